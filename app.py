@@ -1,7 +1,21 @@
-from flask import Flask, render_template, request, jsonify
-import sqlite3, os, calendar
-from datetime import date, timedelta
+from flask import Flask, render_template, request, jsonify, g, has_app_context, make_response
+from werkzeug.security import safe_join
+import sqlite3, os, re, calendar, threading, queue, heapq, time, hashlib, json, base64, csv, io
+import unicodedata, gzip
+import click
+from concurrent.futures import Future, TimeoutError as FuturoExpirado
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
 from dateutil.relativedelta import relativedelta  # pip install python-dateutil
+try:
+    import brotli                                   # opcional: pip install brotli
+except ImportError:
+    brotli = None
+try:
+    import fcntl                                    # só POSIX: lock do agendador entre workers
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 DB = 'financas.db'
@@ -10,109 +24,470 @@ DB = 'financas.db'
 # BANCO DE DADOS
 # ================================================================
 
-def get_db():
-    conn = sqlite3.connect(DB, check_same_thread=False)
+# Aplicados UMA vez por conexão, logo após abrir.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # leitores não bloqueiam o escritor
+    "PRAGMA synchronous=NORMAL",    # seguro em WAL, sem fsync a cada commit
+    "PRAGMA mmap_size=268435456",   # 256 MB mapeados em memória
+    "PRAGMA cache_size=-16000",     # ~16 MB de page cache
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+DB_CACHED_STATEMENTS = 256          # cache de prepared statements por conexão
+
+_db_trace = None                    # callback de trace (verificar-indices)
+
+_db_stats = {'abertas': 0, 'fechadas': 0}
+_db_stats_lock = threading.Lock()
+_db_local = threading.local()
+
+def _conectar():
+    conn = sqlite3.connect(DB, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
     conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    if _db_trace is not None:
+        conn.set_trace_callback(_db_trace)
+    with _db_stats_lock:
+        _db_stats['abertas'] += 1
     return conn
 
-def init_db():
-    with get_db() as conn:
-        c = conn.cursor()
+def _fechar(conn):
+    conn.close()
+    with _db_stats_lock:
+        _db_stats['fechadas'] += 1
+
+def get_db():
+    """
+    Conexão compartilhada: uma por requisição (guardada em flask.g e fechada
+    no teardown) ou, fora de requisição (CLI, threads), uma por thread.
+    Continua funcionando como `with get_db() as conn:` — o `with` só faz
+    commit/rollback, quem fecha é o teardown.
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = _conectar()
+        return g.db
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = _db_local.conn = _conectar()
+    return conn
 
-        # ── transacoes ──────────────────────────────────────────
-        # valor = valor TOTAL da compra (não da parcela).
-        # Para calcular a parcela: valor / parcelas.
-        # tipo_cobranca='fixa' agora é APENAS legado/avulsa — despesas fixas recorrentes
-        # ficam em despesas_fixas (igual a receitas_fixas).
-        c.execute('''CREATE TABLE IF NOT EXISTS transacoes (
-            id               INTEGER PRIMARY KEY AUTOINCREMENT,
-            tipo             TEXT NOT NULL CHECK(tipo IN ('despesa','receita')),
-            descricao        TEXT NOT NULL,
-            valor            REAL NOT NULL,   -- valor TOTAL; parcela = valor/parcelas
-            categoria        TEXT,
-            id_cartao        INTEGER REFERENCES cartoes(id),
-            id_conta         INTEGER REFERENCES contas(id),
-            tipo_receita     TEXT CHECK(tipo_receita  IN ('avulsa','fixa'))     DEFAULT 'avulsa',
-            tipo_cobranca    TEXT CHECK(tipo_cobranca IN ('avulsa','fixa'))     DEFAULT 'avulsa',
-            dia_vencimento   INTEGER,
-            tipo_compra      TEXT CHECK(tipo_compra   IN ('credito','debito'))  DEFAULT 'credito',
-            pagamento        TEXT CHECK(pagamento     IN ('avista','parcelado')) DEFAULT 'avista',
-            parcelas         INTEGER DEFAULT NULL,
-            data_lancamento  DATE NOT NULL DEFAULT (DATE('now'))
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS categorias (
-            id   INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT UNIQUE NOT NULL,
-            tipo TEXT CHECK(tipo IN ('despesa','receita')) DEFAULT 'despesa'
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS contas (
-            id    INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome  TEXT UNIQUE NOT NULL,
-            saldo REAL DEFAULT 0
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS cartoes (
-            id              INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome            TEXT UNIQUE NOT NULL,
-            conta           INTEGER NOT NULL REFERENCES contas(id),
-            tipo_pagamento  TEXT CHECK(tipo_pagamento IN ('credito','debito','multiplo')),
-            data_vencimento INTEGER,   -- dia do mês (1-31)
-            dias_fechamento INTEGER,   -- dias antes do vencimento que a fatura fecha
-            limite          REAL DEFAULT 0
-        )''')
-
-        # ── receitas_fixas ──────────────────────────────────────
-        # Receitas recorrentes (salário, aluguel recebido, etc.).
-        # modo_dia: 'fixo' | 'primeiro_util' | 'ultimo_util'
-        c.execute('''CREATE TABLE IF NOT EXISTS receitas_fixas (
-            id        INTEGER PRIMARY KEY AUTOINCREMENT,
-            descricao TEXT NOT NULL,
-            valor     REAL NOT NULL,
-            categoria TEXT,
-            id_conta  INTEGER NOT NULL REFERENCES contas(id),
-            dia_mes   INTEGER NOT NULL DEFAULT 1,
-            modo_dia  TEXT NOT NULL DEFAULT 'fixo',
-            ativa     INTEGER DEFAULT 1
-        )''')
-
-        # ── despesas_fixas ──────────────────────────────────────
-        # Assinaturas e gastos recorrentes (Netflix, academia, aluguel, etc.).
-        # Funciona exatamente como receitas_fixas mas debita a conta ou fica
-        # na fatura do cartão.
-        # Se id_cartao preenchido → vai para crédito (não debita conta direto).
-        # Se id_conta preenchido e sem cartão → debita a conta no dia.
-        c.execute('''CREATE TABLE IF NOT EXISTS despesas_fixas (
-            id        INTEGER PRIMARY KEY AUTOINCREMENT,
-            descricao TEXT NOT NULL,
-            valor     REAL NOT NULL,
-            categoria TEXT,
-            id_cartao INTEGER REFERENCES cartoes(id),
-            id_conta  INTEGER REFERENCES contas(id),
-            dia_mes   INTEGER NOT NULL DEFAULT 1,
-            modo_dia  TEXT NOT NULL DEFAULT 'fixo',
-            ativa     INTEGER DEFAULT 1
-        )''')
-
-        # Migrações seguras
-        for sql in [
-            "ALTER TABLE receitas_fixas ADD COLUMN modo_dia TEXT NOT NULL DEFAULT 'fixo'",
-            "ALTER TABLE despesas_fixas ADD COLUMN modo_dia TEXT NOT NULL DEFAULT 'fixo'",
-        ]:
-            try: c.execute(sql)
-            except: pass
-
-        # Categorias padrão
-        for nome, tipo in [
-            ('Alimentação','despesa'), ('Transporte','despesa'), ('Moradia','despesa'),
-            ('Saúde','despesa'),       ('Educação','despesa'),   ('Lazer','despesa'),
-            ('Assinaturas','despesa'), ('Salário','receita'),
-            ('Investimentos','receita'), ('Freelance','receita'), ('Presente','receita'),
-        ]:
-            c.execute("INSERT OR IGNORE INTO categorias (nome, tipo) VALUES (?,?)", (nome, tipo))
+def fechar_db_thread():
+    """Fecha a conexão da thread atual (threads de fundo, ao terminar)."""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        _db_local.conn = None
+        _fechar(conn)
 
-        conn.commit()
+@app.teardown_appcontext
+def fechar_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        _fechar(conn)
+
+def db_stats() -> dict:
+    with _db_stats_lock:
+        return {**_db_stats, 'ativas': _db_stats['abertas'] - _db_stats['fechadas']}
+
+def avancar_geracao(c):
+    c.execute("UPDATE meta SET valor=valor+1 WHERE chave='geracao'")
+
+def geracao_atual(conn=None) -> int:
+    """Geração dos dados: muda sempre que algo é gravado."""
+    conn = conn or get_db()
+    return conn.execute("SELECT valor FROM meta WHERE chave='geracao'").fetchone()[0]
+
+def coluna_existe(c, tabela: str, coluna: str) -> bool:
+    c.execute(f"PRAGMA table_info({tabela})")
+    return any(r[1] == coluna for r in c.fetchall())
+
+def reinstalar_triggers(c, sqls):
+    """Recria triggers (DROP + CREATE) quando a definição deles muda."""
+    for sql in sqls:
+        nome = re.search(r'CREATE TRIGGER IF NOT EXISTS (\w+)', sql).group(1)
+        c.execute(f"DROP TRIGGER IF EXISTS {nome}")
+        c.execute(sql)
+
+
+# ================================================================
+# MIGRAÇÕES
+# ================================================================
+# Cada passo roda UMA vez, na sua própria transação, e a versão aplicada fica
+# em PRAGMA user_version. Para mudar o schema: acrescente um passo no FIM de
+# MIGRACOES (nunca edite/reordene passos já publicados).
+
+def _migracao_schema_base(c):
+    # ── transacoes ──────────────────────────────────────────
+    # valor = valor TOTAL da compra (não da parcela).
+    # Para calcular a parcela: valor / parcelas.
+    # tipo_cobranca='fixa' agora é APENAS legado/avulsa — despesas fixas recorrentes
+    # ficam em despesas_fixas (igual a receitas_fixas).
+    c.execute('''CREATE TABLE IF NOT EXISTS transacoes (
+        id               INTEGER PRIMARY KEY AUTOINCREMENT,
+        tipo             TEXT NOT NULL CHECK(tipo IN ('despesa','receita')),
+        descricao        TEXT NOT NULL,
+        valor            REAL NOT NULL,   -- valor TOTAL; parcela = valor/parcelas
+        categoria        TEXT,
+        id_cartao        INTEGER REFERENCES cartoes(id),
+        id_conta         INTEGER REFERENCES contas(id),
+        tipo_receita     TEXT CHECK(tipo_receita  IN ('avulsa','fixa'))     DEFAULT 'avulsa',
+        tipo_cobranca    TEXT CHECK(tipo_cobranca IN ('avulsa','fixa'))     DEFAULT 'avulsa',
+        dia_vencimento   INTEGER,
+        tipo_compra      TEXT CHECK(tipo_compra   IN ('credito','debito'))  DEFAULT 'credito',
+        pagamento        TEXT CHECK(pagamento     IN ('avista','parcelado')) DEFAULT 'avista',
+        parcelas         INTEGER DEFAULT NULL,
+        data_lancamento  DATE NOT NULL DEFAULT (DATE('now'))
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS categorias (
+        id   INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT UNIQUE NOT NULL,
+        tipo TEXT CHECK(tipo IN ('despesa','receita')) DEFAULT 'despesa'
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS contas (
+        id    INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome  TEXT UNIQUE NOT NULL,
+        saldo REAL DEFAULT 0
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS cartoes (
+        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome            TEXT UNIQUE NOT NULL,
+        conta           INTEGER NOT NULL REFERENCES contas(id),
+        tipo_pagamento  TEXT CHECK(tipo_pagamento IN ('credito','debito','multiplo')),
+        data_vencimento INTEGER,   -- dia do mês (1-31)
+        dias_fechamento INTEGER,   -- dias antes do vencimento que a fatura fecha
+        limite          REAL DEFAULT 0
+    )''')
+
+    # ── receitas_fixas ──────────────────────────────────────
+    # Receitas recorrentes (salário, aluguel recebido, etc.).
+    # modo_dia: 'fixo' | 'primeiro_util' | 'ultimo_util'
+    c.execute('''CREATE TABLE IF NOT EXISTS receitas_fixas (
+        id        INTEGER PRIMARY KEY AUTOINCREMENT,
+        descricao TEXT NOT NULL,
+        valor     REAL NOT NULL,
+        categoria TEXT,
+        id_conta  INTEGER NOT NULL REFERENCES contas(id),
+        dia_mes   INTEGER NOT NULL DEFAULT 1,
+        modo_dia  TEXT NOT NULL DEFAULT 'fixo',
+        ativa     INTEGER DEFAULT 1
+    )''')
+
+    # ── despesas_fixas ──────────────────────────────────────
+    # Assinaturas e gastos recorrentes (Netflix, academia, aluguel, etc.).
+    # Funciona exatamente como receitas_fixas mas debita a conta ou fica
+    # na fatura do cartão.
+    # Se id_cartao preenchido → vai para crédito (não debita conta direto).
+    # Se id_conta preenchido e sem cartão → debita a conta no dia.
+    c.execute('''CREATE TABLE IF NOT EXISTS despesas_fixas (
+        id        INTEGER PRIMARY KEY AUTOINCREMENT,
+        descricao TEXT NOT NULL,
+        valor     REAL NOT NULL,
+        categoria TEXT,
+        id_cartao INTEGER REFERENCES cartoes(id),
+        id_conta  INTEGER REFERENCES contas(id),
+        dia_mes   INTEGER NOT NULL DEFAULT 1,
+        modo_dia  TEXT NOT NULL DEFAULT 'fixo',
+        ativa     INTEGER DEFAULT 1
+    )''')
+
+    # Bancos antigos, anteriores à coluna modo_dia
+    for tabela in ('receitas_fixas', 'despesas_fixas'):
+        if not coluna_existe(c, tabela, 'modo_dia'):
+            c.execute(f"ALTER TABLE {tabela} ADD COLUMN modo_dia TEXT NOT NULL DEFAULT 'fixo'")
+
+    # Categorias padrão
+    for nome, tipo in [
+        ('Alimentação','despesa'), ('Transporte','despesa'), ('Moradia','despesa'),
+        ('Saúde','despesa'),       ('Educação','despesa'),   ('Lazer','despesa'),
+        ('Assinaturas','despesa'), ('Salário','receita'),
+        ('Investimentos','receita'), ('Freelance','receita'), ('Presente','receita'),
+    ]:
+        c.execute("INSERT OR IGNORE INTO categorias (nome, tipo) VALUES (?,?)", (nome, tipo))
+
+
+def _migracao_parcelas(c):
+    # ── parcelas ────────────────────────────────────────────
+    # Cronograma materializado das compras parceladas: uma linha por
+    # parcela, já com a competência (mês em que ela cai), o cartão e a
+    # categoria. Escrito por adicionar_lancamento e limpo por
+    # remover_lancamento — os agregados mensais consultam esta tabela
+    # em vez de re-expandir cada compra em Python a cada requisição.
+    c.execute('''CREATE TABLE IF NOT EXISTS parcelas (
+        id_transacao INTEGER NOT NULL REFERENCES transacoes(id) ON DELETE CASCADE,
+        numero       INTEGER NOT NULL,   -- 1..total_parcelas
+        total        INTEGER NOT NULL,
+        competencia  TEXT    NOT NULL,   -- 'YYYY-MM'
+        ciclo        DATE,               -- início do ciclo de fatura (crédito; ver _migracao_ciclo_parcelas)
+        id_cartao    INTEGER REFERENCES cartoes(id),
+        tipo_compra  TEXT,
+        categoria    TEXT,
+        valor        REAL    NOT NULL,   -- valor DA PARCELA
+        PRIMARY KEY (id_transacao, numero)
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_parcelas_competencia ON parcelas(competencia, categoria)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_parcelas_cartao ON parcelas(id_cartao, competencia)")
+
+    # Parceladas antigas (anteriores à tabela) ainda sem cronograma
+    c.execute('''
+        SELECT id FROM transacoes t
+        WHERE tipo='despesa' AND pagamento='parcelado' AND parcelas >= 2
+          AND NOT EXISTS (SELECT 1 FROM parcelas p WHERE p.id_transacao=t.id)
+    ''')
+    materializar_parcelas(c, [r[0] for r in c.fetchall()])
+
+
+def _migracao_rollup_cartao(c):
+    # ── rollup_cartao_mes ───────────────────────────────────
+    # Gasto por cartão × mês × categoria (à vista pelo mês do lançamento,
+    # parcelado pela competência da parcela). Mantido por triggers, então
+    # é atualizado na MESMA transação de qualquer INSERT/DELETE em
+    # transacoes/parcelas. Ocorrências geradas de fixas ficam de fora, como
+    # no dashboard do cartão.
+    c.execute('''CREATE TABLE IF NOT EXISTS rollup_cartao_mes (
+        id_cartao   INTEGER NOT NULL,
+        competencia TEXT    NOT NULL,   -- 'YYYY-MM'
+        categoria   TEXT    NOT NULL,   -- 'Sem categoria' quando NULL
+        avista      REAL    NOT NULL DEFAULT 0,
+        parcelado   REAL    NOT NULL DEFAULT 0,
+        PRIMARY KEY (id_cartao, competencia, categoria)
+    )''')
+    for sql in triggers_rollup_cartao(_gerada_legado):
+        c.execute(sql)
+    reconstruir_rollup_cartao(c, _gerada_legado)
+
+
+def _migracao_resumo_mensal(c):
+    # ── resumo_mensal ───────────────────────────────────────
+    # Totais por mês × conta que alimentam /visaoGeral. Também mantido por
+    # triggers: cobre adicionar/remover_lancamento e os gerar_ocorrencias_*.
+    # Despesas sem conta própria usam a conta do cartão; 0 = sem conta.
+    c.execute('''CREATE TABLE IF NOT EXISTS resumo_mensal (
+        competencia         TEXT    NOT NULL,   -- 'YYYY-MM'
+        id_conta            INTEGER NOT NULL,
+        receitas            REAL    NOT NULL DEFAULT 0,
+        despesas_avista     REAL    NOT NULL DEFAULT 0,
+        despesas_parceladas REAL    NOT NULL DEFAULT 0,
+        despesas_fixas      REAL    NOT NULL DEFAULT 0,   -- ocorrências geradas de despesas_fixas
+        PRIMARY KEY (competencia, id_conta)
+    )''')
+    for sql in triggers_resumo(_gerada_legado):
+        c.execute(sql)
+    reconstruir_resumo_mensal(c, _gerada_legado)
+
+
+def _migracao_origem_fixas(c):
+    # ── origem das ocorrências geradas ──────────────────────
+    # Antes, a ocorrência de uma fixa era marcada com categoria='_rf_<id>' ou
+    # '_df_<id>', o que obrigava todo agregado a filtrar com NOT LIKE (sem
+    # índice) e perdia a categoria real. Agora: id_receita_fixa/id_despesa_fixa
+    # + competencia ('YYYY-MM'), com UNIQUE por (fixa, competência).
+    for coluna, tipo in (('id_receita_fixa', 'INTEGER REFERENCES receitas_fixas(id)'),
+                         ('id_despesa_fixa', 'INTEGER REFERENCES despesas_fixas(id)'),
+                         ('competencia',     'TEXT')):
+        if not coluna_existe(c, 'transacoes', coluna):
+            c.execute(f"ALTER TABLE transacoes ADD COLUMN {coluna} {tipo}")
+
+    for prefixo, coluna, tabela in (('_rf_', 'id_receita_fixa', 'receitas_fixas'),
+                                    ('_df_', 'id_despesa_fixa', 'despesas_fixas')):
+        # Primeira ocorrência de cada (fixa, mês) ganha a origem; duplicatas
+        # antigas, se houver, viram lançamentos comuns (já mexeram no saldo).
+        c.execute(f"""
+            UPDATE transacoes SET
+                {coluna}    = CAST(substr(categoria, 5) AS INTEGER),
+                competencia = strftime('%Y-%m', data_lancamento)
+            WHERE id IN (SELECT MIN(id) FROM transacoes
+                         WHERE substr(categoria, 1, 4) = ?
+                         GROUP BY categoria, strftime('%Y-%m', data_lancamento))
+        """, (prefixo,))
+        c.execute(f"""
+            UPDATE transacoes SET categoria = (
+                SELECT f.categoria FROM {tabela} f
+                WHERE f.id = CAST(substr(transacoes.categoria, 5) AS INTEGER))
+            WHERE substr(categoria, 1, 4) = ?
+        """, (prefixo,))
+
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS ux_transacoes_receita_fixa
+                 ON transacoes(id_receita_fixa, competencia) WHERE id_receita_fixa IS NOT NULL""")
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS ux_transacoes_despesa_fixa
+                 ON transacoes(id_despesa_fixa, competencia) WHERE id_despesa_fixa IS NOT NULL""")
+
+    # Triggers dos agregados passam a usar as colunas de origem
+    reinstalar_triggers(c, triggers_rollup_cartao() + triggers_resumo())
+    reconstruir_rollup_cartao(c)
+    reconstruir_resumo_mensal(c)
+
+
+def _migracao_indices_transacoes(c):
+    # ── índices de transacoes ───────────────────────────────
+    # Casam com os caminhos reais de acesso; os filtros de mês usam faixas
+    # meio-abertas (data_lancamento >= ? AND data_lancamento < ?).
+    for sql in (
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_tipo_pag_data ON transacoes(tipo, pagamento, data_lancamento)",
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_tipo_data     ON transacoes(tipo, data_lancamento, id)",
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_cartao        ON transacoes(id_cartao, tipo, data_lancamento)",
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_conta         ON transacoes(id_conta, tipo, data_lancamento)",
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_data          ON transacoes(data_lancamento, id)",
+    ):
+        c.execute(sql)
+
+
+def _migracao_gerar_desde(c):
+    # ── gerar_desde nas fixas ───────────────────────────────
+    # O agendador recupera meses perdidos a partir da última ocorrência
+    # gerada; gerar_desde ('YYYY-MM') é o piso dessa recuperação, gravado na
+    # criação e na reativação — uma fixa pausada não gera os meses parados.
+    for tabela in ('receitas_fixas', 'despesas_fixas'):
+        if not coluna_existe(c, tabela, 'gerar_desde'):
+            c.execute(f"ALTER TABLE {tabela} ADD COLUMN gerar_desde TEXT")
+
+
+def _migracao_meta(c):
+    # ── meta / geração dos dados ────────────────────────────
+    # 'geracao' avança a cada lote gravado pela fila de escrita; respostas
+    # cacheadas (e os ETags) são chaveadas por ela. Fica no banco para valer
+    # entre processos.
+    c.execute("""CREATE TABLE IF NOT EXISTS meta (
+        chave TEXT PRIMARY KEY,
+        valor INTEGER NOT NULL
+    )""")
+    c.execute("INSERT OR IGNORE INTO meta (chave, valor) VALUES ('geracao', 0)")
+
+
+def _migracao_faturas(c):
+    # ── faturas fechadas ────────────────────────────────────
+    # Snapshot de cada ciclo fechado (ver fechar_faturas). UNIQUE por
+    # (cartão, vencimento) também serve a consulta de histórico por faixa.
+    c.execute("""CREATE TABLE IF NOT EXISTS faturas (
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        id_cartao   INTEGER NOT NULL REFERENCES cartoes(id),
+        inicio      DATE    NOT NULL,
+        fim         DATE    NOT NULL,
+        vencimento  DATE    NOT NULL,
+        total       REAL    NOT NULL,
+        fechada_em  DATE    NOT NULL,
+        UNIQUE (id_cartao, vencimento)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS faturas_itens (
+        id_fatura       INTEGER NOT NULL REFERENCES faturas(id),
+        id_transacao    INTEGER,
+        descricao       TEXT,
+        data_lancamento DATE,
+        categoria       TEXT,
+        parcela         INTEGER,    -- número da parcela (NULL = à vista)
+        total_parcelas  INTEGER,
+        valor           REAL    NOT NULL
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_faturas_itens_fatura ON faturas_itens(id_fatura)")
+    for sql in triggers_faturas():
+        c.execute(sql)
+
+
+def _migracao_busca(c):
+    # ── busca textual ───────────────────────────────────────
+    # Índice FTS5 dos lançamentos (ver BUSCA TEXTUAL); rowid = transacoes.id.
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS busca_transacoes USING fts5(
+        descricao, categoria, cartao, conta,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )""")
+    for sql in triggers_busca():
+        c.execute(sql)
+    reconstruir_busca(c)
+
+
+def _migracao_hash_importacao(c):
+    # ── lançamentos importados de extratos ──────────────────
+    # Hash do conteúdo de cada linha importada (ver importar_extrato): o
+    # índice único faz reimportar o mesmo extrato pular o que já entrou.
+    if not coluna_existe(c, 'transacoes', 'hash_importacao'):
+        c.execute("ALTER TABLE transacoes ADD COLUMN hash_importacao TEXT")
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_transacoes_hash_importacao
+                 ON transacoes(hash_importacao) WHERE hash_importacao IS NOT NULL""")
+
+
+def _migracao_ciclo_parcelas(c):
+    # ── ciclo de fatura de cada parcela ─────────────────────
+    # A parcela 1 cai no ciclo da compra e cada seguinte no ciclo seguinte;
+    # `ciclo` guarda o início desse ciclo, fixado na materialização. Uma
+    # compra nova nunca entra num ciclo já fechado. Os snapshots antigos,
+    # montados pela competência, são refeitos pelo próximo fechar_faturas.
+    if not coluna_existe(c, 'parcelas', 'ciclo'):
+        c.execute("ALTER TABLE parcelas ADD COLUMN ciclo DATE")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_parcelas_ciclo ON parcelas(id_cartao, ciclo)")
+    c.execute('''
+        SELECT p.id_transacao, t.data_lancamento, k.data_vencimento, k.dias_fechamento, MAX(p.numero)
+        FROM parcelas p
+        JOIN transacoes t ON t.id = p.id_transacao
+        JOIN cartoes k ON k.id = p.id_cartao
+        WHERE p.tipo_compra = 'credito' AND p.ciclo IS NULL
+          AND k.data_vencimento IS NOT NULL AND k.dias_fechamento IS NOT NULL
+        GROUP BY p.id_transacao
+    ''')
+    linhas = []
+    for tid, data_str, dia_venc, dias_fech, n in c.fetchall():
+        try:
+            data_compra = date.fromisoformat(str(data_str)[:10])
+        except ValueError:
+            continue
+        linhas += [(ciclo.isoformat(), tid, numero)
+                   for numero, ciclo in enumerate(ciclos_parcelas(dia_venc, dias_fech, data_compra, n), 1)]
+    c.executemany("UPDATE parcelas SET ciclo=? WHERE id_transacao=? AND numero=?", linhas)
+    reinstalar_triggers(c, triggers_faturas())
+    c.execute("DELETE FROM faturas")
+
+
+def _migracao_lotes_gravados(c):
+    # ── lotes gravados ──────────────────────────────────────
+    # Uma linha por lote da fila de escrita (geração + cartões tocados),
+    # gravada no mesmo COMMIT. É por aqui que o stream SSE de um processo
+    # fica sabendo do que outro worker gravou (ver TransmissorEventos).
+    c.execute("""CREATE TABLE IF NOT EXISTS lotes_gravados (
+        geracao INTEGER PRIMARY KEY,
+        cartoes TEXT    NOT NULL    -- JSON: ids dos cartões afetados
+    )""")
+
+
+MIGRACOES = [
+    _migracao_schema_base,
+    _migracao_parcelas,
+    _migracao_rollup_cartao,
+    _migracao_resumo_mensal,
+    _migracao_origem_fixas,
+    _migracao_indices_transacoes,
+    _migracao_gerar_desde,
+    _migracao_meta,
+    _migracao_faturas,
+    _migracao_busca,
+    _migracao_hash_importacao,
+    _migracao_ciclo_parcelas,
+    _migracao_lotes_gravados,
+]
+
+
+def init_db() -> int:
+    """
+    Aplica só as migrações pendentes (PRAGMA user_version < len(MIGRACOES)),
+    cada uma na sua transação. Banco já atualizado = uma leitura de pragma e
+    nenhum DDL. Retorna quantos passos foram aplicados.
+    """
+    conn = get_db()
+    versao = conn.execute("PRAGMA user_version").fetchone()[0]
+    pendentes = MIGRACOES[versao:]
+    for numero, passo in enumerate(pendentes, start=versao + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            passo(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        app.logger.info('Migração %d (%s) aplicada', numero, passo.__name__)
+    return len(pendentes)
 
 
 # ================================================================
@@ -123,18 +498,72 @@ FERIADOS_FIXOS_BR = {
     (1,1),(4,21),(5,1),(9,7),(10,12),(11,2),(11,15),(12,25)
 }
 
+# Feriados móveis, em dias a partir do domingo de Páscoa. Carnaval é ponto
+# facultativo, mas não há expediente bancário — para salário/débito conta
+# como feriado.
+FERIADOS_MOVEIS_BR = {
+    -48: 'Carnaval (segunda)',
+    -47: 'Carnaval (terça)',
+     -2: 'Sexta-feira Santa',
+     60: 'Corpus Christi',
+}
+
+def pascoa(ano: int) -> date:
+    """Domingo de Páscoa (algoritmo de Meeus/Jones/Butcher, calendário gregoriano)."""
+    a, b, c = ano % 19, ano // 100, ano % 100
+    d, e = b // 4, b % 4
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    mes, dia = divmod(h + l - 7 * m + 114, 31)
+    return date(ano, mes, dia + 1)
+
+@lru_cache(maxsize=256)
+def feriados_br(ano: int) -> frozenset:
+    p = pascoa(ano)
+    return frozenset({date(ano, m, d) for m, d in FERIADOS_FIXOS_BR} |
+                     {p + timedelta(days=n) for n in FERIADOS_MOVEIS_BR})
+
+@lru_cache(maxsize=256)
+def calendario_util(ano: int) -> tuple:
+    """
+    Calendário pré-calculado do ano: (uteis, primeiros, ultimos).
+    uteis     — bytes com 1 byte por dia do ano (1 = dia útil), índice = dia do ano - 1
+    primeiros — primeiro dia útil de cada mês (índice 1..12)
+    ultimos   — último dia útil de cada mês (índice 1..12)
+    """
+    feriados = feriados_br(ano)
+    inicio = date(ano, 1, 1)
+    n_dias = 366 if calendar.isleap(ano) else 365
+    dias = [inicio + timedelta(days=i) for i in range(n_dias)]
+    uteis = bytes(d.weekday() < 5 and d not in feriados for d in dias)
+    primeiros, ultimos = [None] * 13, [None] * 13
+    for d, util in zip(dias, uteis):
+        if util:
+            primeiros[d.month] = primeiros[d.month] or d
+            ultimos[d.month] = d
+    return uteis, tuple(primeiros), tuple(ultimos)
+
 def eh_dia_util(d: date) -> bool:
-    return d.weekday() < 5 and (d.month, d.day) not in FERIADOS_FIXOS_BR
+    return bool(calendario_util(d.year)[0][d.toordinal() - date(d.year, 1, 1).toordinal()])
 
 def primeiro_dia_util(ano: int, mes: int) -> date:
-    d = date(ano, mes, 1)
-    while not eh_dia_util(d): d += timedelta(days=1)
-    return d
+    return calendario_util(ano)[1][mes]
 
 def ultimo_dia_util(ano: int, mes: int) -> date:
-    d = date(ano, mes, calendar.monthrange(ano, mes)[1])
-    while not eh_dia_util(d): d -= timedelta(days=1)
-    return d
+    return calendario_util(ano)[2][mes]
+
+def limites_mes(competencia: str) -> tuple:
+    """
+    'YYYY-MM' → ('YYYY-MM-01', 1º dia do mês seguinte), para filtrar com
+    data_lancamento >= ? AND data_lancamento < ? (usa índice, ao contrário
+    de strftime('%Y-%m', data_lancamento) = ?).
+    """
+    inicio = date.fromisoformat(competencia + '-01')
+    return inicio.isoformat(), (inicio + relativedelta(months=1)).isoformat()
 
 def data_ocorrencia(ano: int, mes: int, dia_mes: int, modo_dia: str) -> date:
     """Data efetiva de um lançamento fixo em determinado mês/ano."""
@@ -143,70 +572,518 @@ def data_ocorrencia(ano: int, mes: int, dia_mes: int, modo_dia: str) -> date:
     return date(ano, mes, min(dia_mes, calendar.monthrange(ano, mes)[1]))
 
 
+# ================================================================
+# ESCRITA EM GRUPO (group commit)
+# ================================================================
+# Uma única thread é dona da conexão de escrita e drena uma fila de
+# operações. Tudo o que acumulou enquanto o último commit acontecia vai num
+# só BEGIN IMMEDIATE … COMMIT: um fsync para o lote inteiro e nenhuma disputa
+# de lock entre escritores. Cada operação roda sob um SAVEPOINT próprio, então
+# a falha de uma não desfaz as outras do lote.
+#
+# Uma operação é uma função op(c) -> resultado, que recebe o cursor da
+# conexão de escrita. Quem chama recebe um Future (ou o resultado/exceção,
+# via escrever()).
+#
+# Triggers TEMP (só nesta conexão) anotam os cartões tocados pelo lote;
+# depois do COMMIT os ouvintes recebem essa lista (ex.: o stream SSE). A
+# mesma lista vai para lotes_gravados, no próprio lote, para os outros
+# processos (serve --workers N).
+
+LOTES_GUARDADOS = 1000      # últimos lotes mantidos em lotes_gravados
+
+# Cartões afetados: lançamentos com cartão e o próprio cadastro de cartões.
+SQL_RASTREIO_CARTOES = [
+    "CREATE TEMP TABLE IF NOT EXISTS cartoes_afetados (id INTEGER PRIMARY KEY)",
+] + [
+    f"""CREATE TEMP TRIGGER IF NOT EXISTS trg_afetado_{nome} AFTER {evento} ON main.{tabela}
+        WHEN {linha}.{coluna} IS NOT NULL
+        BEGIN INSERT OR IGNORE INTO cartoes_afetados (id) VALUES ({linha}.{coluna}); END"""
+    for nome, evento, tabela, linha, coluna in (
+        ('transacoes_ins', 'INSERT', 'transacoes', 'NEW', 'id_cartao'),
+        ('transacoes_del', 'DELETE', 'transacoes', 'OLD', 'id_cartao'),
+        ('cartoes_ins',    'INSERT', 'cartoes',    'NEW', 'id'),
+        ('cartoes_upd',    'UPDATE', 'cartoes',    'NEW', 'id'),
+        ('cartoes_del',    'DELETE', 'cartoes',    'OLD', 'id'),
+    )
+]
+
+def registrar_lote(c):
+    """Grava (geração atual, cartões afetados) do lote em andamento e poda os antigos."""
+    c.execute("""INSERT INTO lotes_gravados (geracao, cartoes)
+                 SELECT valor, (SELECT json_group_array(id) FROM temp.cartoes_afetados)
+                 FROM meta WHERE chave='geracao'""")
+    c.execute("""DELETE FROM lotes_gravados
+                 WHERE geracao <= (SELECT valor FROM meta WHERE chave='geracao') - ?""",
+              (LOTES_GUARDADOS,))
+
+class EscritorDB:
+    MAX_LOTE = 256
+
+    def __init__(self):
+        self._fila = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.stats = {'operacoes': 0, 'lotes': 0, 'falhas': 0, 'maior_lote': 0}
+        self.ouvintes = []      # callbacks(cartoes_afetados), chamados após cada COMMIT
+
+    def _garantir_thread(self):
+        # Sobe sob demanda — e de novo após um fork, já que threads não são herdadas
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    # Fila herdada do pai: ninguém neste processo espera por ela.
+                    # Thread que só morreu deixa a fila como está, para a nova drenar.
+                    self._fila = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name='escritor-db', daemon=True)
+                self._thread.start()
+
+    def submeter(self, op) -> Future:
+        self._garantir_thread()
+        fut = Future()
+        self._fila.put((op, fut))
+        return fut
+
+    def parar(self, timeout: float = 10):
+        """
+        Drena a fila e encerra a thread, fechando a conexão de escrita. Usado
+        antes de um fork: nem thread nem conexão SQLite atravessam para os
+        workers (o próximo submeter() sobe outra).
+        """
+        with self._lock:
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is None or not thread.is_alive():
+            return
+        self._fila.put(None)
+        thread.join(timeout)
+
+    def _loop(self):
+        conn = sqlite3.connect(DB, isolation_level=None, check_same_thread=False,
+                               cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        for sql in SQL_RASTREIO_CARTOES:
+            conn.execute(sql)
+        parar = False
+        while not parar:
+            lote = [self._fila.get()]
+            while len(lote) < self.MAX_LOTE:
+                try:
+                    lote.append(self._fila.get_nowait())
+                except queue.Empty:
+                    break
+            if None in lote:
+                # Sentinela de parar(): o que veio antes dela ainda é gravado
+                lote, parar = lote[:lote.index(None)], True
+            if lote:
+                try:
+                    self._executar_lote(conn, lote)
+                except Exception:
+                    app.logger.exception('Falha inesperada na fila de escrita')
+        conn.close()
+
+    def _executar_lote(self, conn, lote):
+        resultados, gravou = [], False
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for op, fut in lote:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT op")
+                try:
+                    resultados.append((fut, op(conn.cursor()), None))
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    resultados.append((fut, None, e))
+            gravou = any(e is None for _, _, e in resultados)
+            if gravou:
+                avancar_geracao(conn)
+                registrar_lote(conn)
+            conn.execute("COMMIT")
+        except Exception as e:
+            # Falha do lote inteiro (BEGIN/COMMIT): ninguém foi gravado. Ops
+            # que o laço não chegou a pegar ainda podem ser canceladas por
+            # escrever(): só recebem o erro as que forem reivindicadas agora.
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            resultados, gravou = [(fut, None, e) for op, fut in lote
+                                  if not fut.cancelled()
+                                  and (fut.running() or fut.set_running_or_notify_cancel())], False
+        with self._lock:
+            self.stats['lotes'] += 1
+            self.stats['operacoes'] += len(lote)
+            self.stats['falhas'] += sum(1 for _, _, e in resultados if e is not None)
+            self.stats['maior_lote'] = max(self.stats['maior_lote'], len(lote))
+        cartoes = [r[0] for r in conn.execute("SELECT id FROM temp.cartoes_afetados")]
+        conn.execute("DELETE FROM temp.cartoes_afetados")
+        for fut, resultado, erro in resultados:
+            if erro is not None:
+                fut.set_exception(erro)
+            else:
+                fut.set_result(resultado)
+        if gravou:
+            for ouvinte in self.ouvintes:
+                try:
+                    ouvinte(cartoes)
+                except Exception:
+                    app.logger.exception('Falha em ouvinte da fila de escrita')
+
+
+escritor = EscritorDB()
+
+
+class EscritaIndisponivel(Exception):
+    """A fila de escrita não chegou na operação a tempo; ela foi cancelada e nada foi gravado."""
+
+
+def escrever(op, timeout: float = 30):
+    """
+    Executa op(c) na thread de escrita e devolve o resultado (ou relança o
+    erro). Se o prazo vence com a op ainda na fila, ela é cancelada (o lote
+    pula futures cancelados) e sobe EscritaIndisponivel → 503. Se ela já
+    está rodando, vai gravar: espera o fim em vez de relatar uma falha falsa.
+    """
+    fut = escritor.submeter(op)
+    try:
+        return fut.result(timeout)
+    except FuturoExpirado:
+        if fut.cancel():
+            raise EscritaIndisponivel(f'fila de escrita ocupada há mais de {timeout:g}s') from None
+        return fut.result()
+
+
+@app.errorhandler(EscritaIndisponivel)
+def escrita_indisponivel(e):
+    resp = jsonify({'success': False, 'error': 'Banco ocupado, tente novamente'})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '5'
+    app.logger.warning('Escrita cancelada: %s', e)
+    return resp
+
+
 # ================================================================
 # GERAÇÃO AUTOMÁTICA DE OCORRÊNCIAS
 # ================================================================
 
-def gerar_ocorrencias_receitas_fixas():
+SQL_OCORRENCIA_RECEITA = """INSERT OR IGNORE INTO transacoes
+    (tipo,descricao,valor,categoria,id_conta,tipo_receita,data_lancamento,id_receita_fixa,competencia)
+    VALUES ('receita',?,?,?,?,'avulsa',?,?,?)"""
+
+SQL_OCORRENCIA_DESPESA = """INSERT OR IGNORE INTO transacoes
+    (tipo,descricao,valor,categoria,id_cartao,id_conta,tipo_cobranca,tipo_compra,pagamento,
+     data_lancamento,id_despesa_fixa,competencia)
+    VALUES ('despesa',?,?,?,?,?,'fixa',?,'avista',?,?,?)"""
+
+
+def ocorrencias_a_partir(ultima, desde, dia_mes: int, modo: str, hoje: date):
     """
-    Para cada receita fixa ativa: se a data de ocorrência do mês atual
-    já chegou/passou e ainda não foi gerada → cria a transação e credita saldo.
+    (competencia, data) de cada mês ainda não gerado de uma fixa, em ordem e
+    sem fim: começa no mês seguinte à última ocorrência gerada (ou no mês
+    atual, se nunca gerou), nunca antes de `desde` ('YYYY-MM').
     """
-    hoje = date.today()
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT id, descricao, valor, categoria, id_conta, dia_mes, modo_dia FROM receitas_fixas WHERE ativa=1")
-        for rf_id, desc, valor, cat, id_conta, dia_mes, modo in c.fetchall():
-            data_oc = data_ocorrencia(hoje.year, hoje.month, dia_mes, modo or 'fixo')
-            if hoje < data_oc: continue
-            chave = f'_rf_{rf_id}'
-            c.execute("SELECT COUNT(*) FROM transacoes WHERE tipo='receita' AND id_conta=? AND categoria=? AND strftime('%Y-%m',data_lancamento)=?",
-                      (id_conta, chave, hoje.strftime('%Y-%m')))
-            if c.fetchone()[0] > 0: continue
-            c.execute("INSERT INTO transacoes (tipo,descricao,valor,categoria,id_conta,tipo_receita,data_lancamento) VALUES ('receita',?,?,?,?,'avulsa',?)",
-                      (desc, valor, chave, id_conta, data_oc.isoformat()))
-            c.execute("UPDATE contas SET saldo=saldo+? WHERE id=?", (valor, id_conta))
-        conn.commit()
+    if ultima:
+        mes = date.fromisoformat(ultima + '-01') + relativedelta(months=1)
+    else:
+        mes = date(hoje.year, hoje.month, 1)
+    if desde:
+        mes = max(mes, date.fromisoformat(desde + '-01'))
+    while True:
+        yield mes.strftime('%Y-%m'), data_ocorrencia(mes.year, mes.month, dia_mes, modo or 'fixo')
+        mes += relativedelta(months=1)
+
+
+def _filtro_ids(coluna: str, ids) -> tuple:
+    if ids is None: return '', ()
+    return f"AND {coluna} IN ({','.join('?' * len(ids))})", tuple(ids)
 
 
-def gerar_ocorrencias_despesas_fixas():
+def _gerar_receitas_fixas(c, hoje: date, ids=None):
     """
-    Para cada despesa fixa ativa: se a data de ocorrência do mês atual
-    já chegou/passou e ainda não foi gerada → cria a transação.
-    - Com cartão de crédito: não debita conta (entra na fatura).
-    - Com débito/conta direta: debita a conta imediatamente.
+    Para cada receita fixa ativa: cria as ocorrências de todos os meses já
+    vencidos e ainda não gerados (recupera meses perdidos com o servidor
+    parado) e credita o saldo. Devolve (proximas, geradas), onde proximas são
+    entradas (data, 'receita', id) da próxima ocorrência de cada fixa.
+    A ocorrência é marcada com (id_receita_fixa, competencia); o índice UNIQUE
+    sobre esse par garante no máximo uma por mês.
     """
-    hoje = date.today()
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT id, descricao, valor, categoria, id_cartao, id_conta, dia_mes, modo_dia FROM despesas_fixas WHERE ativa=1")
-        for df_id, desc, valor, cat, id_cartao, id_conta, dia_mes, modo in c.fetchall():
-            data_oc = data_ocorrencia(hoje.year, hoje.month, dia_mes, modo or 'fixo')
-            if hoje < data_oc: continue
-            chave = f'_df_{df_id}'
-            c.execute("SELECT COUNT(*) FROM transacoes WHERE tipo='despesa' AND categoria=? AND strftime('%Y-%m',data_lancamento)=?",
-                      (chave, hoje.strftime('%Y-%m')))
-            if c.fetchone()[0] > 0: continue
-
-            # Determina tipo_compra pelo cartão
-            tipo_compra = 'credito'
-            if id_cartao:
-                c.execute("SELECT tipo_pagamento FROM cartoes WHERE id=?", (id_cartao,))
-                row = c.fetchone()
-                if row and row[0] == 'debito': tipo_compra = 'debito'
-            else:
-                tipo_compra = 'debito'  # sem cartão → débito direto na conta
+    filtro, params = _filtro_ids('rf.id', ids)
+    c.execute(f"""
+        SELECT rf.id, rf.descricao, rf.valor, rf.categoria, rf.id_conta, rf.dia_mes, rf.modo_dia,
+               rf.gerar_desde,
+               (SELECT MAX(t.competencia) FROM transacoes t WHERE t.id_receita_fixa=rf.id)
+        FROM receitas_fixas rf
+        WHERE rf.ativa=1 {filtro}
+    """, params)
+    proximas, geradas, saldos = [], 0, {}
+    for rf_id, desc, valor, cat, id_conta, dia_mes, modo, desde, ultima in c.fetchall():
+        for competencia, data_oc in ocorrencias_a_partir(ultima, desde, dia_mes, modo, hoje):
+            if hoje < data_oc:
+                proximas.append((data_oc, 'receita', rf_id))
+                break
+            c.execute(SQL_OCORRENCIA_RECEITA, (desc, valor, cat, id_conta, data_oc.isoformat(), rf_id, competencia))
+            if c.rowcount:
+                geradas += 1
+                saldos[id_conta] = saldos.get(id_conta, 0) + valor
+    c.executemany("UPDATE contas SET saldo=saldo+? WHERE id=?",
+                  [(v, conta) for conta, v in saldos.items()])
+    return proximas, geradas
 
-            c.execute("""INSERT INTO transacoes
-                (tipo,descricao,valor,categoria,id_cartao,id_conta,tipo_cobranca,tipo_compra,pagamento,data_lancamento)
-                VALUES ('despesa',?,?,?,?,?,'fixa',?,'avista',?)""",
-                (desc, valor, chave, id_cartao, id_conta, tipo_compra, data_oc.isoformat()))
 
+def _gerar_despesas_fixas(c, hoje: date, ids=None):
+    """
+    Para cada despesa fixa ativa: cria as ocorrências vencidas e ainda não
+    geradas, como em _gerar_receitas_fixas.
+    - Com cartão de crédito: não debita conta (entra na fatura).
+    - Com débito/conta direta: debita a conta imediatamente.
+    """
+    filtro, params = _filtro_ids('df.id', ids)
+    c.execute(f"""
+        SELECT df.id, df.descricao, df.valor, df.categoria, df.id_cartao, df.id_conta,
+               df.dia_mes, df.modo_dia, ca.tipo_pagamento, df.gerar_desde,
+               (SELECT MAX(t.competencia) FROM transacoes t WHERE t.id_despesa_fixa=df.id)
+        FROM despesas_fixas df
+        LEFT JOIN cartoes ca ON ca.id = df.id_cartao
+        WHERE df.ativa=1 {filtro}
+    """, params)
+    proximas, geradas, saldos = [], 0, {}
+    for df_id, desc, valor, cat, id_cartao, id_conta, dia_mes, modo, tp, desde, ultima in c.fetchall():
+        # Determina tipo_compra pelo cartão (sem cartão → débito direto na conta)
+        tipo_compra = 'debito' if (not id_cartao or tp == 'debito') else 'credito'
+        for competencia, data_oc in ocorrencias_a_partir(ultima, desde, dia_mes, modo, hoje):
+            if hoje < data_oc:
+                proximas.append((data_oc, 'despesa', df_id))
+                break
+            c.execute(SQL_OCORRENCIA_DESPESA,
+                      (desc, valor, cat, id_cartao, id_conta, tipo_compra, data_oc.isoformat(), df_id, competencia))
+            if not c.rowcount: continue
+            geradas += 1
             # Débito direto → desconta da conta imediatamente
             if tipo_compra == 'debito' and id_conta:
-                c.execute("UPDATE contas SET saldo=saldo-? WHERE id=?", (valor, id_conta))
+                saldos[id_conta] = saldos.get(id_conta, 0) + valor
+    c.executemany("UPDATE contas SET saldo=saldo-? WHERE id=?",
+                  [(v, conta) for conta, v in saldos.items()])
+    return proximas, geradas
 
-        conn.commit()
+
+def gerar_ocorrencias_fixas(ids_receitas=None, ids_despesas=None, hoje: date = None):
+    """
+    Gera, numa única operação de escrita, tudo o que está vencido das fixas
+    indicadas (None = todas as ativas; [] = nenhuma). Devolve (proximas, geradas).
+    """
+    if ids_receitas is not None and ids_despesas is not None and not ids_receitas and not ids_despesas:
+        return [], 0
+    hoje = hoje or date.today()
+    def op(c):
+        proximas, geradas = [], 0
+        if ids_receitas is None or ids_receitas:
+            p, n = _gerar_receitas_fixas(c, hoje, ids_receitas)
+            proximas += p; geradas += n
+        if ids_despesas is None or ids_despesas:
+            p, n = _gerar_despesas_fixas(c, hoje, ids_despesas)
+            proximas += p; geradas += n
+        return proximas, geradas
+    return escrever(op)
+
+
+class AgendadorFixas:
+    """
+    Thread que mantém um min-heap (data, tipo, id) com a próxima ocorrência de
+    cada fixa ativa e o próximo fechamento de fatura de cada cartão, e só
+    acorda quando a do topo vence. Ao subir (e a cada recarregar(), chamado
+    quando uma fixa ou cartão muda) faz a recuperação completa: todos os meses
+    e ciclos perdidos.
+    """
+    MAX_ESPERA = 6 * 3600   # reavalia o topo ao menos a cada 6h (relógio ajustado, suspensão)
+    ESPERA_COMPARTILHADO = 30   # com vários workers: de quanto em quanto olha meta('agenda')
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._recarregar = True
+        self._thread = None
+        self._pid = None
+        # Vários processos (serve --workers N): só um roda a thread, e os
+        # recarregar() dos outros chegam pelo contador meta('agenda').
+        self.compartilhado = False
+        self._agenda_vista = None
+        self.stats = {'execucoes': 0, 'geradas': 0, 'faturas': 0, 'proxima': None}
+
+    def iniciar(self):
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._recarregar = True
+            self._thread = threading.Thread(target=self._loop, name='agendador-fixas', daemon=True)
+            self._thread.start()
+
+    def recarregar(self):
+        if self.compartilhado:
+            escrever(lambda c: c.execute(
+                "INSERT INTO meta (chave, valor) VALUES ('agenda', 1) "
+                "ON CONFLICT(chave) DO UPDATE SET valor = valor + 1"))
+        with self._cond:
+            self._recarregar = True
+            self._cond.notify()
+
+    def _versao_agenda(self):
+        linha = get_db().execute("SELECT valor FROM meta WHERE chave='agenda'").fetchone()
+        return linha[0] if linha else 0
+
+    def _espera(self):
+        if not self._heap: return self.MAX_ESPERA
+        vence = datetime.combine(self._heap[0][0], datetime.min.time())
+        return min((vence - datetime.now()).total_seconds(), self.MAX_ESPERA)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._recarregar and self._espera() > 0:
+                    if not self.compartilhado:
+                        self._cond.wait(self._espera())
+                        continue
+                    self._cond.wait(min(self._espera(), self.ESPERA_COMPARTILHADO))
+                    if self._versao_agenda() != self._agenda_vista:
+                        self._recarregar = True
+                completo, self._recarregar = self._recarregar, False
+                if completo and self.compartilhado:
+                    self._agenda_vista = self._versao_agenda()
+                vencidas = []
+                if not completo:
+                    hoje = date.today()
+                    while self._heap and self._heap[0][0] <= hoje:
+                        vencidas.append(heapq.heappop(self._heap))
+            try:
+                if completo:
+                    proximas, geradas = gerar_ocorrencias_fixas()
+                    faturas, fechadas = fechar_faturas()
+                else:
+                    proximas, geradas = gerar_ocorrencias_fixas(
+                        [i for _, tipo, i in vencidas if tipo == 'receita'],
+                        [i for _, tipo, i in vencidas if tipo == 'despesa'])
+                    faturas, fechadas = fechar_faturas(
+                        [i for _, tipo, i in vencidas if tipo == 'fatura'])
+                proximas += faturas
+            except Exception:
+                app.logger.exception('Falha ao gerar ocorrências fixas')
+                with self._cond:
+                    self._heap.extend(vencidas)
+                    heapq.heapify(self._heap)
+                    self._cond.wait(60)
+                    self._recarregar = True
+                continue
+            with self._cond:
+                if completo:
+                    self._heap = proximas
+                    heapq.heapify(self._heap)
+                else:
+                    for item in proximas:
+                        heapq.heappush(self._heap, item)
+                self.stats['execucoes'] += 1
+                self.stats['geradas'] += geradas
+                self.stats['faturas'] += fechadas
+                self.stats['proxima'] = self._heap[0][0].isoformat() if self._heap else None
+
+
+agendador = AgendadorFixas()
+
+
+# ── backfill histórico ──────────────────────────────────
+MAX_MESES_BACKFILL = 120
+
+def backfill(desde: str, ate: str, hoje: date = None) -> dict:
+    """
+    Expande todas as fixas ativas pelos meses desde..ate ('YYYY-MM',
+    inclusive; nada depois de hoje) numa única operação de escrita: um
+    executemany por tabela e um UPDATE de saldo por conta. Pares (fixa,
+    competência) já existentes são pulados, então rodar de novo sobre uma
+    faixa sobreposta não duplica nada.
+    """
+    hoje = hoje or date.today()
+    meses, mes = [], date.fromisoformat(desde + '-01')
+    while mes <= date.fromisoformat(ate + '-01'):
+        meses.append(mes)
+        mes += relativedelta(months=1)
+
+    def expandir(fixas, existentes):
+        for f in fixas:
+            for mes in meses:
+                competencia = mes.strftime('%Y-%m')
+                if (f['id'], competencia) in existentes: continue
+                data_oc = data_ocorrencia(mes.year, mes.month, f['dia_mes'], f['modo_dia'] or 'fixo')
+                if data_oc > hoje: break
+                yield f, competencia, data_oc
+
+    def op(c):
+        saldos = {}
+
+        c.execute("""SELECT id_receita_fixa, competencia FROM transacoes
+                     WHERE id_receita_fixa IS NOT NULL AND competencia BETWEEN ? AND ?""", (desde, ate))
+        existentes = set(map(tuple, c.fetchall()))
+        c.execute("""SELECT id, descricao, valor, categoria, id_conta, dia_mes, modo_dia
+                     FROM receitas_fixas WHERE ativa=1""")
+        receitas = []
+        for f, competencia, data_oc in expandir(c.fetchall(), existentes):
+            receitas.append((f['descricao'], f['valor'], f['categoria'], f['id_conta'],
+                             data_oc.isoformat(), f['id'], competencia))
+            saldos[f['id_conta']] = saldos.get(f['id_conta'], 0) + f['valor']
+        c.executemany(SQL_OCORRENCIA_RECEITA, receitas)
+
+        c.execute("""SELECT id_despesa_fixa, competencia FROM transacoes
+                     WHERE id_despesa_fixa IS NOT NULL AND competencia BETWEEN ? AND ?""", (desde, ate))
+        existentes = set(map(tuple, c.fetchall()))
+        c.execute("""SELECT df.id, df.descricao, df.valor, df.categoria, df.id_cartao, df.id_conta,
+                            df.dia_mes, df.modo_dia, ca.tipo_pagamento
+                     FROM despesas_fixas df LEFT JOIN cartoes ca ON ca.id = df.id_cartao
+                     WHERE df.ativa=1""")
+        despesas = []
+        for f, competencia, data_oc in expandir(c.fetchall(), existentes):
+            tipo_compra = 'debito' if (not f['id_cartao'] or f['tipo_pagamento'] == 'debito') else 'credito'
+            despesas.append((f['descricao'], f['valor'], f['categoria'], f['id_cartao'], f['id_conta'],
+                             tipo_compra, data_oc.isoformat(), f['id'], competencia))
+            if tipo_compra == 'debito' and f['id_conta']:
+                saldos[f['id_conta']] = saldos.get(f['id_conta'], 0) - f['valor']
+        c.executemany(SQL_OCORRENCIA_DESPESA, despesas)
+
+        c.executemany("UPDATE contas SET saldo=saldo+? WHERE id=?",
+                      [(v, conta) for conta, v in saldos.items() if v])
+        return {'receitas': len(receitas), 'despesas': len(despesas),
+                'saldos': {conta: round(v, 2) for conta, v in saldos.items()}}
+    return escrever(op)
+
+
+def validar_faixa_backfill(desde, ate):
+    """Mensagem de erro para uma faixa inválida, ou None."""
+    padrao = re.compile(r'\d{4}-(0[1-9]|1[0-2])')
+    if not desde or not ate or not padrao.fullmatch(desde) or not padrao.fullmatch(ate):
+        return 'desde e ate devem estar no formato YYYY-MM'
+    if desde > ate:
+        return 'desde deve ser anterior ou igual a ate'
+    meses = (int(ate[:4]) - int(desde[:4])) * 12 + int(ate[5:]) - int(desde[5:]) + 1
+    if meses > MAX_MESES_BACKFILL:
+        return f'faixa máxima de {MAX_MESES_BACKFILL} meses'
+    return None
+
+
+@app.cli.command('backfill')
+@click.argument('desde')
+@click.argument('ate')
+def cli_backfill(desde, ate):
+    """Gera as ocorrências históricas das fixas entre DESDE e ATE (YYYY-MM)."""
+    erro = validar_faixa_backfill(desde, ate)
+    if erro:
+        raise click.BadParameter(erro)
+    r = backfill(desde, ate)
+    print(f"Geradas {r['receitas']} receitas e {r['despesas']} despesas fixas.")
+    for conta, delta in sorted(r['saldos'].items()):
+        print(f'  conta {conta}: {delta:+.2f}')
 
 
 # ================================================================
@@ -233,117 +1110,774 @@ def periodo_fatura_atual(dia_vencimento: int, dias_fechamento: int, referencia:
     return fech_anterior, fech_atual - timedelta(days=1), venc_atual
 
 
-def valor_parcela_na_fatura(valor_total: float, parcelas: int,
-                             data_compra: date, inicio_fatura: date, fim_fatura: date) -> float:
+def ciclos_parcelas(dia_vencimento: int, dias_fechamento: int, data_compra: date, n: int) -> list:
+    """Início do ciclo de fatura de cada uma das n parcelas: o da compra e os n-1 seguintes."""
+    inicio, fim, _ = periodo_fatura_atual(dia_vencimento, dias_fechamento, data_compra)
+    ciclos = [inicio]
+    for _ in range(n - 1):
+        inicio, fim, _ = periodo_fatura_atual(dia_vencimento, dias_fechamento, fim + timedelta(days=1))
+        ciclos.append(inicio)
+    return ciclos
+
+
+# ================================================================
+# PARCELAS MATERIALIZADAS
+# ================================================================
+
+def materializar_parcelas(c, ids) -> int:
+    """
+    Gera as linhas de `parcelas` para as transações informadas.
+    Parcela N (1-based) cai no mês (data_compra + N-1 meses), com valor
+    round(valor_total / parcelas, 2); no crédito, o ciclo de fatura é o
+    N-ésimo a partir do da compra.
+    Deve ser chamada no mesmo cursor/transação do INSERT em transacoes.
     """
-    Retorna o valor de UMA parcela se alguma delas cair no período da fatura.
+    ids = list(ids)
+    if not ids:
+        return 0
+    linhas = []
+    for i in range(0, len(ids), 500):
+        lote = ids[i:i + 500]
+        c.execute(f"""
+            SELECT t.id, t.valor, t.parcelas, t.data_lancamento, t.id_cartao, t.tipo_compra, t.categoria,
+                   k.data_vencimento, k.dias_fechamento
+            FROM transacoes t
+            LEFT JOIN cartoes k ON k.id = t.id_cartao
+            WHERE t.id IN ({','.join('?' * len(lote))})
+              AND t.tipo='despesa' AND t.pagamento='parcelado' AND t.parcelas >= 2
+        """, lote)
+        for tid, valor_total, n, data_str, id_cartao, tipo_compra, cat, dia_venc, dias_fech in c.fetchall():
+            try:
+                data_compra = date.fromisoformat(str(data_str)[:10])
+            except Exception:
+                continue
+            vp = round(valor_total / n, 2)
+            base = data_compra.replace(day=1)
+            if tipo_compra == 'credito' and dia_venc is not None and dias_fech is not None:
+                ciclos = [d.isoformat() for d in ciclos_parcelas(dia_venc, dias_fech, data_compra, n)]
+            else:
+                ciclos = [None] * n
+            for p in range(n):
+                comp = (base + relativedelta(months=p)).strftime('%Y-%m')
+                linhas.append((tid, p + 1, n, comp, ciclos[p], id_cartao, tipo_compra, cat, vp))
+    c.executemany("""
+        INSERT OR IGNORE INTO parcelas
+            (id_transacao, numero, total, competencia, ciclo, id_cartao, tipo_compra, categoria, valor)
+        VALUES (?,?,?,?,?,?,?,?,?)
+    """, linhas)
+    return len(linhas)
 
-    Regra: parcela N cai no mês (data_compra + N meses).
-    Comparação por mês/ano: o período da fatura cobre aquele mês inteiro?
-    Isso é correto porque o cartão cobra a parcela no mês em que ela cai,
-    independente do dia exato dentro do mês.
+
+# ================================================================
+# MOTOR DE FATURAS
+# ================================================================
+# Uma fatura [inicio, fim] de um cartão = compras de crédito à vista no
+# período + as parcelas cujo ciclo (parcelas.ciclo, o início do ciclo em que
+# a parcela cai, fixado na compra) começa nele — cada compra entra com UMA
+# parcela por fatura, e nunca numa fatura de antes da compra.
+#
+# calcular_faturas resolve qualquer quantidade de janelas (cartões × ciclos)
+# numa só consulta: as janelas entram como uma CTE VALUES e o join usa
+# idx_transacoes_cartao / idx_parcelas_ciclo. Totais são arredondados uma vez,
+# por janela; quem soma várias janelas arredonda de novo no fim.
+
+def calcular_faturas(c, janelas, com_itens: bool = False) -> list:
+    """
+    janelas = [(id_cartao, inicio, fim)]. Devolve, na mesma ordem, um dict
+    {'total', 'itens'} por janela (itens só com com_itens=True; parcela e
+    total_parcelas são None para compras à vista).
     """
-    if not parcelas or parcelas < 1:
-        return 0.0
-    vp = round(valor_total / parcelas, 2)
-    for p in range(parcelas):
-        mes_parcela = data_compra + relativedelta(months=p)
-        ultimo = calendar.monthrange(mes_parcela.year, mes_parcela.month)[1]
-        ini_mes = mes_parcela.replace(day=1)
-        fim_mes = mes_parcela.replace(day=ultimo)
-        if inicio_fatura <= fim_mes and fim_fatura >= ini_mes:
-            return vp
-    return 0.0
+    janelas = list(janelas)
+    resultado = [{'total': 0.0, 'itens': []} for _ in janelas]
+    somas = [0.0] * len(janelas)
+    for base in range(0, len(janelas), 500):
+        lote = janelas[base:base + 500]
+        valores = ','.join(['(?,?,?,?)'] * len(lote))
+        params = []
+        for i, (cartao_id, inicio, fim) in enumerate(lote, start=base):
+            params += [i, cartao_id, inicio.isoformat(), fim.isoformat()]
+        linhas = f"""
+            WITH janelas(n, id_cartao, inicio, fim) AS (VALUES {valores})
+            SELECT j.n, t.id, t.descricao, t.data_lancamento, t.categoria, NULL AS parcela, NULL AS total_parcelas, t.valor
+            FROM janelas j
+            JOIN transacoes t ON t.id_cartao = j.id_cartao AND t.tipo = 'despesa'
+                             AND t.data_lancamento BETWEEN j.inicio AND j.fim
+            WHERE t.tipo_compra = 'credito' AND t.pagamento = 'avista'
+            UNION ALL
+            SELECT j.n, t.id, t.descricao, t.data_lancamento, p.categoria, p.numero, p.total, p.valor
+            FROM janelas j
+            JOIN parcelas p ON p.id_cartao = j.id_cartao AND p.ciclo BETWEEN j.inicio AND j.fim
+            JOIN transacoes t ON t.id = p.id_transacao
+            WHERE p.tipo_compra = 'credito'
+        """
+        if com_itens:
+            c.execute(linhas + " ORDER BY 1, 4, 2", params)
+            for n, tid, desc, data_l, cat, parcela, total_parc, valor in c.fetchall():
+                somas[n] += valor
+                resultado[n]['itens'].append({
+                    'id_transacao': tid, 'descricao': desc, 'data': data_l, 'categoria': cat,
+                    'parcela': parcela, 'total_parcelas': total_parc, 'valor': round(valor, 2)})
+        else:
+            c.execute(f"SELECT n, SUM(valor) FROM ({linhas}) GROUP BY n", params)
+            for n, soma in c.fetchall():
+                somas[n] = soma
+    for r, soma in zip(resultado, somas):
+        r['total'] = round(soma, 2)
+    return resultado
 
 
-def total_fatura_atual():
+def faturas_abertas(c, cartao_id: int = None, com_itens: bool = False, hoje: date = None) -> dict:
     """
-    Soma o que está na fatura aberta de todos os cartões de crédito.
-    Para compras parceladas: conta apenas o valor da parcela do mês,
-    não o valor total da compra.
+    Fatura aberta de cada cartão de crédito/múltiplo (ou só de cartao_id):
+    {id_cartao: {'inicio', 'fim', 'vencimento', 'total', 'itens'}}.
     """
-    total = 0.0
+    filtro, params = _filtro_ids('id', None if cartao_id is None else [cartao_id])
+    c.execute(f"""
+        SELECT id, data_vencimento, dias_fechamento FROM cartoes
+        WHERE tipo_pagamento IN ('credito','multiplo')
+          AND data_vencimento IS NOT NULL AND dias_fechamento IS NOT NULL {filtro}
+    """, params)
+    periodos = {r[0]: periodo_fatura_atual(r[1], r[2], hoje) for r in c.fetchall()}
+    calculadas = calcular_faturas(c, [(cid, ini, fim) for cid, (ini, fim, _) in periodos.items()],
+                                  com_itens)
+    return {cid: {'inicio': ini, 'fim': fim, 'vencimento': venc, **fatura}
+            for (cid, (ini, fim, venc)), fatura in zip(periodos.items(), calculadas)}
+
+
+# ================================================================
+# FATURAS FECHADAS (snapshots)
+# ================================================================
+# Quando o ciclo de um cartão fecha, a fatura vira uma linha em `faturas`
+# (período, vencimento, total) mais as linhas de `faturas_itens`. O
+# histórico é lido direto dessas tabelas; só o ciclo aberto é calculado.
+# Um lançamento retroativo que caia num ciclo já fechado apaga o snapshot
+# (triggers abaixo) e ele é refeito na próxima passada de fechar_faturas.
+# Parcelas invalidam pelo ciclo em que caem, fixado na compra: uma compra
+# feita depois do fechamento não reabre a fatura fechada.
+
+def ciclos_fechados(dia_vencimento: int, dias_fechamento: int, desde: date, hoje: date) -> list:
+    """
+    Ciclos (inicio, fim, vencimento) já fechados em `hoje` cujo período
+    termina em/após `desde`, do mais antigo ao mais recente. Cada ciclo é o
+    que periodo_fatura_atual devolveria num dia dentro dele.
+    """
+    inicio = periodo_fatura_atual(dia_vencimento, dias_fechamento, hoje)[0]
+    ciclos = []
+    while True:
+        ciclo = periodo_fatura_atual(dia_vencimento, dias_fechamento, inicio - timedelta(days=1))
+        if ciclo[1] < desde or ciclo[0] >= inicio:
+            break
+        ciclos.append(ciclo)
+        inicio = ciclo[0]
+    return ciclos[::-1]
+
+
+def ciclos_sem_snapshot(c, cartao_id: int, dia_venc: int, dias_fech: int, hoje: date) -> list:
+    """Ciclos fechados do cartão, desde a primeira compra (ou só o último), ainda sem snapshot."""
+    c.execute("SELECT MIN(data_lancamento) FROM transacoes WHERE id_cartao=? AND tipo='despesa'",
+              (cartao_id,))
+    primeira = c.fetchone()[0]
+    if primeira:
+        desde = date.fromisoformat(str(primeira)[:10])
+    else:
+        desde = periodo_fatura_atual(dia_venc, dias_fech, hoje)[0] - timedelta(days=1)
+    c.execute("SELECT vencimento FROM faturas WHERE id_cartao=?", (cartao_id,))
+    existentes = {r[0] for r in c.fetchall()}
+    return [ciclo for ciclo in ciclos_fechados(dia_venc, dias_fech, desde, hoje)
+            if ciclo[2].isoformat() not in existentes]
+
+
+def _fechar_faturas(c, hoje: date, ids=None):
+    """
+    Grava o snapshot de todo ciclo fechado que ainda não tem um, desde a
+    primeira compra do cartão (ou só o último ciclo, se não houver compras).
+    Devolve (proximas, fechadas): proximas são entradas (data, 'fatura', id)
+    com o dia em que o ciclo aberto de cada cartão fecha.
+    """
+    filtro, params = _filtro_ids('id', ids)
+    c.execute(f"""
+        SELECT id, data_vencimento, dias_fechamento FROM cartoes
+        WHERE tipo_pagamento IN ('credito','multiplo')
+          AND data_vencimento IS NOT NULL AND dias_fechamento IS NOT NULL {filtro}
+    """, params)
+    proximas, fechadas = [], 0
+    for cartao_id, dia_venc, dias_fech in c.fetchall():
+        fim_aberta = periodo_fatura_atual(dia_venc, dias_fech, hoje)[1]
+        proximas.append((fim_aberta + timedelta(days=1), 'fatura', cartao_id))
+        ciclos = ciclos_sem_snapshot(c, cartao_id, dia_venc, dias_fech, hoje)
+        calculadas = calcular_faturas(c, [(cartao_id, ini, fim) for ini, fim, _ in ciclos], com_itens=True)
+        for (inicio, fim, venc), fatura in zip(ciclos, calculadas):
+            c.execute("""INSERT INTO faturas (id_cartao, inicio, fim, vencimento, total, fechada_em)
+                         VALUES (?,?,?,?,?,?)""",
+                      (cartao_id, inicio.isoformat(), fim.isoformat(), venc.isoformat(),
+                       fatura['total'], hoje.isoformat()))
+            id_fatura = c.lastrowid
+            c.executemany("""
+                INSERT INTO faturas_itens
+                    (id_fatura, id_transacao, descricao, data_lancamento, categoria, parcela, total_parcelas, valor)
+                VALUES (?,?,?,?,?,?,?,?)
+            """, [(id_fatura, i['id_transacao'], i['descricao'], i['data'], i['categoria'],
+                   i['parcela'], i['total_parcelas'], i['valor']) for i in fatura['itens']])
+            fechadas += 1
+    return proximas, fechadas
+
+
+def fechar_faturas(ids_cartoes=None, hoje: date = None):
+    """fechar_faturas para os cartões indicados (None = todos), na fila de escrita."""
+    if ids_cartoes is not None and not ids_cartoes:
+        return [], 0
+    hoje = hoje or date.today()
+    return escrever(lambda c: _fechar_faturas(c, hoje, ids_cartoes))
+
+
+def triggers_faturas() -> list:
+    """Snapshot que cobre um lançamento/parcela alterado deixa de valer."""
+    return [
+        """CREATE TRIGGER IF NOT EXISTS trg_faturas_itens_del AFTER DELETE ON faturas
+           BEGIN DELETE FROM faturas_itens WHERE id_fatura = OLD.id; END""",
+    ] + [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_faturas_inval_{nome} AFTER {evento} ON {tabela}
+            WHEN {linha}.id_cartao IS NOT NULL {quando}
+            BEGIN
+                DELETE FROM faturas WHERE id_cartao = {linha}.id_cartao {periodo};
+            END"""
+        for nome, evento, tabela, linha, quando, periodo in (
+            ('transacao_ins', 'INSERT', 'transacoes', 'NEW', "AND NEW.tipo='despesa'",
+             "AND NEW.data_lancamento BETWEEN inicio AND fim"),
+            ('transacao_del', 'DELETE', 'transacoes', 'OLD', "AND OLD.tipo='despesa'",
+             "AND OLD.data_lancamento BETWEEN inicio AND fim"),
+            ('parcela_ins', 'INSERT', 'parcelas', 'NEW', "AND NEW.tipo_compra='credito'",
+             "AND NEW.ciclo BETWEEN inicio AND fim"),
+            ('parcela_del', 'DELETE', 'parcelas', 'OLD', "AND OLD.tipo_compra='credito'",
+             "AND OLD.ciclo BETWEEN inicio AND fim"),
+        )
+    ]
+
+
+# ================================================================
+# BUSCA TEXTUAL (FTS5)
+# ================================================================
+# busca_transacoes espelha descrição, categoria e nomes de cartão/conta de
+# cada lançamento, com rowid = transacoes.id. O tokenizer remove acentos
+# ("cafe" acha "Café") e os índices de prefixo de 2 e 3 letras deixam a
+# busca "enquanto digita" barata. Triggers mantêm o espelho em dia.
+
+# Pesos do bm25 por coluna: descrição vale mais que categoria/cartão/conta
+PESOS_BUSCA = (10.0, 4.0, 2.0, 2.0)
+MAX_TERMOS_BUSCA = 8
+
+
+def triggers_busca() -> list:
+    valores = """NEW.descricao, NEW.categoria,
+                 (SELECT nome FROM cartoes WHERE id = NEW.id_cartao),
+                 (SELECT nome FROM contas  WHERE id = NEW.id_conta)"""
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_busca_ins AFTER INSERT ON transacoes
+            BEGIN
+                INSERT INTO busca_transacoes (rowid, descricao, categoria, cartao, conta)
+                VALUES (NEW.id, {valores});
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_busca_del AFTER DELETE ON transacoes
+           BEGIN DELETE FROM busca_transacoes WHERE rowid = OLD.id; END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_busca_upd
+            AFTER UPDATE OF descricao, categoria, id_cartao, id_conta ON transacoes
+            BEGIN
+                DELETE FROM busca_transacoes WHERE rowid = OLD.id;
+                INSERT INTO busca_transacoes (rowid, descricao, categoria, cartao, conta)
+                VALUES (NEW.id, {valores});
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_busca_cartao_nome AFTER UPDATE OF nome ON cartoes
+           BEGIN
+               UPDATE busca_transacoes SET cartao = NEW.nome
+               WHERE rowid IN (SELECT id FROM transacoes WHERE id_cartao = NEW.id);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_busca_conta_nome AFTER UPDATE OF nome ON contas
+           BEGIN
+               UPDATE busca_transacoes SET conta = NEW.nome
+               WHERE rowid IN (SELECT id FROM transacoes WHERE id_conta = NEW.id);
+           END""",
+    ]
+
+
+def reconstruir_busca(c):
+    c.execute("DELETE FROM busca_transacoes")
+    c.execute("""
+        INSERT INTO busca_transacoes (rowid, descricao, categoria, cartao, conta)
+        SELECT t.id, t.descricao, t.categoria, ca.nome, co.nome
+        FROM transacoes t
+        LEFT JOIN cartoes ca ON ca.id = t.id_cartao
+        LEFT JOIN contas  co ON co.id = t.id_conta
+    """)
+
+
+def expressao_busca(texto: str) -> str:
+    """
+    Texto livre → expressão MATCH: cada palavra vira um prefixo entre aspas
+    ("amaz"* "2024"*), todas obrigatórias. Aspas/operadores do usuário não
+    chegam ao FTS. Sem palavras → ''.
+    """
+    termos = re.findall(r'\w+', texto or '')[:MAX_TERMOS_BUSCA]
+    return ' '.join(f'"{t}"*' for t in termos)
+
+
+def buscar_lancamentos(c, texto: str, args) -> dict:
+    """
+    Lançamentos que casam com `texto`, do mais relevante (bm25) ao menos.
+    args: tipo=despesa|receita, de, ate, limite, cursor (score, id).
+    Retorna {'itens': [dict], 'proximo': cursor | None}; ValueError para
+    parâmetros inválidos.
+    """
+    expr = expressao_busca(texto)
+    if not expr:
+        raise ValueError('q obrigatório')
+    where, params = [], [expr]
+    tipo = args.get('tipo')
+    if tipo:
+        if tipo not in ('despesa', 'receita'):
+            raise ValueError('tipo deve ser despesa ou receita')
+        where.append("t.tipo = ?")
+        params.append(tipo)
+    for nome, (sql, conv) in (('de', _FILTROS_COMUNS['de']), ('ate', _FILTROS_COMUNS['ate'])):
+        if args.get(nome):
+            try:
+                params.append(conv(args[nome]))
+            except ValueError:
+                raise ValueError(f'{nome} inválido')
+            where.append(sql)
+    if args.get('cursor'):
+        try:
+            apos = decodificar_cursor(args['cursor'])
+        except (ValueError, TypeError):
+            raise ValueError('cursor inválido')
+        where.append("(r.score, r.id) > (?, ?)")
+        params.extend(apos)
+    try:
+        limite = max(1, min(int(args.get('limite') or 50), LISTAGEM_LIMITE_MAX))
+    except ValueError:
+        raise ValueError('limite inválido')
+
+    c.execute(f"""
+        SELECT t.id, t.tipo, t.descricao, t.valor, t.categoria, ca.nome, co.nome,
+               t.data_lancamento, t.pagamento, t.parcelas, r.score
+        FROM (SELECT rowid AS id, bm25(busca_transacoes, {', '.join(map(str, PESOS_BUSCA))}) AS score
+              FROM busca_transacoes WHERE busca_transacoes MATCH ?) r
+        JOIN transacoes t ON t.id = r.id
+        LEFT JOIN cartoes ca ON ca.id = t.id_cartao
+        LEFT JOIN contas  co ON co.id = t.id_conta
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY r.score, r.id
+        LIMIT ?
+    """, params + [limite + 1])
+    rows = c.fetchall()
+    proximo = None
+    if len(rows) > limite:
+        rows = rows[:limite]
+        proximo = codificar_cursor(rows[-1][-1], rows[-1][0])
+    chaves = ('id', 'tipo', 'descricao', 'valor', 'categoria', 'cartao', 'conta',
+              'data', 'pagamento', 'parcelas')
+    return {'itens': [dict(zip(chaves, r)) for r in rows], 'proximo': proximo}
+
+
+# ================================================================
+# ROLLUP MENSAL POR CARTÃO
+# ================================================================
+# Os triggers e reconstruções abaixo recebem o predicado "é ocorrência gerada
+# de uma fixa": _gerada (colunas de origem) ou _gerada_legado (chaves
+# '_rf_<id>'/'_df_<id>' em categoria), este usado só pelas migrações antigas.
+
+def _gerada(t: str) -> str:
+    return f"({t}.id_receita_fixa IS NOT NULL OR {t}.id_despesa_fixa IS NOT NULL)"
+
+def _gerada_legado(t: str) -> str:
+    return f"(COALESCE({t}.categoria, '') LIKE '_rf_%' OR COALESCE({t}.categoria, '') LIKE '_df_%')"
+
+
+def triggers_rollup_cartao(gerada=_gerada) -> list:
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_rollup_cartao_avista_ins AFTER INSERT ON transacoes
+            WHEN NEW.tipo='despesa' AND NEW.pagamento='avista' AND NEW.id_cartao IS NOT NULL
+             AND NOT {gerada('NEW')}
+            BEGIN
+                INSERT INTO rollup_cartao_mes (id_cartao, competencia, categoria, avista)
+                VALUES (NEW.id_cartao, strftime('%Y-%m', NEW.data_lancamento),
+                        COALESCE(NEW.categoria, 'Sem categoria'), NEW.valor)
+                ON CONFLICT(id_cartao, competencia, categoria) DO UPDATE SET avista = avista + excluded.avista;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_rollup_cartao_avista_del AFTER DELETE ON transacoes
+            WHEN OLD.tipo='despesa' AND OLD.pagamento='avista' AND OLD.id_cartao IS NOT NULL
+             AND NOT {gerada('OLD')}
+            BEGIN
+                UPDATE rollup_cartao_mes SET avista = avista - OLD.valor
+                WHERE id_cartao=OLD.id_cartao AND competencia=strftime('%Y-%m', OLD.data_lancamento)
+                  AND categoria=COALESCE(OLD.categoria, 'Sem categoria');
+                DELETE FROM rollup_cartao_mes
+                WHERE id_cartao=OLD.id_cartao AND competencia=strftime('%Y-%m', OLD.data_lancamento)
+                  AND categoria=COALESCE(OLD.categoria, 'Sem categoria')
+                  AND ABS(avista) < 0.005 AND ABS(parcelado) < 0.005;
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_rollup_cartao_parcela_ins AFTER INSERT ON parcelas
+            WHEN NEW.id_cartao IS NOT NULL
+            BEGIN
+                INSERT INTO rollup_cartao_mes (id_cartao, competencia, categoria, parcelado)
+                VALUES (NEW.id_cartao, NEW.competencia, COALESCE(NEW.categoria, 'Sem categoria'), NEW.valor)
+                ON CONFLICT(id_cartao, competencia, categoria) DO UPDATE SET parcelado = parcelado + excluded.parcelado;
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_rollup_cartao_parcela_del AFTER DELETE ON parcelas
+            WHEN OLD.id_cartao IS NOT NULL
+            BEGIN
+                UPDATE rollup_cartao_mes SET parcelado = parcelado - OLD.valor
+                WHERE id_cartao=OLD.id_cartao AND competencia=OLD.competencia
+                  AND categoria=COALESCE(OLD.categoria, 'Sem categoria');
+                DELETE FROM rollup_cartao_mes
+                WHERE id_cartao=OLD.id_cartao AND competencia=OLD.competencia
+                  AND categoria=COALESCE(OLD.categoria, 'Sem categoria')
+                  AND ABS(avista) < 0.005 AND ABS(parcelado) < 0.005;
+            END""",
+    ]
+
+
+def reconstruir_rollup_cartao(c, gerada=_gerada):
+    """Recalcula rollup_cartao_mes do zero a partir de transacoes + parcelas."""
+    c.execute("DELETE FROM rollup_cartao_mes")
+    c.execute(f"""
+        INSERT INTO rollup_cartao_mes (id_cartao, competencia, categoria, avista, parcelado)
+        SELECT id_cartao, competencia, categoria, SUM(avista), SUM(parcelado) FROM (
+            SELECT t.id_cartao, strftime('%Y-%m', t.data_lancamento) AS competencia,
+                   COALESCE(t.categoria, 'Sem categoria') AS categoria,
+                   t.valor AS avista, 0 AS parcelado
+            FROM transacoes t
+            WHERE t.tipo='despesa' AND t.pagamento='avista' AND t.id_cartao IS NOT NULL
+              AND NOT {gerada('t')}
+            UNION ALL
+            SELECT id_cartao, competencia, COALESCE(categoria, 'Sem categoria'), 0, valor
+            FROM parcelas WHERE id_cartao IS NOT NULL
+        )
+        GROUP BY id_cartao, competencia, categoria
+    """)
+
+
+def rollup_cartao_historico(c, cartao_id: int, mes_ini: str, mes_fim: str) -> dict:
+    """{'YYYY-MM': total} do cartão no intervalo, direto do rollup."""
+    c.execute("""
+        SELECT competencia, SUM(avista + parcelado) FROM rollup_cartao_mes
+        WHERE id_cartao=? AND competencia BETWEEN ? AND ?
+        GROUP BY competencia
+    """, (cartao_id, mes_ini, mes_fim))
+    return {comp: total for comp, total in c.fetchall()}
+
+
+def rollup_cartao_categorias(c, cartao_id: int, mes: str, limit: int = 5) -> list:
+    """Top categorias do cartão no mês, direto do rollup."""
+    c.execute("""
+        SELECT categoria, SUM(avista + parcelado) AS total FROM rollup_cartao_mes
+        WHERE id_cartao=? AND competencia=?
+        GROUP BY categoria
+        ORDER BY total DESC
+    """, (cartao_id, mes))
+    return top_categorias({cat: total for cat, total in c.fetchall()}, limit)
+
+
+# ================================================================
+# RESUMO MENSAL (VISÃO GERAL)
+# ================================================================
+
+def _sql_trigger_resumo(nome, evento, tabela, quando, coluna, competencia, conta, valor):
+    """Monta o trigger que soma (INSERT) ou subtrai (DELETE) `valor` em resumo_mensal.coluna."""
+    if evento == 'INSERT':
+        corpo = f"""
+            INSERT INTO resumo_mensal (competencia, id_conta, {coluna})
+            VALUES ({competencia}, {conta}, {valor})
+            ON CONFLICT(competencia, id_conta) DO UPDATE SET {coluna} = {coluna} + excluded.{coluna};"""
+    else:
+        corpo = f"""
+            UPDATE resumo_mensal SET {coluna} = {coluna} - {valor}
+            WHERE competencia={competencia} AND id_conta={conta};
+            DELETE FROM resumo_mensal
+            WHERE competencia={competencia} AND id_conta={conta}
+              AND ABS(receitas) < 0.005 AND ABS(despesas_avista) < 0.005
+              AND ABS(despesas_parceladas) < 0.005 AND ABS(despesas_fixas) < 0.005;"""
+    return f"""CREATE TRIGGER IF NOT EXISTS {nome} AFTER {evento} ON {tabela}
+        WHEN {quando}
+        BEGIN{corpo}
+        END"""
+
+
+def triggers_resumo(gerada=_gerada) -> list:
+    sqls = []
+    for evento, r in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+        sufixo = 'ins' if evento == 'INSERT' else 'del'
+        comp = f"strftime('%Y-%m', {r}.data_lancamento)"
+        conta_desp = f"COALESCE({r}.id_conta, (SELECT conta FROM cartoes WHERE id={r}.id_cartao), 0)"
+        sqls += [
+            _sql_trigger_resumo(f'trg_resumo_receita_{sufixo}', evento, 'transacoes',
+                                f"{r}.tipo='receita'", 'receitas',
+                                comp, f"COALESCE({r}.id_conta, 0)", f"{r}.valor"),
+            _sql_trigger_resumo(f'trg_resumo_avista_{sufixo}', evento, 'transacoes',
+                                f"{r}.tipo='despesa' AND {r}.pagamento='avista' AND NOT {gerada(r)}",
+                                'despesas_avista', comp, conta_desp, f"{r}.valor"),
+            _sql_trigger_resumo(f'trg_resumo_fixa_{sufixo}', evento, 'transacoes',
+                                f"{r}.tipo='despesa' AND {r}.pagamento='avista' AND {gerada(r)}",
+                                'despesas_fixas', comp, conta_desp, f"{r}.valor"),
+            _sql_trigger_resumo(f'trg_resumo_parcela_{sufixo}', evento, 'parcelas', '1',
+                                'despesas_parceladas', f"{r}.competencia",
+                                f"COALESCE((SELECT conta FROM cartoes WHERE id={r}.id_cartao), 0)",
+                                f"{r}.valor"),
+        ]
+    return sqls
+
+
+def reconstruir_resumo_mensal(c, gerada=_gerada, meses=None):
+    """
+    Recalcula resumo_mensal a partir de transacoes + parcelas: tudo, ou só
+    as competências em `meses` ('YYYY-MM').
+    """
+    filtro, params = '', []
+    if meses is not None:
+        meses = sorted(set(meses))
+        if not meses:
+            return
+        filtro, params = f"WHERE competencia IN ({','.join('?' * len(meses))})", meses
+    c.execute(f"DELETE FROM resumo_mensal {filtro}", params)
+    c.execute(f"""
+        INSERT INTO resumo_mensal
+            (competencia, id_conta, receitas, despesas_avista, despesas_parceladas, despesas_fixas)
+        SELECT competencia, id_conta, SUM(rec), SUM(av), SUM(parc), SUM(fixa) FROM (
+            SELECT strftime('%Y-%m', t.data_lancamento) AS competencia,
+                   CASE WHEN t.tipo='receita' THEN COALESCE(t.id_conta, 0)
+                        ELSE COALESCE(t.id_conta, ca.conta, 0) END AS id_conta,
+                   CASE WHEN t.tipo='receita' THEN t.valor ELSE 0 END AS rec,
+                   CASE WHEN t.tipo='despesa' AND t.pagamento='avista'
+                         AND NOT {gerada('t')}
+                        THEN t.valor ELSE 0 END AS av,
+                   0 AS parc,
+                   CASE WHEN t.tipo='despesa' AND t.pagamento='avista'
+                         AND {gerada('t')}
+                        THEN t.valor ELSE 0 END AS fixa
+            FROM transacoes t LEFT JOIN cartoes ca ON ca.id = t.id_cartao
+            WHERE t.tipo='receita' OR t.pagamento='avista'
+            UNION ALL
+            SELECT p.competencia, COALESCE(ca.conta, 0), 0, 0, p.valor, 0
+            FROM parcelas p LEFT JOIN cartoes ca ON ca.id = p.id_cartao
+        )
+        {filtro}
+        GROUP BY competencia, id_conta
+    """, params)
+
+
+def resumo_meses(c, mes_ini: str, mes_fim: str, id_conta: int = None) -> dict:
+    """{'YYYY-MM': {receitas, despesas_avista, despesas_parceladas, despesas_fixas}} do rollup."""
+    filtro = "AND id_conta = ?" if id_conta is not None else ""
+    c.execute(f"""
+        SELECT competencia, SUM(receitas), SUM(despesas_avista),
+               SUM(despesas_parceladas), SUM(despesas_fixas)
+        FROM resumo_mensal
+        WHERE competencia BETWEEN ? AND ? {filtro}
+        GROUP BY competencia
+    """, (mes_ini, mes_fim) + ((id_conta,) if id_conta is not None else ()))
+    return {r[0]: {'receitas': r[1], 'despesas_avista': r[2],
+                   'despesas_parceladas': r[3], 'despesas_fixas': r[4]}
+            for r in c.fetchall()}
+
+
+@app.cli.command('reconstruir-agregados')
+def cli_reconstruir_agregados():
+    """Recalcula resumo_mensal, rollup_cartao_mes e o índice de busca."""
     with get_db() as conn:
         c = conn.cursor()
-        c.execute("""
-            SELECT id, data_vencimento, dias_fechamento FROM cartoes
-            WHERE tipo_pagamento IN ('credito','multiplo')
-              AND data_vencimento IS NOT NULL AND dias_fechamento IS NOT NULL
-        """)
-        for cartao_id, dia_venc, dias_fech in c.fetchall():
-            inicio, fim, _ = periodo_fatura_atual(dia_venc, dias_fech)
-
-            # Despesas à vista no período
-            c.execute("""
-                SELECT COALESCE(SUM(valor), 0) FROM transacoes
-                WHERE tipo='despesa' AND tipo_compra='credito'
-                  AND pagamento='avista'
-                  AND id_cartao=? AND data_lancamento BETWEEN ? AND ?
-            """, (cartao_id, inicio.isoformat(), fim.isoformat()))
-            total += c.fetchone()[0]
-
-            # Despesas parceladas: conta apenas a parcela do período
-            c.execute("""
-                SELECT valor, parcelas, data_lancamento FROM transacoes
-                WHERE tipo='despesa' AND tipo_compra='credito'
-                  AND pagamento='parcelado' AND parcelas >= 2
-                  AND id_cartao=?
-            """, (cartao_id,))
-            for valor_total, parcelas, data_str in c.fetchall():
-                try:
-                    data_compra = date.fromisoformat(str(data_str)[:10])
-                except Exception:
-                    continue
-                total += valor_parcela_na_fatura(valor_total, parcelas, data_compra, inicio, fim)
+        reconstruir_resumo_mensal(c)
+        reconstruir_rollup_cartao(c)
+        reconstruir_busca(c)
+        avancar_geracao(c)
+        conn.commit()
+    print('Agregados reconstruídos.')
 
-    return round(total, 2)
 
+def total_fatura_atual(conn=None):
+    """
+    Soma o que está na fatura aberta de todos os cartões de crédito.
+    Para compras parceladas: conta apenas o valor da parcela do mês,
+    não o valor total da compra.
+    """
+    if conn is None:
+        with get_db() as conn:
+            return total_fatura_atual(conn)
+    faturas = faturas_abertas(conn.cursor())
+    return round(sum(f['total'] for f in faturas.values()), 2)
 
-def despesas_fixas_pendentes_mes():
+
+def despesas_fixas_pendentes_mes(conn=None, hoje: date = None):
     """
     Despesas fixas (assinaturas) que ainda não foram geradas este mês
     mas vão cair. Usadas no cálculo do Disponível.
     Retorna apenas as que são crédito (as de débito já descontam do saldo
     quando geradas, então já estão refletidas no saldo_total).
     """
-    hoje = date.today()
+    if conn is None:
+        with get_db() as conn:
+            return despesas_fixas_pendentes_mes(conn, hoje)
+
+    hoje = hoje or date.today()
     total = 0.0
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT id, valor, dia_mes, modo_dia, id_cartao FROM despesas_fixas WHERE ativa=1")
-        for df_id, valor, dia_mes, modo, id_cartao in c.fetchall():
-            data_oc = data_ocorrencia(hoje.year, hoje.month, dia_mes, modo or 'fixo')
-            if data_oc <= hoje: continue  # já gerada ou gerada hoje
-            chave = f'_df_{df_id}'
-            c.execute("SELECT COUNT(*) FROM transacoes WHERE tipo='despesa' AND categoria=? AND strftime('%Y-%m',data_lancamento)=?",
-                      (chave, hoje.strftime('%Y-%m')))
-            if c.fetchone()[0] > 0: continue
-            # Só considera se for crédito (débito vai abater do saldo quando gerado)
-            if id_cartao:
-                total += valor
+    c = conn.cursor()
+    # Anti-join: só as que ainda não têm ocorrência na competência atual.
+    # Só considera crédito (débito vai abater do saldo quando gerado).
+    c.execute("""
+        SELECT df.valor, df.dia_mes, df.modo_dia FROM despesas_fixas df
+        WHERE df.ativa=1 AND df.id_cartao IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM transacoes t
+                          WHERE t.id_despesa_fixa=df.id AND t.competencia=?)
+    """, (hoje.strftime('%Y-%m'),))
+    for valor, dia_mes, modo in c.fetchall():
+        if data_ocorrencia(hoje.year, hoje.month, dia_mes, modo or 'fixo') > hoje:
+            total += valor
     return round(total, 2)
 
 
-def receitas_fixas_pendentes_mes():
+def receitas_fixas_pendentes_mes(conn=None, hoje: date = None):
     """
     Receitas fixas que ainda não foram creditadas neste mês mas vão cair.
     """
-    hoje = date.today()
+    if conn is None:
+        with get_db() as conn:
+            return receitas_fixas_pendentes_mes(conn, hoje)
+
+    hoje = hoje or date.today()
     total = 0.0
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT id, valor, dia_mes, modo_dia, id_conta FROM receitas_fixas WHERE ativa=1")
-        for rf_id, valor, dia_mes, modo, id_conta in c.fetchall():
-            data_oc = data_ocorrencia(hoje.year, hoje.month, dia_mes, modo or 'fixo')
-            if data_oc <= hoje: continue
-            chave = f'_rf_{rf_id}'
-            c.execute("SELECT COUNT(*) FROM transacoes WHERE tipo='receita' AND id_conta=? AND categoria=? AND strftime('%Y-%m',data_lancamento)=?",
-                      (id_conta, chave, hoje.strftime('%Y-%m')))
-            if c.fetchone()[0] > 0: continue
+    c = conn.cursor()
+    c.execute("""
+        SELECT rf.valor, rf.dia_mes, rf.modo_dia FROM receitas_fixas rf
+        WHERE rf.ativa=1
+          AND NOT EXISTS (SELECT 1 FROM transacoes t
+                          WHERE t.id_receita_fixa=rf.id AND t.competencia=?)
+    """, (hoje.strftime('%Y-%m'),))
+    for valor, dia_mes, modo in c.fetchall():
+        if data_ocorrencia(hoje.year, hoje.month, dia_mes, modo or 'fixo') > hoje:
             total += valor
     return round(total, 2)
 
 
+# ── snapshot do dashboard ───────────────────────────────
+@dataclass
+class DashboardSnapshot:
+    """Números do topo do dashboard, todos lidos do mesmo instante do banco."""
+    referencia: date
+    saldo_total: float
+    receitas_mes: float
+    gasto_credito: float            # fatura aberta de todos os cartões
+    receitas_pendentes: float       # fixas que ainda vão cair este mês
+    despesas_pendentes: float       # fixas de crédito que ainda vão cair este mês
+    duracao_ms: float = 0.0
+
+    @property
+    def disponivel_mes(self) -> float:
+        # Disponível no Mês:
+        #   saldo real (já na conta)
+        # + receitas fixas ainda não geradas este mês
+        # - fatura de crédito aberta (à vista + parcela do mês)
+        # - despesas fixas de crédito ainda não geradas este mês
+        return round(self.saldo_total + self.receitas_pendentes
+                     - self.gasto_credito - self.despesas_pendentes, 2)
+
+
+def dashboard_snapshot(conn=None, hoje: date = None) -> DashboardSnapshot:
+    """
+    Calcula o DashboardSnapshot numa única transação de leitura: em WAL, todas
+    as consultas enxergam o mesmo estado, mesmo com a fila de escrita
+    gravando em paralelo.
+    """
+    if conn is None:
+        conn = get_db()
+    hoje = hoje or date.today()
+    inicio = time.perf_counter()
+    propria = not conn.in_transaction
+    if propria:
+        conn.execute("BEGIN")
+    try:
+        c = conn.cursor()
+        c.execute("SELECT COALESCE(SUM(saldo), 0) FROM contas")
+        saldo_total = round(c.fetchone()[0], 2)
+        c.execute("""
+            SELECT COALESCE(SUM(valor), 0) FROM transacoes
+            WHERE tipo='receita' AND data_lancamento >= ? AND data_lancamento < ?
+              AND id_receita_fixa IS NULL
+        """, limites_mes(hoje.strftime('%Y-%m')))
+        receitas_mes = round(c.fetchone()[0], 2)
+        snap = DashboardSnapshot(
+            referencia=hoje,
+            saldo_total=saldo_total,
+            receitas_mes=receitas_mes,
+            gasto_credito=total_fatura_atual(conn),
+            receitas_pendentes=receitas_fixas_pendentes_mes(conn, hoje),
+            despesas_pendentes=despesas_fixas_pendentes_mes(conn, hoje),
+        )
+    finally:
+        if propria:
+            conn.rollback()     # só leitura: encerra o snapshot
+    snap.duracao_ms = round((time.perf_counter() - inicio) * 1000, 2)
+    return snap
+
+
+def agregar_despesas(conn, mes_ini: str, mes_fim: str, cartao_id: int = None) -> dict:
+    """
+    Motor em lote dos agregados de despesa: meses × categorias e meses × cartões
+    para todo o intervalo ['YYYY-MM', 'YYYY-MM'] em UMA passada (um GROUP BY
+    sobre as à vista + um sobre o cronograma de parcelas).
+
+    Retorna {mes: {'total': float, 'categorias': {cat: v}, 'cartoes': {id: v}}}
+    com todos os meses do intervalo presentes (zerados se não houver gasto).
+    Com cartao_id, considera só as despesas daquele cartão.
+    """
+    c = conn.cursor()
+    matriz = {}
+    ref = date.fromisoformat(mes_ini + '-01')
+    while ref.strftime('%Y-%m') <= mes_fim:
+        matriz[ref.strftime('%Y-%m')] = {'total': 0.0, 'categorias': {}, 'cartoes': {}}
+        ref += relativedelta(months=1)
+
+    filtro_cartao = "AND id_cartao = ?" if cartao_id is not None else ""
+    extra = (cartao_id,) if cartao_id is not None else ()
+
+    # À vista: mês = data_lancamento
+    c.execute(f"""
+        SELECT strftime('%Y-%m', data_lancamento), COALESCE(categoria, 'Sem categoria'),
+               id_cartao, SUM(valor)
+        FROM transacoes
+        WHERE tipo = 'despesa' AND pagamento = 'avista'
+          AND data_lancamento >= ? AND data_lancamento < ?
+          AND id_despesa_fixa IS NULL AND id_receita_fixa IS NULL
+          {filtro_cartao}
+        GROUP BY 1, 2, 3
+    """, (limites_mes(mes_ini)[0], limites_mes(mes_fim)[1]) + extra)
+    linhas = c.fetchall()
+
+    # Parceladas: mês = competência da parcela
+    c.execute(f"""
+        SELECT competencia, COALESCE(categoria, 'Sem categoria'), id_cartao, SUM(valor)
+        FROM parcelas
+        WHERE competencia BETWEEN ? AND ? {filtro_cartao}
+        GROUP BY 1, 2, 3
+    """, (mes_ini, mes_fim) + extra)
+    linhas += c.fetchall()
+
+    for mes, cat, id_cartao, val in linhas:
+        celula = matriz.get(mes)
+        if celula is None:
+            continue
+        celula['total'] += val
+        celula['categorias'][cat] = celula['categorias'].get(cat, 0) + val
+        celula['cartoes'][id_cartao] = celula['cartoes'].get(id_cartao, 0) + val
+    return matriz
+
+
+def top_categorias(categorias: dict, limit: int) -> list:
+    """Lista [{'nome', 'total'}] ordenada do maior para o menor gasto."""
+    resultado = sorted(
+        [{'nome': k, 'total': round(v, 2)} for k, v in categorias.items()],
+        key=lambda x: x['total'], reverse=True
+    )
+    return resultado[:limit]
+
+
 def despesas_reais_mes(ano: int, mes: int, conn) -> float:
     """
     Calcula o total REAL de despesas de um mês específico, tratando
@@ -352,41 +1886,10 @@ def despesas_reais_mes(ano: int, mes: int, conn) -> float:
 
     Para despesas à vista: usa data_lancamento normalmente.
     Para despesas parceladas: parcela N cai em (data_lancamento + N meses).
+    Para vários meses, prefira uma única chamada a agregar_despesas.
     """
-    c = conn.cursor()
     mes_str = f"{ano:04d}-{mes:02d}"
-
-    # Despesas à vista do mês (data_lancamento no mês)
-    c.execute("""
-        SELECT COALESCE(SUM(valor), 0) FROM transacoes
-        WHERE tipo = 'despesa'
-          AND pagamento = 'avista'
-          AND strftime('%Y-%m', data_lancamento) = ?
-          AND (categoria IS NULL OR (categoria NOT LIKE '_rf_%' AND categoria NOT LIKE '_df_%'))
-    """, (mes_str,))
-    total = c.fetchone()[0]
-
-    # Parcelas que caem neste mês (independente de quando a compra foi feita)
-    c.execute("""
-        SELECT valor, parcelas, data_lancamento FROM transacoes
-        WHERE tipo = 'despesa'
-          AND pagamento = 'parcelado'
-          AND parcelas >= 2
-          AND (categoria IS NULL OR (categoria NOT LIKE '_rf_%' AND categoria NOT LIKE '_df_%'))
-    """)
-    for valor_total, parcelas, data_str in c.fetchall():
-        try:
-            data_compra = date.fromisoformat(str(data_str)[:10])
-        except Exception:
-            continue
-        vp = round(valor_total / parcelas, 2)
-        for p in range(parcelas):
-            mp = data_compra + relativedelta(months=p)
-            if mp.year == ano and mp.month == mes:
-                total += vp
-                break
-
-    return round(total, 2)
+    return round(agregar_despesas(conn, mes_str, mes_str)[mes_str]['total'], 2)
 
 
 def gastos_categoria_mes(ano: int, mes: int, conn, limit: int = 5) -> list:
@@ -394,46 +1897,8 @@ def gastos_categoria_mes(ano: int, mes: int, conn, limit: int = 5) -> list:
     Retorna os gastos por categoria de um mês, tratando parceladas corretamente.
     Para parceladas: conta apenas a parcela do mês em cada categoria.
     """
-    c = conn.cursor()
     mes_str = f"{ano:04d}-{mes:02d}"
-    acum = {}  # categoria -> total
-
-    # À vista
-    c.execute("""
-        SELECT COALESCE(categoria, 'Sem categoria'), COALESCE(SUM(valor), 0)
-        FROM transacoes
-        WHERE tipo = 'despesa' AND pagamento = 'avista'
-          AND strftime('%Y-%m', data_lancamento) = ?
-          AND (categoria IS NULL OR (categoria NOT LIKE '_rf_%' AND categoria NOT LIKE '_df_%'))
-        GROUP BY categoria
-    """, (mes_str,))
-    for cat, val in c.fetchall():
-        acum[cat] = acum.get(cat, 0) + val
-
-    # Parceladas — parcela do mês por categoria
-    c.execute("""
-        SELECT COALESCE(categoria, 'Sem categoria'), valor, parcelas, data_lancamento
-        FROM transacoes
-        WHERE tipo = 'despesa' AND pagamento = 'parcelado' AND parcelas >= 2
-          AND (categoria IS NULL OR (categoria NOT LIKE '_rf_%' AND categoria NOT LIKE '_df_%'))
-    """)
-    for cat, valor_total, parcelas, data_str in c.fetchall():
-        try:
-            data_compra = date.fromisoformat(str(data_str)[:10])
-        except Exception:
-            continue
-        vp = round(valor_total / parcelas, 2)
-        for p in range(parcelas):
-            mp = data_compra + relativedelta(months=p)
-            if mp.year == ano and mp.month == mes:
-                acum[cat] = acum.get(cat, 0) + vp
-                break
-
-    resultado = sorted(
-        [{'nome': k, 'total': round(v, 2)} for k, v in acum.items()],
-        key=lambda x: x['total'], reverse=True
-    )
-    return resultado[:limit]
+    return top_categorias(agregar_despesas(conn, mes_str, mes_str)[mes_str]['categorias'], limit)
 
 
 
@@ -460,64 +1925,15 @@ def dashboard_por_cartao(cartao_id: int) -> dict:
             return None
         nome_cartao, dia_venc, dias_fech, limite, tipo_pag = row
 
-        # Período da fatura atual deste cartão
+        # Fatura atual deste cartão (à vista + só a parcela do período)
         fatura_atual = 0.0
         inicio_f = fim_f = venc_f = None
         if dia_venc and dias_fech:
             inicio_f, fim_f, venc_f = periodo_fatura_atual(dia_venc, dias_fech)
+            fatura_atual = calcular_faturas(c, [(cartao_id, inicio_f, fim_f)])[0]['total']
 
-            # À vista na fatura atual
-            c.execute("""
-                SELECT COALESCE(SUM(valor), 0) FROM transacoes
-                WHERE tipo='despesa' AND tipo_compra='credito' AND pagamento='avista'
-                  AND id_cartao=? AND data_lancamento BETWEEN ? AND ?
-            """, (cartao_id, inicio_f.isoformat(), fim_f.isoformat()))
-            fatura_atual += c.fetchone()[0]
-
-            # Parceladas — só a parcela do período
-            c.execute("""
-                SELECT valor, parcelas, data_lancamento FROM transacoes
-                WHERE tipo='despesa' AND tipo_compra='credito' AND pagamento='parcelado'
-                  AND parcelas >= 2 AND id_cartao=?
-            """, (cartao_id,))
-            for vt, parc, ds in c.fetchall():
-                try:
-                    dc = date.fromisoformat(str(ds)[:10])
-                except Exception:
-                    continue
-                fatura_atual += valor_parcela_na_fatura(vt, parc, dc, inicio_f, fim_f)
-
-        fatura_atual = round(fatura_atual, 2)
-
-        # Gastos por categoria deste cartão no mês atual (parcelas corretas)
-        acum = {}
-        c.execute("""
-            SELECT COALESCE(categoria, 'Sem categoria'), valor, pagamento, parcelas, data_lancamento
-            FROM transacoes
-            WHERE tipo='despesa' AND id_cartao=?
-              AND (categoria IS NULL OR (categoria NOT LIKE '_rf_%' AND categoria NOT LIKE '_df_%'))
-        """, (cartao_id,))
-        for cat, vt, pag, parc, ds in c.fetchall():
-            try:
-                dc = date.fromisoformat(str(ds)[:10])
-            except Exception:
-                continue
-            if pag == 'avista':
-                if dc.year == hoje.year and dc.month == hoje.month:
-                    acum[cat] = acum.get(cat, 0) + vt
-            else:
-                n = parc or 1
-                vp = round(vt / n, 2)
-                for p in range(n):
-                    mp = dc + relativedelta(months=p)
-                    if mp.year == hoje.year and mp.month == hoje.month:
-                        acum[cat] = acum.get(cat, 0) + vp
-                        break
-
-        gastos_categoria = sorted(
-            [{'nome': k, 'total': round(v, 2)} for k, v in acum.items()],
-            key=lambda x: x['total'], reverse=True
-        )[:5]
+        # Gastos por categoria deste cartão no mês atual (rollup mensal)
+        gastos_categoria = rollup_cartao_categorias(c, cartao_id, mes_str, 5)
 
         # Últimas 10 transações deste cartão
         c.execute("""
@@ -540,35 +1956,15 @@ def dashboard_por_cartao(cartao_id: int) -> dict:
                 d['valor_total']   = d['valor']
             transacoes.append(d)
 
-        # Histórico 6 meses deste cartão (gastos por mês, parcelas corretas)
+        # Histórico 6 meses deste cartão (rollup mensal, parcelas corretas)
+        ini_hist = (hoje - relativedelta(months=5)).strftime('%Y-%m')
+        por_mes = rollup_cartao_historico(c, cartao_id, ini_hist, mes_str)
         historico = []
         meses_pt = {1:'Jan',2:'Fev',3:'Mar',4:'Abr',5:'Mai',6:'Jun',
                     7:'Jul',8:'Ago',9:'Set',10:'Out',11:'Nov',12:'Dez'}
         for delta in range(5, -1, -1):
             ref = hoje - relativedelta(months=delta)
-            # Busca todas as despesas do cartão para calcular o mês correto
-            c.execute("""
-                SELECT valor, pagamento, parcelas, data_lancamento FROM transacoes
-                WHERE tipo='despesa' AND id_cartao=?
-                  AND (categoria IS NULL OR (categoria NOT LIKE '_rf_%' AND categoria NOT LIKE '_df_%'))
-            """, (cartao_id,))
-            desp_mes = 0.0
-            for vt, pag, parc, ds in c.fetchall():
-                try:
-                    dc = date.fromisoformat(str(ds)[:10])
-                except Exception:
-                    continue
-                if pag == 'avista':
-                    if dc.year == ref.year and dc.month == ref.month:
-                        desp_mes += vt
-                else:
-                    n = parc or 1
-                    vp = round(vt / n, 2)
-                    for p in range(n):
-                        mp = dc + relativedelta(months=p)
-                        if mp.year == ref.year and mp.month == ref.month:
-                            desp_mes += vp
-                            break
+            desp_mes = por_mes.get(ref.strftime('%Y-%m'), 0.0)
             historico.append({
                 'label':    f"{meses_pt[ref.month]}/{ref.year}",
                 'despesas': round(desp_mes, 2),
@@ -587,52 +1983,408 @@ def dashboard_por_cartao(cartao_id: int) -> dict:
         'historico':        historico,
     }
 
-def projecao_mensal(n_meses: int = 3):
+MAX_MESES_PROJECAO = 120
+
+def projecao_mensal(n_meses: int = 3, conn=None, detalhar: bool = False):
     """
-    Projeção dos próximos n_meses.
+    Projeção dos próximos n_meses (máx. MAX_MESES_PROJECAO) numa única passada:
+    as fixas ativas são lidas uma vez e cada uma entra uma vez em todo mês
+    alvo (os totais de fixas são iguais em todos); as parcelas vêm de um
+    único GROUP BY sobre o cronograma, já separadas por competência.
     Parcelas: conta apenas o valor da parcela do mês, não o total.
+    Com detalhar=True, cada mês traz também as ocorrências fixas com a data
+    (dia_mes + modo_dia), só então calculada.
     """
+    if conn is None:
+        with get_db() as conn:
+            return projecao_mensal(n_meses, conn, detalhar)
+
+    n_meses = max(0, min(int(n_meses), MAX_MESES_PROJECAO))
     hoje = date.today()
     meses_pt = {1:'Jan',2:'Fev',3:'Mar',4:'Abr',5:'Mai',6:'Jun',
                 7:'Jul',8:'Ago',9:'Set',10:'Out',11:'Nov',12:'Dez'}
+    alvos = [hoje + relativedelta(months=delta) for delta in range(1, n_meses + 1)]
+    if not alvos:
+        return []
+    baldes = {a.strftime('%Y-%m'): {'receitas': 0.0, 'despesas_fixas': 0.0,
+                                    'despesas_parceladas': 0.0, 'ocorrencias': []}
+              for a in alvos}
+
+    c = conn.cursor()
+
+    # Fixas ativas: uma leitura só; toda fixa cai uma vez por mês
+    c.execute("SELECT 'receita', descricao, valor, dia_mes, modo_dia FROM receitas_fixas WHERE ativa=1")
+    fixas = c.fetchall()
+    c.execute("SELECT 'despesa', descricao, valor, dia_mes, modo_dia FROM despesas_fixas WHERE ativa=1")
+    fixas += c.fetchall()
+    receitas_fixas = sum(f[2] for f in fixas if f[0] == 'receita')
+    despesas_fixas = sum(f[2] for f in fixas if f[0] == 'despesa')
+    for alvo in alvos:
+        balde = baldes[alvo.strftime('%Y-%m')]
+        balde['receitas'] += receitas_fixas
+        balde['despesas_fixas'] += despesas_fixas
+        if detalhar:
+            for tipo, desc, valor, dia_mes, modo in fixas:
+                data_oc = data_ocorrencia(alvo.year, alvo.month, dia_mes, modo or 'fixo')
+                balde['ocorrencias'].append({'tipo': tipo, 'descricao': desc, 'valor': valor,
+                                             'data': data_oc.isoformat()})
+
+    # Parcelas: apenas a parcela que cai em cada mês alvo
+    c.execute("""
+        SELECT competencia, SUM(valor) FROM parcelas
+        WHERE competencia BETWEEN ? AND ?
+        GROUP BY competencia
+    """, (alvos[0].strftime('%Y-%m'), alvos[-1].strftime('%Y-%m')))
+    for comp, val in c.fetchall():
+        if comp in baldes:
+            baldes[comp]['despesas_parceladas'] += val
+
     resultado = []
-    with get_db() as conn:
-        c = conn.cursor()
-        for delta in range(1, n_meses + 1):
-            alvo = hoje + relativedelta(months=delta)
-            ano_alvo, mes_alvo = alvo.year, alvo.month
-
-            # Receitas fixas
-            c.execute("SELECT COALESCE(SUM(valor), 0) FROM receitas_fixas WHERE ativa=1")
-            rec_fixas = c.fetchone()[0]
-
-            # Despesas fixas (assinaturas)
-            c.execute("SELECT COALESCE(SUM(valor), 0) FROM despesas_fixas WHERE ativa=1")
-            desp_fixas = c.fetchone()[0]
-
-            # Parcelas: apenas a parcela que cai no mês alvo
-            c.execute("SELECT valor, parcelas, data_lancamento FROM transacoes WHERE tipo='despesa' AND pagamento='parcelado' AND parcelas>=2")
-            desp_parc = 0.0
-            for valor_total, parcelas, data_str in c.fetchall():
-                try: dc = date.fromisoformat(str(data_str)[:10])
-                except: continue
-                vp = round(valor_total / parcelas, 2)
-                for p in range(parcelas):
-                    mp = dc + relativedelta(months=p)
-                    if mp.year == ano_alvo and mp.month == mes_alvo:
-                        desp_parc += vp
-                        break
-
-            resultado.append({
-                'mes_ano':             f"{meses_pt[mes_alvo]}/{ano_alvo}",
-                'receitas':            round(rec_fixas, 2),
-                'despesas_fixas':      round(desp_fixas, 2),
-                'despesas_parceladas': round(desp_parc, 2),
-                'saldo':               round(rec_fixas - desp_fixas - desp_parc, 2),
-            })
+    for alvo in alvos:
+        b = baldes[alvo.strftime('%Y-%m')]
+        item = {
+            'mes_ano':             f"{meses_pt[alvo.month]}/{alvo.year}",
+            'receitas':            round(b['receitas'], 2),
+            'despesas_fixas':      round(b['despesas_fixas'], 2),
+            'despesas_parceladas': round(b['despesas_parceladas'], 2),
+            'saldo':               round(b['receitas'] - b['despesas_fixas'] - b['despesas_parceladas'], 2),
+        }
+        if detalhar:
+            item['competencia'] = alvo.strftime('%Y-%m')
+            item['ocorrencias'] = sorted(b['ocorrencias'], key=lambda o: o['data'])
+        resultado.append(item)
     return resultado
 
 
+# ================================================================
+# CACHE DE RESPOSTAS (ETag por geração)
+# ================================================================
+# Payloads do dashboard ficam em memória chaveados por (endpoint, parâmetros,
+# geração, data). O ETag sai da mesma chave, então um If-None-Match que
+# bate vira 304 sem nem olhar o cache: aba parada custa a leitura da geração
+# (uma linha de meta) e uma comparação. Só o corpo é guardado: cabeçalhos
+# da view (ex.: Server-Timing) saem apenas no miss, quando ela roda de fato.
+
+CACHE_MAX_ENTRADAS = 256
+
+_cache_respostas = {}
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0, 'nao_modificado': 0}
+
+def _contar_cache(chave: str):
+    with _cache_lock:
+        _cache_stats[chave] += 1
+
+def cache_stats() -> dict:
+    with _cache_lock:
+        return {**_cache_stats, 'entradas': len(_cache_respostas)}
+
+def cache_por_geracao(view):
+    """Decorator para rotas GET de JSON que só dependem do banco e da data."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        chave = (request.endpoint, tuple(sorted(kwargs.items())),
+                 tuple(sorted(request.args.items(multi=True))),
+                 geracao_atual(), date.today().isoformat())
+        etag = hashlib.sha1(repr(chave).encode()).hexdigest()[:20]
+        if request.if_none_match.contains_weak(etag):    # fraco: a versão comprimida tem W/
+            _contar_cache('nao_modificado')
+            resp = app.response_class(status=304)
+        else:
+            with _cache_lock:
+                corpo = _cache_respostas.get(chave)
+            if corpo is not None:
+                _contar_cache('hits')
+                resp = app.response_class(corpo, mimetype='application/json')
+            else:
+                _contar_cache('misses')
+                resp = make_response(view(*args, **kwargs))
+                if resp.status_code == 200:
+                    with _cache_lock:
+                        if len(_cache_respostas) >= CACHE_MAX_ENTRADAS:
+                            # Entradas de gerações/dias passados nunca mais batem
+                            _cache_respostas.clear()
+                        _cache_respostas[chave] = resp.get_data()
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'no-cache'     # sempre revalida via ETag
+        return resp
+    return wrapper
+
+
+# ================================================================
+# ENTREGA HTTP (compressão, estáticos versionados, páginas prontas)
+# ================================================================
+# HTML/JSON/JS saem comprimidos conforme o Accept-Encoding (br se o módulo
+# brotli estiver instalado, senão gzip). url_for('static') ganha ?v=<hash
+# do conteúdo>, então o arquivo pode ser cacheado como imutável: mudou o
+# conteúdo, mudou a URL. Páginas que não dependem do banco são renderizadas
+# e comprimidas uma vez por processo (@pagina_pronta).
+
+COMPRIMIR_TIPOS = {'text/html', 'application/json', 'text/css', 'text/javascript',
+                   'application/javascript', 'image/x-icon', 'image/vnd.microsoft.icon',
+                   'image/svg+xml'}
+COMPRIMIR_MIN_BYTES = 500
+CACHE_IMUTAVEL = 'public, max-age=31536000, immutable'
+MAX_ESTATICOS_COMPRIMIDOS = 256
+
+_paginas_prontas = {}       # endpoint → {'etag', None: corpo, 'gzip': ..., 'br': ...}
+_estaticos_comprimidos = {} # (arquivo, versão, codificação) → corpo; sai o mais antigo
+_entrega_lock = threading.Lock()
+
+
+def codificacao_preferida():
+    """'br', 'gzip' ou None, pelo Accept-Encoding da requisição."""
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+
+def comprimir(corpo: bytes, codificacao: str, maximo: bool = False) -> bytes:
+    """Níveis médios para respostas dinâmicas; maximo=True para o que é comprimido uma vez."""
+    if codificacao == 'br':
+        return brotli.compress(corpo, quality=11 if maximo else 5)
+    return gzip.compress(corpo, compresslevel=9 if maximo else 6, mtime=0)
+
+
+@lru_cache(maxsize=256)
+def _versao_estatico(caminho: str, mtime: float) -> str:
+    with open(caminho, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def versao_estatico(filename: str):
+    """Hash do conteúdo atual de static/<filename>, ou None se não existir."""
+    caminho = safe_join(app.static_folder, filename)
+    try:
+        return _versao_estatico(caminho, os.path.getmtime(caminho)) if caminho else None
+    except OSError:
+        return None
+
+
+@app.url_defaults
+def _versionar_estaticos(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        versao = versao_estatico(values['filename'])
+        if versao:
+            values['v'] = versao
+
+
+def pagina_pronta(view):
+    """
+    Para páginas que não leem o banco: corpo renderizado e comprimido uma
+    única vez, servido com ETag (304 quando bate). Em debug não guarda nada,
+    já que os templates recarregam.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if app.debug:
+            return view(*args, **kwargs)
+        with _entrega_lock:
+            pronta = _paginas_prontas.get(request.endpoint)
+        if pronta is None:
+            corpo = make_response(view(*args, **kwargs)).get_data()
+            pronta = {'etag': hashlib.sha1(corpo).hexdigest()[:20], None: corpo,
+                      'gzip': comprimir(corpo, 'gzip', maximo=True)}
+            if brotli:
+                pronta['br'] = comprimir(corpo, 'br', maximo=True)
+            with _entrega_lock:
+                _paginas_prontas[request.endpoint] = pronta
+        if request.if_none_match.contains_weak(pronta['etag']):
+            resp = app.response_class(status=304)
+        else:
+            cod = codificacao_preferida()
+            resp = app.response_class(pronta[cod], mimetype='text/html')
+            if cod:
+                resp.headers['Content-Encoding'] = cod
+        resp.set_etag(pronta['etag'], weak=True)
+        resp.vary.add('Accept-Encoding')
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+    return wrapper
+
+
+@app.after_request
+def entregar(resp):
+    estatico = request.endpoint == 'static'
+    versao = None
+    if estatico:
+        # Só o ?v= do conteúdo atual é imutável; outro valor qualquer
+        # (versão velha, inventada) revalida sempre
+        v = request.args.get('v')
+        versao = v if v and v == versao_estatico(request.view_args.get('filename', '')) else None
+        if resp.status_code in (200, 304):
+            resp.headers['Cache-Control'] = CACHE_IMUTAVEL if versao else 'no-cache'
+    if (resp.status_code != 200 or (resp.is_streamed and not estatico)
+            or 'Content-Encoding' in resp.headers or resp.mimetype not in COMPRIMIR_TIPOS):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    cod = codificacao_preferida()
+    if not cod:
+        return resp
+    if estatico:
+        # Estáticos versionados: comprime uma vez por (arquivo, versão)
+        resp.direct_passthrough = False
+        chave = (request.view_args.get('filename'), versao, cod)
+        corpo = None
+        if versao:
+            with _entrega_lock:
+                corpo = _estaticos_comprimidos.get(chave)
+        if corpo is None:
+            corpo = comprimir(resp.get_data(), cod, maximo=bool(versao))
+            if versao:
+                with _entrega_lock:
+                    if len(_estaticos_comprimidos) >= MAX_ESTATICOS_COMPRIMIDOS:
+                        del _estaticos_comprimidos[next(iter(_estaticos_comprimidos))]
+                    _estaticos_comprimidos[chave] = corpo
+        elif hasattr(resp.response, 'close'):
+            resp.call_on_close(resp.response.close)     # arquivo aberto pelo send_file
+    else:
+        if resp.content_length is not None and resp.content_length < COMPRIMIR_MIN_BYTES:
+            return resp
+        corpo = comprimir(resp.get_data(), cod)
+    etag, fraco = resp.get_etag()
+    resp.set_data(corpo)
+    resp.headers['Content-Encoding'] = cod
+    if etag:
+        resp.set_etag(etag, weak=True)      # mesmo conteúdo, outros bytes
+    return resp
+
+
+def entrega_stats() -> dict:
+    with _entrega_lock:
+        return {'brotli': brotli is not None, 'paginas_prontas': sorted(_paginas_prontas),
+                'estaticos_comprimidos': len(_estaticos_comprimidos)}
+
+
+# ================================================================
+# STREAM DE ATUALIZAÇÕES (SSE)
+# ================================================================
+# Cada lote gravado pela fila de escrita acorda o transmissor. A thread do
+# transmissor lê em lotes_gravados os lotes que ainda não viu (e os cartões
+# tocados), calcula o delta UMA vez (só se houver alguém inscrito) e entrega
+# na fila de cada aba aberta. Abas paradas só recebem um comentário de
+# keep-alive: o banco não acorda.
+#
+# Com vários workers (serve --workers N) o lote pode ter sido gravado por
+# outro processo: aí a thread também olha lotes_gravados a cada SSE_POLL
+# segundos enquanto houver inscritos. Cada stream aberto prende uma thread
+# do servidor; o serve reserva --streams threads para eles por worker e
+# recusa (503) o que passar disso — a página cai no polling de 30 s.
+
+SSE_KEEPALIVE = 15          # segundos entre pings numa conexão ociosa
+SSE_FILA_MAX  = 16          # eventos pendentes por inscrito antes de descartar
+SSE_POLL      = 2           # com vários workers: intervalo de consulta a lotes_gravados
+
+class TransmissorEventos:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inscritos = set()
+        self._avisos = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self.stats = {'eventos': 0, 'descartados': 0, 'recusados': 0}
+        self._vista = 0             # último lote de lotes_gravados já transmitido
+        self.compartilhado = False  # vários processos gravando: consulta lotes_gravados por tempo
+        self.max_inscritos = None   # teto de streams neste processo (None = sem teto)
+
+    def inscrever(self):
+        """Fila do novo inscrito, ou None se o processo já está no teto de streams."""
+        fila = queue.Queue(maxsize=SSE_FILA_MAX)
+        # Sem inscritos a thread não lê o banco; o primeiro a chegar parte do
+        # lote mais recente, não de tudo o que foi gravado enquanto ninguém via
+        ultimo = None
+        if not self.inscritos():
+            ultimo = get_db().execute("SELECT COALESCE(MAX(geracao), 0) FROM lotes_gravados").fetchone()[0]
+        with self._lock:
+            if self.max_inscritos is not None and len(self._inscritos) >= self.max_inscritos:
+                self.stats['recusados'] += 1
+                return None
+            if not self._inscritos and ultimo is not None:
+                self._vista = max(self._vista, ultimo)
+            self._inscritos.add(fila)
+        self._garantir_thread()
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._inscritos.discard(fila)
+
+    def inscritos(self) -> int:
+        with self._lock:
+            return len(self._inscritos)
+
+    def avisar(self, cartoes):
+        """Ouvinte da fila de escrita: só acorda a thread (os cartões ela lê de lotes_gravados)."""
+        if self.inscritos():
+            self._avisos.put(cartoes)
+
+    def _garantir_thread(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name='transmissor-sse', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self._avisos.get(timeout=SSE_POLL if self.compartilhado else None)
+            except queue.Empty:
+                pass
+            while True:
+                try:
+                    self._avisos.get_nowait()
+                except queue.Empty:
+                    break
+            if not self.inscritos():
+                fechar_db_thread()
+                continue
+            try:
+                with self._lock:
+                    vista = self._vista
+                lotes = get_db().execute(
+                    "SELECT geracao, cartoes FROM lotes_gravados WHERE geracao > ? ORDER BY geracao",
+                    (vista,)).fetchall()
+                if not lotes:
+                    continue
+                with self._lock:
+                    self._vista = max(self._vista, lotes[-1][0])
+                cartoes = set().union(*(json.loads(l[1]) for l in lotes))
+                snap = dashboard_snapshot()
+                evento = {
+                    'saldo_total':    snap.saldo_total,
+                    'receitas_mes':   snap.receitas_mes,
+                    'gasto_credito':  snap.gasto_credito,
+                    'disponivel_mes': snap.disponivel_mes,
+                    'cartoes':        sorted(cartoes),
+                }
+            except Exception:
+                app.logger.exception('Falha ao calcular delta do stream')
+                fechar_db_thread()
+                continue
+            self._publicar(evento)
+
+    def _publicar(self, evento):
+        with self._lock:
+            inscritos = list(self._inscritos)
+            self.stats['eventos'] += 1
+        for fila in inscritos:
+            try:
+                fila.put_nowait(evento)
+            except queue.Full:
+                # Cliente lento: o evento mais antigo perde a vez (o próximo
+                # delta já traz o estado completo dos totais)
+                with self._lock:
+                    self.stats['descartados'] += 1
+                try:
+                    fila.get_nowait()
+                    fila.put_nowait(evento)
+                except (queue.Empty, queue.Full):
+                    pass
+
+
+transmissor = TransmissorEventos()
+escritor.ouvintes.append(transmissor.avisar)
+
+
 # ================================================================
 # ROTA PRINCIPAL /
 # ================================================================
@@ -652,29 +2404,10 @@ def index():
         """)
         transacoes = [dict(r) for r in c.fetchall()]
 
-        c.execute("SELECT COALESCE(SUM(saldo), 0) FROM contas")
-        saldo_total = round(c.fetchone()[0], 2)
-
         hoje = date.today()
-        c.execute("""
-            SELECT COALESCE(SUM(valor), 0) FROM transacoes
-            WHERE tipo='receita' AND strftime('%Y-%m', data_lancamento)=?
-              AND (categoria IS NULL OR categoria NOT LIKE '_rf_%')
-        """, (hoje.strftime('%Y-%m'),))
-        receitas_mes = round(c.fetchone()[0], 2)
-
         gastos_por_categoria = gastos_categoria_mes(hoje.year, hoje.month, conn, limit=5)
 
-    fatura_atual   = total_fatura_atual()
-    rec_pendentes  = receitas_fixas_pendentes_mes()
-    desp_pendentes = despesas_fixas_pendentes_mes()
-
-    # Disponível no Mês:
-    #   saldo real (já na conta)
-    # + receitas fixas ainda não geradas este mês
-    # - fatura de crédito aberta (à vista + parcela do mês)
-    # - despesas fixas de crédito ainda não geradas este mês
-    disponivel_mes = round(saldo_total + rec_pendentes - fatura_atual - desp_pendentes, 2)
+    snap = dashboard_snapshot()
 
     # Cartões de crédito para as abas
     with get_db() as conn:
@@ -686,44 +2419,105 @@ def index():
         """)
         cartoes_credito = [{'id': r[0], 'nome': r[1]} for r in c.fetchall()]
 
-    return render_template('index.html',
+    html = render_template('index.html',
         transacoes=transacoes,
-        saldo_total=saldo_total,
-        receitas_mes=receitas_mes,
-        gasto_credito=fatura_atual,
-        disponivel_mes=disponivel_mes,
+        saldo_total=snap.saldo_total,
+        receitas_mes=snap.receitas_mes,
+        gasto_credito=snap.gasto_credito,
+        disponivel_mes=snap.disponivel_mes,
         proximas_faturas=projecao_mensal(3),
         gastos_por_categoria=gastos_por_categoria,
         cartoes_credito=cartoes_credito,
     )
+    return html, {'Server-Timing': f'dashboard;dur={snap.duracao_ms}'}
 
 
 @app.route('/api/dashboard_data')
+@cache_por_geracao
 def dashboard_data():
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT COALESCE(SUM(saldo), 0) FROM contas")
-        saldo_total = round(c.fetchone()[0], 2)
-        hoje = date.today()
-        c.execute("""
-            SELECT COALESCE(SUM(valor), 0) FROM transacoes
-            WHERE tipo='receita' AND strftime('%Y-%m', data_lancamento)=?
-              AND (categoria IS NULL OR categoria NOT LIKE '_rf_%')
-        """, (hoje.strftime('%Y-%m'),))
-        receitas_mes = round(c.fetchone()[0], 2)
-
-    fatura_atual   = total_fatura_atual()
-    rec_pendentes  = receitas_fixas_pendentes_mes()
-    desp_pendentes = despesas_fixas_pendentes_mes()
+    snap = dashboard_snapshot()
     return jsonify({
-        'saldo_total':    saldo_total,
-        'receitas_mes':   receitas_mes,
-        'gasto_credito':  fatura_atual,
-        'disponivel_mes': round(saldo_total + rec_pendentes - fatura_atual - desp_pendentes, 2),
-    })
+        'saldo_total':    snap.saldo_total,
+        'receitas_mes':   snap.receitas_mes,
+        'gasto_credito':  snap.gasto_credito,
+        'disponivel_mes': snap.disponivel_mes,
+    }), {'Server-Timing': f'dashboard;dur={snap.duracao_ms}'}
+
+
+@app.route('/api/stream')
+def api_stream():
+    """
+    Server-Sent Events: um evento 'dados' por lote gravado, com os totais do
+    dashboard e os ids dos cartões afetados. 503 quando este processo já
+    está no teto de streams (transmissor.max_inscritos).
+    """
+    fila = transmissor.inscrever()
+    if fila is None:
+        return jsonify({'success': False, 'error': 'Limite de streams atingido'}), 503, {'Retry-After': '30'}
+    def eventos():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    evento = fila.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield f'event: dados\ndata: {json.dumps(evento)}\n\n'
+        finally:
+            transmissor.cancelar(fila)
+    return app.response_class(eventos(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/projecao')
+def api_projecao():
+    """Projeção de receitas fixas, despesas fixas e parcelas para até 120 meses."""
+    meses = request.args.get('meses', 12, type=int)
+    if meses is None or meses < 1 or meses > MAX_MESES_PROJECAO:
+        return jsonify({'success': False, 'error': f'meses deve estar entre 1 e {MAX_MESES_PROJECAO}'}), 400
+    detalhar = request.args.get('detalhar') in ('1', 'true')
+    return jsonify({'success': True, 'meses': meses,
+                    'projecao': projecao_mensal(meses, detalhar=detalhar)})
+
+
+@app.route('/api/resumo_mensal')
+def api_resumo_mensal():
+    """Receitas/despesas por mês (opcionalmente de uma conta), lidas do resumo_mensal."""
+    hoje = date.today()
+    de  = request.args.get('de')  or (hoje - relativedelta(months=11)).strftime('%Y-%m')
+    ate = request.args.get('ate') or hoje.strftime('%Y-%m')
+    id_conta = request.args.get('conta', type=int)
+    with get_db() as conn:
+        resumo = resumo_meses(conn.cursor(), de, ate, id_conta)
+    meses = []
+    for comp in sorted(resumo):
+        m = resumo[comp]
+        desp = m['despesas_avista'] + m['despesas_parceladas']
+        meses.append({'competencia': comp,
+                      'receitas': round(m['receitas'], 2),
+                      'despesas_avista': round(m['despesas_avista'], 2),
+                      'despesas_parceladas': round(m['despesas_parceladas'], 2),
+                      'despesas_fixas': round(m['despesas_fixas'], 2),
+                      'saldo': round(m['receitas'] - desp, 2)})
+    return jsonify({'success': True, 'meses': meses})
+
+
+@app.route('/api/diagnostico')
+def api_diagnostico():
+    """Contadores internos (conexões, fila de escrita, agendador, cache, stream SSE, entrega)."""
+    with escritor._lock:
+        escrita = dict(escritor.stats)
+    with agendador._cond:
+        fixas = dict(agendador.stats)
+    with transmissor._lock:
+        stream = {**transmissor.stats, 'inscritos': len(transmissor._inscritos)}
+    return jsonify({'db': db_stats(), 'escrita': escrita, 'agendador': fixas,
+                    'cache': cache_stats(), 'stream': stream, 'entrega': entrega_stats()})
 
 
 @app.route('/api/dashboard_cartao/<int:cartao_id>')
+@cache_por_geracao
 def api_dashboard_cartao(cartao_id):
     """Retorna todos os dados do dashboard filtrados por um cartão."""
     dados = dashboard_por_cartao(cartao_id)
@@ -737,42 +2531,21 @@ def api_dashboard_cartao(cartao_id):
 # ================================================================
 
 @app.route('/lancamentos')
+@pagina_pronta
 def lancamentos():
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT t.id, t.descricao, t.tipo, t.valor, t.categoria,
-                   ca.nome AS cartao_nome, t.data_lancamento,
-                   t.pagamento, t.parcelas, t.tipo_compra, t.tipo_cobranca
-            FROM transacoes t LEFT JOIN cartoes ca ON t.id_cartao=ca.id
-            WHERE t.tipo='despesa'
-              AND (t.categoria IS NULL OR t.categoria NOT LIKE '_df_%')
-            ORDER BY t.data_lancamento DESC, t.id DESC
-        """)
-        lancamentos_db = [list(r) for r in c.fetchall()]
-    return render_template('lancamentos.html', lancamentos=lancamentos_db)
+    # A tabela busca as linhas em /api/lancamentos, por janelas
+    return render_template('lancamentos.html')
 
 
 @app.route('/lancamentosReceita')
+@pagina_pronta
 def lancamentosReceita():
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT t.id, t.descricao, t.tipo, t.valor,
-                   COALESCE(t.categoria,'') AS categoria,
-                   COALESCE(co.nome,'N/A') AS conta_nome,
-                   COALESCE(t.tipo_receita,'avulsa'),
-                   t.dia_vencimento
-            FROM transacoes t LEFT JOIN contas co ON t.id_conta=co.id
-            WHERE t.tipo='receita'
-              AND (t.categoria IS NULL OR t.categoria NOT LIKE '_rf_%')
-            ORDER BY t.data_lancamento DESC, t.id DESC
-        """)
-        receitas = [list(r) for r in c.fetchall()]
-    return render_template('lancamentosReceita.html', receitas=receitas)
+    # A tabela de avulsas busca as linhas em /api/receitas, por janelas
+    return render_template('lancamentosReceita.html')
 
 
 @app.route('/lancamentosAssinaturas')
+@pagina_pronta
 def lancamentosAssinaturas():
     return render_template('lancamentosAssinaturas.html')
 
@@ -812,7 +2585,8 @@ def lancamentosCategorias():
 
 @app.route('/projecoes')
 def projecoes():
-    return render_template('projecoes.html', projecoes=projecao_mensal(6))
+    meses = request.args.get('meses', 6, type=int)
+    return render_template('projecoes.html', projecoes=projecao_mensal(meses))
 
 
 @app.route('/visaoGeral')
@@ -823,18 +2597,18 @@ def visaoGeral():
         meses_pt = {1:'Jan',2:'Fev',3:'Mar',4:'Abr',5:'Mai',6:'Jun',
                     7:'Jul',8:'Ago',9:'Set',10:'Out',11:'Nov',12:'Dez'}
 
+        # Receitas/despesas dos 6 meses direto do resumo_mensal
+        resumo = resumo_meses(c, (hoje - relativedelta(months=5)).strftime('%Y-%m'),
+                              hoje.strftime('%Y-%m'))
+        vazio = {'receitas': 0, 'despesas_avista': 0, 'despesas_parceladas': 0}
+
         historico = []
         for delta in range(5, -1, -1):
             ref = hoje - relativedelta(months=delta)
-            # Receitas: SUM simples (receitas avulsas e fixas geradas)
-            ms = ref.strftime('%Y-%m')
-            c.execute("""
-                SELECT COALESCE(SUM(valor),0) FROM transacoes
-                WHERE tipo='receita' AND strftime('%Y-%m',data_lancamento)=?
-            """, (ms,))
-            rec = round(c.fetchone()[0], 2)
-            # Despesas: usa despesas_reais_mes para tratar parcelas corretamente
-            desp = despesas_reais_mes(ref.year, ref.month, conn)
+            m = resumo.get(ref.strftime('%Y-%m'), vazio)
+            # Receitas: avulsas e fixas geradas; despesas: à vista + parcela do mês
+            rec  = round(m['receitas'], 2)
+            desp = round(m['despesas_avista'] + m['despesas_parceladas'], 2)
             historico.append({
                 'label': f"{meses_pt[ref.month]}/{ref.year}",
                 'receitas': rec, 'despesas': desp, 'saldo': round(rec - desp, 2)
@@ -850,30 +2624,15 @@ def visaoGeral():
             FROM cartoes ca WHERE ca.tipo_pagamento IN ('credito','multiplo')
               AND ca.data_vencimento IS NOT NULL AND ca.dias_fechamento IS NOT NULL
         """)
+        cartoes = c.fetchall()
+        abertas = faturas_abertas(c)
         faturas_cartoes = []
-        for cartao_id, nome_cartao, dia_venc, dias_fech, limite in c.fetchall():
-            inicio, fim, vencimento = periodo_fatura_atual(dia_venc, dias_fech)
-            # À vista
-            c.execute("""
-                SELECT COALESCE(SUM(valor),0) FROM transacoes
-                WHERE tipo='despesa' AND tipo_compra='credito' AND pagamento='avista'
-                  AND id_cartao=? AND data_lancamento BETWEEN ? AND ?
-            """, (cartao_id, inicio.isoformat(), fim.isoformat()))
-            gasto = c.fetchone()[0]
-            # Parcelado (apenas parcela do período)
-            c.execute("""
-                SELECT valor, parcelas, data_lancamento FROM transacoes
-                WHERE tipo='despesa' AND tipo_compra='credito' AND pagamento='parcelado'
-                  AND parcelas>=2 AND id_cartao=?
-            """, (cartao_id,))
-            for vt, parc, ds in c.fetchall():
-                try: dc = date.fromisoformat(str(ds)[:10])
-                except: continue
-                gasto += valor_parcela_na_fatura(vt, parc, dc, inicio, fim)
+        for cartao_id, nome_cartao, dia_venc, dias_fech, limite in cartoes:
+            f = abertas[cartao_id]
             faturas_cartoes.append({
-                'nome': nome_cartao, 'gasto': round(gasto,2), 'limite': limite,
-                'vencimento': vencimento.strftime('%d/%m/%Y'),
-                'inicio': inicio.strftime('%d/%m/%Y'), 'fim': fim.strftime('%d/%m/%Y'),
+                'nome': nome_cartao, 'gasto': f['total'], 'limite': limite,
+                'vencimento': f['vencimento'].strftime('%d/%m/%Y'),
+                'inicio': f['inicio'].strftime('%d/%m/%Y'), 'fim': f['fim'].strftime('%d/%m/%Y'),
             })
 
     return render_template('visaoGeral.html',
@@ -898,27 +2657,25 @@ def adicionar_conta():
     data = request.get_json()
     nome = (data.get('nome') or '').strip()
     if not nome: return jsonify({'success': False, 'error': 'Nome obrigatório'})
-    with get_db() as conn:
-        c = conn.cursor()
-        try:
-            c.execute("INSERT INTO contas (nome, saldo) VALUES (?, 0)", (nome,))
-            conn.commit()
-            return jsonify({'success': True, 'id': c.lastrowid, 'nome': nome})
-        except sqlite3.IntegrityError:
-            return jsonify({'success': False, 'error': 'Conta já existe'})
+    def op(c):
+        c.execute("INSERT INTO contas (nome, saldo) VALUES (?, 0)", (nome,))
+        return c.lastrowid
+    try:
+        return jsonify({'success': True, 'id': escrever(op), 'nome': nome})
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'error': 'Conta já existe'})
 
 @app.route('/api/remover_conta', methods=['POST'])
 def remover_conta():
     data = request.get_json()
     conta_id = data.get('id')
     if not conta_id: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
+    def op(c):
         c.execute("SELECT COUNT(*) FROM cartoes WHERE conta=?", (conta_id,))
-        if c.fetchone()[0] > 0: return jsonify({'success': False, 'error': 'Conta possui cartões vinculados'})
+        if c.fetchone()[0] > 0: return {'success': False, 'error': 'Conta possui cartões vinculados'}
         c.execute("DELETE FROM contas WHERE id=?", (conta_id,))
-        conn.commit()
-    return jsonify({'success': True})
+        return {'success': True}
+    return jsonify(escrever(op))
 
 
 # ================================================================
@@ -944,25 +2701,32 @@ def adicionar_cartao():
     limite = float(data.get('limite') or 0)
     if not nome or not conta or not tipo_pagamento:
         return jsonify({'success': False, 'error': 'Nome, conta e tipo são obrigatórios'})
-    with get_db() as conn:
-        c = conn.cursor()
-        try:
-            c.execute("INSERT INTO cartoes (nome, conta, tipo_pagamento, data_vencimento, dias_fechamento, limite) VALUES (?,?,?,?,?,?)",
-                      (nome, conta, tipo_pagamento, data_vencimento, dias_fechamento, limite))
-            conn.commit()
-            return jsonify({'success': True, 'id': c.lastrowid, 'nome': nome})
-        except sqlite3.IntegrityError:
-            return jsonify({'success': False, 'error': 'Cartão já existe'})
+    def op(c):
+        c.execute("INSERT INTO cartoes (nome, conta, tipo_pagamento, data_vencimento, dias_fechamento, limite) VALUES (?,?,?,?,?,?)",
+                  (nome, conta, tipo_pagamento, data_vencimento, dias_fechamento, limite))
+        return c.lastrowid
+    try:
+        novo_id = escrever(op)
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'error': 'Cartão já existe'})
+    agendador.recarregar()
+    return jsonify({'success': True, 'id': novo_id, 'nome': nome})
 
 @app.route('/api/remover_cartao', methods=['POST'])
 def remover_cartao():
     data = request.get_json()
     cartao_id = data.get('id')
     if not cartao_id: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
+    def op(c):
+        # Os lançamentos do cartão ficam, mas o resumo_mensal os atribuía à
+        # conta dele: os meses tocados são refeitos sem o cartão
+        c.execute("""SELECT strftime('%Y-%m', data_lancamento) FROM transacoes WHERE id_cartao=?
+                     UNION SELECT competencia FROM parcelas WHERE id_cartao=?""", (cartao_id, cartao_id))
+        meses = [r[0] for r in c.fetchall()]
         c.execute("DELETE FROM cartoes WHERE id=?", (cartao_id,))
-        conn.commit()
+        reconstruir_resumo_mensal(c, meses=meses)
+    escrever(op)
+    agendador.recarregar()
     return jsonify({'success': True})
 
 
@@ -988,24 +2752,20 @@ def adicionar_categoria():
     nome = (data.get('nome') or '').strip()
     tipo = data.get('tipo', 'despesa')
     if not nome: return jsonify({'success': False, 'error': 'Nome obrigatório'})
-    with get_db() as conn:
-        c = conn.cursor()
-        try:
-            c.execute("INSERT INTO categorias (nome, tipo) VALUES (?,?)", (nome, tipo))
-            conn.commit()
-            return jsonify({'success': True, 'id': c.lastrowid})
-        except sqlite3.IntegrityError:
-            return jsonify({'success': False, 'error': 'Categoria já existe'})
+    def op(c):
+        c.execute("INSERT INTO categorias (nome, tipo) VALUES (?,?)", (nome, tipo))
+        return c.lastrowid
+    try:
+        return jsonify({'success': True, 'id': escrever(op)})
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'error': 'Categoria já existe'})
 
 @app.route('/api/remover_categoria', methods=['POST'])
 def remover_categoria():
     data = request.get_json()
     cat_id = data.get('id')
     if not cat_id: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM categorias WHERE id=?", (cat_id,))
-        conn.commit()
+    escrever(lambda c: c.execute("DELETE FROM categorias WHERE id=?", (cat_id,)))
     return jsonify({'success': True})
 
 
@@ -1013,81 +2773,201 @@ def remover_categoria():
 # APIs — LANÇAMENTOS (avulsos)
 # ================================================================
 
-@app.route('/api/adicionar_lancamento', methods=['POST'])
-def adicionar_lancamento():
-    data = request.get_json()
-    if not data: return jsonify({'success': False, 'error': 'Nenhum dado recebido'})
+MAX_LOTE_LANCAMENTOS = 5000
+LINHAS_POR_INSERT = 500        # 13 colunas × 500 linhas fica bem abaixo do limite de variáveis
+
+COLUNAS_LANCAMENTO = ('tipo', 'descricao', 'valor', 'categoria', 'id_cartao', 'id_conta',
+                      'tipo_receita', 'tipo_cobranca', 'dia_vencimento', 'tipo_compra',
+                      'pagamento', 'parcelas', 'data_lancamento')
+
+
+def normalizar_lancamento(data) -> dict:
+    """
+    Valida e normaliza o corpo de um lançamento avulso, sem tocar no banco.
+    Levanta ValueError com a mensagem para o cliente.
+    """
+    if not data or not isinstance(data, dict): raise ValueError('Nenhum dado recebido')
 
     descricao     = (data.get('descricao') or '').strip()
     tipo          = data.get('tipo')
     valor_str     = data.get('valor')
-    categoria     = data.get('categoria')
-    id_cartao_str = data.get('id_cartao')
-    id_conta_str  = data.get('id_conta')
     tipo_receita  = data.get('tipo_receita',  'avulsa')
     tipo_cobranca = data.get('tipo_cobranca', 'avulsa')
-    dia_venc_str  = data.get('dia_vencimento')
     tipo_compra   = data.get('tipo_compra', 'credito')
     pagamento     = data.get('pagamento',   'avista')
-    parcelas_str  = data.get('parcelas')
     data_str      = data.get('data')
 
-    if not descricao: return jsonify({'success': False, 'error': 'Descrição obrigatória'})
-    if tipo not in ('despesa', 'receita'): return jsonify({'success': False, 'error': 'Tipo inválido'})
+    if not descricao: raise ValueError('Descrição obrigatória')
+    if tipo not in ('despesa', 'receita'): raise ValueError('Tipo inválido')
     try:
         valor = float(valor_str)
         if valor <= 0: raise ValueError
-    except: return jsonify({'success': False, 'error': 'Valor inválido'})
+    except: raise ValueError('Valor inválido')
 
     def to_int(v):
         try: return int(v) if v else None
         except: return None
 
-    id_cartao = to_int(id_cartao_str)
-    id_conta  = to_int(id_conta_str)
-    dia_venc  = to_int(dia_venc_str)
-    parcelas  = to_int(parcelas_str)
+    id_cartao = to_int(data.get('id_cartao'))
+    id_conta  = to_int(data.get('id_conta'))
+    parcelas  = to_int(data.get('parcelas'))
 
     try: data_lanc = date.fromisoformat(data_str) if data_str else date.today()
     except: data_lanc = date.today()
 
     if tipo == 'despesa' and not id_cartao:
-        return jsonify({'success': False, 'error': 'Selecione um cartão para a despesa'})
+        raise ValueError('Selecione um cartão para a despesa')
     if tipo == 'receita' and not id_conta:
-        return jsonify({'success': False, 'error': 'Selecione uma conta para a receita'})
+        raise ValueError('Selecione uma conta para a receita')
     if pagamento == 'parcelado' and (not parcelas or parcelas < 2):
-        return jsonify({'success': False, 'error': 'Parcelado exige mínimo 2 parcelas'})
+        raise ValueError('Parcelado exige mínimo 2 parcelas')
+
+    return {'tipo': tipo, 'descricao': descricao, 'valor': valor, 'categoria': data.get('categoria'),
+            'id_cartao': id_cartao, 'id_conta': id_conta, 'tipo_receita': tipo_receita,
+            'tipo_cobranca': tipo_cobranca, 'dia_vencimento': to_int(data.get('dia_vencimento')),
+            'tipo_compra': tipo_compra, 'pagamento': pagamento, 'parcelas': parcelas,
+            'data_lancamento': data_lanc.isoformat()}
+
+
+def carregar_destinos(c, lancamentos) -> tuple:
+    """Cartões {id: (tipo_pagamento, conta)} e contas {id} citados, numa consulta cada."""
+    ids_cartoes = sorted({l['id_cartao'] for l in lancamentos if l['id_cartao']})
+    ids_contas  = sorted({l['id_conta']  for l in lancamentos if l['id_conta']})
+    cartoes, contas = {}, set()
+    if ids_cartoes:
+        c.execute(f"SELECT id, tipo_pagamento, conta FROM cartoes WHERE id IN ({','.join('?' * len(ids_cartoes))})",
+                  ids_cartoes)
+        cartoes = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+    if ids_contas:
+        c.execute(f"SELECT id FROM contas WHERE id IN ({','.join('?' * len(ids_contas))})", ids_contas)
+        contas = {r[0] for r in c.fetchall()}
+    return cartoes, contas
+
+
+def conferir_destino(lanc: dict, cartoes: dict, contas: set):
+    """
+    Regras que dependem do cadastro. Devolve (erro, (conta, delta_saldo) | None):
+    receita avulsa credita a conta agora; despesa no débito debita a conta do
+    cartão agora; crédito (à vista ou parcelado) só cai na fatura.
+    """
+    if lanc['tipo'] == 'despesa':
+        cartao = cartoes.get(lanc['id_cartao'])
+        if not cartao: return 'Cartão não encontrado', None
+        tp, conta = cartao
+        if tp != 'multiplo' and lanc['tipo_compra'] != tp:
+            return f'Cartão só aceita {tp}', None
+        if tp == 'debito' and lanc['pagamento'] == 'parcelado':
+            return 'Débito não permite parcelamento', None
+        if lanc['tipo_compra'] == 'debito':
+            return None, (conta, -lanc['valor'])
+        return None, None
+    if lanc['id_conta'] not in contas:
+        return 'Conta não encontrada', None
+    if lanc['tipo_receita'] == 'avulsa':
+        return None, (lanc['id_conta'], lanc['valor'])
+    return None, None
+
+
+def inserir_lancamentos(c, lancamentos) -> list:
+    """
+    INSERT multi-linha (em blocos de LINHAS_POR_INSERT) + cronograma das
+    parceladas. Devolve os ids na ordem de `lancamentos`: dentro da mesma
+    transação o AUTOINCREMENT entrega ids crescentes na ordem do VALUES.
+    """
+    ids = []
+    for i in range(0, len(lancamentos), LINHAS_POR_INSERT):
+        bloco = lancamentos[i:i + LINHAS_POR_INSERT]
+        linha = '(' + ','.join('?' * len(COLUNAS_LANCAMENTO)) + ')'
+        c.execute(f"""INSERT INTO transacoes ({', '.join(COLUNAS_LANCAMENTO)})
+                      VALUES {','.join([linha] * len(bloco))} RETURNING id""",
+                  [l[col] for l in bloco for col in COLUNAS_LANCAMENTO])
+        ids.extend(sorted(r[0] for r in c.fetchall()))
+    parceladas = [id_ for id_, l in zip(ids, lancamentos) if l['pagamento'] == 'parcelado']
+    if parceladas:
+        materializar_parcelas(c, parceladas)
+    return ids
+
+
+def aplicar_saldos(c, deltas):
+    """Soma os (conta, delta) por conta e aplica um UPDATE por conta."""
+    saldos = {}
+    for conta, delta in deltas:
+        saldos[conta] = saldos.get(conta, 0) + delta
+    c.executemany("UPDATE contas SET saldo=saldo+? WHERE id=?",
+                  [(v, conta) for conta, v in saldos.items() if v])
 
-    with get_db() as conn:
-        c = conn.cursor()
-        if tipo == 'despesa' and id_cartao:
-            c.execute("SELECT tipo_pagamento FROM cartoes WHERE id=?", (id_cartao,))
-            row = c.fetchone()
-            if not row: return jsonify({'success': False, 'error': 'Cartão não encontrado'})
-            tp = row[0]
-            if tp != 'multiplo' and tipo_compra != tp:
-                return jsonify({'success': False, 'error': f'Cartão só aceita {tp}'})
-            if tp == 'debito' and pagamento == 'parcelado':
-                return jsonify({'success': False, 'error': 'Débito não permite parcelamento'})
 
-        c.execute("""
-            INSERT INTO transacoes (tipo,descricao,valor,categoria,id_cartao,id_conta,
-                tipo_receita,tipo_cobranca,dia_vencimento,tipo_compra,pagamento,parcelas,data_lancamento)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (tipo, descricao, valor, categoria, id_cartao, id_conta,
-              tipo_receita, tipo_cobranca, dia_venc, tipo_compra,
-              pagamento, parcelas, data_lanc.isoformat()))
-
-        # Receita avulsa → credita agora
-        # Despesa débito → debita agora
-        # Despesa crédito parcelada ou à vista → NÃO mexe no saldo (cai na fatura)
-        if tipo == 'receita' and tipo_receita == 'avulsa' and id_conta:
-            c.execute("UPDATE contas SET saldo=saldo+? WHERE id=?", (valor, id_conta))
-        elif tipo == 'despesa' and tipo_compra == 'debito' and id_cartao:
-            c.execute("UPDATE contas SET saldo=saldo-? WHERE id=(SELECT conta FROM cartoes WHERE id=?)", (valor, id_cartao))
+@app.route('/api/adicionar_lancamento', methods=['POST'])
+def adicionar_lancamento():
+    try:
+        lanc = normalizar_lancamento(request.get_json())
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-        conn.commit()
-        return jsonify({'success': True, 'id': c.lastrowid})
+    def op(c):
+        erro, delta = conferir_destino(lanc, *carregar_destinos(c, [lanc]))
+        if erro: return {'success': False, 'error': erro}
+        novo_id, = inserir_lancamentos(c, [lanc])
+        aplicar_saldos(c, [delta] if delta else [])
+        return {'success': True, 'id': novo_id}
+    return jsonify(escrever(op))
+
+
+@app.route('/api/adicionar_lancamentos', methods=['POST'])
+def adicionar_lancamentos():
+    """
+    Lote de lançamentos: [...] ou {"lancamentos": [...], "modo": "tudo_ou_nada" | "parcial"}.
+    Mesma validação do endpoint unitário, com cartões/contas lidos uma vez,
+    um INSERT multi-linha, um UPDATE de saldo por conta e um único commit.
+    resultados[i] = {'id': ...} ou {'error': ...}, na ordem enviada.
+    tudo_ou_nada (padrão): qualquer erro → nada é gravado.
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        data = {'lancamentos': data}
+    elif not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Envie uma lista de lançamentos'}), 400
+    itens = data.get('lancamentos')
+    modo = data.get('modo', 'tudo_ou_nada')
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'success': False, 'error': 'Envie uma lista em lancamentos'}), 400
+    if len(itens) > MAX_LOTE_LANCAMENTOS:
+        return jsonify({'success': False, 'error': f'Máximo de {MAX_LOTE_LANCAMENTOS} lançamentos por lote'}), 400
+    if modo not in ('tudo_ou_nada', 'parcial'):
+        return jsonify({'success': False, 'error': 'modo deve ser tudo_ou_nada ou parcial'}), 400
+
+    resultados, validos = [None] * len(itens), []
+    for n, item in enumerate(itens):
+        try:
+            validos.append((n, normalizar_lancamento(item)))
+        except ValueError as e:
+            resultados[n] = {'error': str(e)}
+
+    def op(c):
+        cartoes, contas = carregar_destinos(c, [l for _, l in validos])
+        aceitos, deltas = [], []
+        for n, lanc in validos:
+            erro, delta = conferir_destino(lanc, cartoes, contas)
+            if erro:
+                resultados[n] = {'error': erro}
+                continue
+            aceitos.append((n, lanc))
+            if delta: deltas.append(delta)
+        if modo == 'tudo_ou_nada' and len(aceitos) < len(itens):
+            return 0
+        ids = inserir_lancamentos(c, [l for _, l in aceitos]) if aceitos else []
+        for (n, _), id_ in zip(aceitos, ids):
+            resultados[n] = {'id': id_}
+        aplicar_saldos(c, deltas)
+        return len(ids)
+
+    inseridos = escrever(op, timeout=120)
+    if modo == 'tudo_ou_nada' and not inseridos:
+        # Itens válidos que ficaram de fora por causa dos outros
+        resultados = [r or {'error': 'Não gravado: outro item do lote tem erro'} for r in resultados]
+    erros = sum(1 for r in resultados if 'error' in r)
+    return jsonify({'success': erros == 0, 'inseridos': inseridos, 'erros': erros,
+                    'resultados': resultados})
 
 
 @app.route('/api/remover_lancamento', methods=['POST'])
@@ -1095,8 +2975,7 @@ def remover_lancamento():
     data = request.get_json()
     lid = data.get('id')
     if not lid: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
+    def op(c):
         c.execute("SELECT tipo, valor, id_conta, id_cartao, tipo_compra, tipo_receita FROM transacoes WHERE id=?", (lid,))
         row = c.fetchone()
         if row:
@@ -1105,11 +2984,580 @@ def remover_lancamento():
                 c.execute("UPDATE contas SET saldo=saldo-? WHERE id=?", (valor, id_conta))
             elif tipo == 'despesa' and tipo_compra == 'debito' and id_cartao:
                 c.execute("UPDATE contas SET saldo=saldo+? WHERE id=(SELECT conta FROM cartoes WHERE id=?)", (valor, id_cartao))
+        c.execute("DELETE FROM parcelas WHERE id_transacao=?", (lid,))
         c.execute("DELETE FROM transacoes WHERE id=?", (lid,))
-        conn.commit()
+    escrever(op)
     return jsonify({'success': True})
 
 
+# ================================================================
+# APIs — LISTAGEM PAGINADA (despesas / receitas)
+# ================================================================
+# As telas de lançamentos buscam janelas sob demanda em vez de receber o
+# histórico inteiro no template. A paginação é por chave (ordem, id): o
+# cursor guarda a última linha entregue e a próxima janela continua dali,
+# sem OFFSET — a página 500 custa o mesmo que a primeira.
+
+LISTAGEM_LIMITE_PADRAO = 100
+LISTAGEM_LIMITE_MAX = 500
+
+# Por tipo: colunas devolvidas, FROM, predicado base, filtros aceitos
+# (parâmetro → SQL, conversor) e ordens permitidas (chave → expressão).
+# Só o que está aqui chega ao SQL; valores sempre vão como parâmetros.
+_VALOR_MES = "t.valor / COALESCE(t.parcelas, 1)"   # "Valor/Mês" da tela de despesas
+
+LISTAGENS = {
+    'despesa': {
+        'colunas': ('id', 'descricao', 'valor', 'categoria', 'id_cartao', 'cartao',
+                    'data', 'pagamento', 'parcelas', 'tipo_compra'),
+        'select':  """t.id, t.descricao, t.valor, t.categoria, t.id_cartao, ca.nome,
+                      t.data_lancamento, t.pagamento, t.parcelas, t.tipo_compra""",
+        'origem':  "transacoes t LEFT JOIN cartoes ca ON ca.id = t.id_cartao",
+        'base':    "t.tipo = 'despesa' AND t.id_despesa_fixa IS NULL",
+        'filtros': {
+            'cartao':      ("t.id_cartao = ?", int),
+            'conta':       ("t.id_cartao IN (SELECT id FROM cartoes WHERE conta = ?)", int),
+            'tipo_compra': ("t.tipo_compra = ?", str),
+            'pagamento':   ("t.pagamento = ?", str),
+            'valor_min':   (f"{_VALOR_MES} >= ?", float),
+            'valor_max':   (f"{_VALOR_MES} <= ?", float),
+        },
+        'ordens': {
+            'data':      "t.data_lancamento",
+            'valor':     _VALOR_MES,
+            'descricao': "t.descricao COLLATE NOCASE",
+            'categoria': "COALESCE(t.categoria, '') COLLATE NOCASE",
+            'cartao':    "COALESCE(ca.nome, '') COLLATE NOCASE",
+            'parcelas':  "COALESCE(t.parcelas, 1)",
+        },
+    },
+    'receita': {
+        'colunas': ('id', 'descricao', 'valor', 'categoria', 'id_conta', 'conta', 'data'),
+        'select':  """t.id, t.descricao, t.valor, t.categoria, t.id_conta, co.nome,
+                      t.data_lancamento""",
+        'origem':  "transacoes t LEFT JOIN contas co ON co.id = t.id_conta",
+        'base':    "t.tipo = 'receita' AND t.id_receita_fixa IS NULL",
+        'filtros': {
+            'conta':     ("t.id_conta = ?", int),
+            'valor_min': ("t.valor >= ?", float),
+            'valor_max': ("t.valor <= ?", float),
+        },
+        'ordens': {
+            'data':      "t.data_lancamento",
+            'valor':     "t.valor",
+            'descricao': "t.descricao COLLATE NOCASE",
+            'categoria': "COALESCE(t.categoria, '') COLLATE NOCASE",
+            'conta':     "COALESCE(co.nome, '') COLLATE NOCASE",
+        },
+    },
+}
+
+# Filtros comuns aos dois tipos
+_FILTROS_COMUNS = {
+    'de':        ("t.data_lancamento >= ?", lambda v: date.fromisoformat(v).isoformat()),
+    'ate':       ("t.data_lancamento <= ?", lambda v: date.fromisoformat(v).isoformat()),
+    'categoria': ("t.categoria = ?", str),
+    # Filtro da coluna Descrição: palavras (prefixo, sem acento) via índice
+    # FTS, restrito à coluna descricao — categoria/cartão/conta ficam com a
+    # /api/busca. Só pontuação não casa com nada.
+    'q':         ("t.id IN (SELECT rowid FROM busca_transacoes WHERE busca_transacoes MATCH ?)",
+                  lambda v: f'descricao : ({e})' if (e := expressao_busca(v)) else '""'),
+}
+
+
+def codificar_cursor(valor, id_) -> str:
+    return base64.urlsafe_b64encode(json.dumps([valor, id_]).encode()).decode().rstrip('=')
+
+
+def decodificar_cursor(token: str) -> tuple:
+    bruto = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    valor, id_ = json.loads(bruto)
+    if not isinstance(id_, int) or not isinstance(valor, (str, int, float)):
+        raise ValueError('cursor inválido')
+    return valor, id_
+
+
+def listar_lancamentos(c, tipo: str, args) -> dict:
+    """
+    Uma janela de lançamentos avulsos do tipo, já filtrada e ordenada.
+    args: mapping com os filtros de LISTAGENS/_FILTROS_COMUNS e
+      ordem=<chave>, dir=asc|desc (padrão data desc), limite, cursor.
+    Retorna {'itens': [dict], 'proximo': cursor | None}.
+    Levanta ValueError com mensagem para parâmetros inválidos.
+    """
+    spec = LISTAGENS[tipo]
+    ordem = args.get('ordem') or 'data'
+    if ordem not in spec['ordens']:
+        raise ValueError(f"ordem deve ser uma de: {', '.join(spec['ordens'])}")
+    direcao = (args.get('dir') or 'desc').lower()
+    if direcao not in ('asc', 'desc'):
+        raise ValueError('dir deve ser asc ou desc')
+    try:
+        limite = int(args.get('limite') or LISTAGEM_LIMITE_PADRAO)
+    except ValueError:
+        raise ValueError('limite inválido')
+    limite = max(1, min(limite, LISTAGEM_LIMITE_MAX))
+
+    where, params = [spec['base']], []
+    for nome, (sql, conv) in {**_FILTROS_COMUNS, **spec['filtros']}.items():
+        bruto = args.get(nome)
+        if bruto in (None, ''):
+            continue
+        try:
+            params.append(conv(bruto))
+        except ValueError:
+            raise ValueError(f'{nome} inválido')
+        where.append(sql)
+
+    expr = spec['ordens'][ordem]
+    if args.get('cursor'):
+        try:
+            apos = decodificar_cursor(args['cursor'])
+        except (ValueError, TypeError):
+            raise ValueError('cursor inválido')
+        where.append(f"({expr}, t.id) {'<' if direcao == 'desc' else '>'} (?, ?)")
+        params.extend(apos)
+
+    c.execute(f"""
+        SELECT {spec['select']}, {expr}
+        FROM {spec['origem']}
+        WHERE {' AND '.join(where)}
+        ORDER BY {expr} {direcao.upper()}, t.id {direcao.upper()}
+        LIMIT ?
+    """, params + [limite + 1])
+    rows = c.fetchall()
+    proximo = None
+    if len(rows) > limite:
+        rows = rows[:limite]
+        proximo = codificar_cursor(rows[-1][-1], rows[-1][0])
+    return {'itens': [dict(zip(spec['colunas'], r)) for r in rows], 'proximo': proximo}
+
+
+def _api_listagem(tipo: str):
+    try:
+        janela = listar_lancamentos(get_db().cursor(), tipo, request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, **janela})
+
+
+@app.route('/api/lancamentos')
+def api_lancamentos():
+    return _api_listagem('despesa')
+
+
+@app.route('/api/receitas')
+def api_receitas():
+    return _api_listagem('receita')
+
+
+@app.route('/api/busca')
+def api_busca():
+    """?q=texto livre (&tipo=, de=, ate=, limite=, cursor=), por relevância."""
+    try:
+        janela = buscar_lancamentos(get_db().cursor(), request.args.get('q', ''), request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, **janela})
+
+
+# ================================================================
+# EXPORTAÇÃO (CSV / NDJSON)
+# ================================================================
+# O razão sai em pedaços de EXPORT_LOTE linhas lidos com fetchmany de uma
+# conexão própria, dentro de uma única transação de leitura (snapshot
+# consistente do começo ao fim). Nada é acumulado: a memória fica igual
+# com mil ou um milhão de lançamentos.
+
+EXPORT_LOTE = 1000
+EXPORT_FORMATOS = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+EXPORT_COLUNAS = ('id', 'tipo', 'data', 'descricao', 'categoria', 'valor', 'cartao', 'conta',
+                  'tipo_compra', 'pagamento', 'parcelas', 'origem')
+# Com parcelas expandidas: uma linha por parcela (à vista = parcela única)
+EXPORT_COLUNAS_PARCELAS = EXPORT_COLUNAS + ('parcela', 'competencia', 'valor_parcela')
+
+
+def _sql_exportacao(expandir: bool, de: str = None, ate: str = None) -> tuple:
+    where, params = [], []
+    if de:
+        where.append("t.data_lancamento >= ?"); params.append(de)
+    if ate:
+        where.append("t.data_lancamento <= ?"); params.append(ate)
+    extra, junta, ordem = '', '', ''
+    if expandir:
+        extra = """, COALESCE(p.numero, 1), COALESCE(p.competencia, strftime('%Y-%m', t.data_lancamento)),
+                   COALESCE(p.valor, t.valor)"""
+        junta = "LEFT JOIN parcelas p ON p.id_transacao = t.id"
+        ordem = ", p.numero"
+    sql = f"""
+        SELECT t.id, t.tipo, t.data_lancamento, t.descricao, t.categoria, t.valor,
+               ca.nome, co.nome, t.tipo_compra, t.pagamento, t.parcelas,
+               CASE WHEN {_gerada('t')} THEN 'fixa' ELSE 'avulsa' END {extra}
+        FROM transacoes t
+        LEFT JOIN cartoes ca ON ca.id = t.id_cartao
+        LEFT JOIN contas  co ON co.id = t.id_conta
+        {junta}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY t.data_lancamento, t.id {ordem}
+    """
+    return sql, params
+
+
+def exportar_lancamentos(formato: str = 'csv', de: str = None, ate: str = None,
+                         expandir: bool = False):
+    """
+    Gerador de pedaços de texto (cabeçalho CSV incluso) com os lançamentos
+    de `de` a `ate` (data da compra, ISO, ambos opcionais e inclusivos).
+    expandir=True → uma linha por parcela. Serve à rota e ao CLI.
+    """
+    colunas = EXPORT_COLUNAS_PARCELAS if expandir else EXPORT_COLUNAS
+    sql, params = _sql_exportacao(expandir, de, ate)
+    conn = _conectar()
+    try:
+        conn.execute("BEGIN")
+        cur = conn.execute(sql, params)
+        buf = io.StringIO()
+        escritor_csv = csv.writer(buf, lineterminator='\n')
+        if formato == 'csv':
+            escritor_csv.writerow(colunas)
+        while True:
+            rows = cur.fetchmany(EXPORT_LOTE)
+            if not rows:
+                break
+            if formato == 'csv':
+                escritor_csv.writerows(rows)
+            else:
+                for r in rows:
+                    buf.write(json.dumps(dict(zip(colunas, r)), ensure_ascii=False))
+                    buf.write('\n')
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        if formato == 'csv' and buf.tell():
+            yield buf.getvalue()    # só o cabeçalho: exportação vazia
+    finally:
+        conn.rollback()
+        _fechar(conn)
+
+
+def _data_exportacao(valor):
+    return date.fromisoformat(valor).isoformat() if valor else None
+
+
+@app.route('/api/export')
+def api_export():
+    """?formato=csv|ndjson&de=&ate=&parcelas=1 — download em streaming."""
+    formato = request.args.get('formato', 'csv')
+    if formato not in EXPORT_FORMATOS:
+        return jsonify({'success': False, 'error': 'formato deve ser csv ou ndjson'}), 400
+    try:
+        de  = _data_exportacao(request.args.get('de'))
+        ate = _data_exportacao(request.args.get('ate'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'de/ate devem ser datas YYYY-MM-DD'}), 400
+    expandir = request.args.get('parcelas') in ('1', 'true', 'sim')
+    nome = 'lancamentos' + (f'_{de}' if de else '') + (f'_{ate}' if ate else '') + f'.{formato}'
+    return app.response_class(
+        exportar_lancamentos(formato, de, ate, expandir),
+        mimetype=EXPORT_FORMATOS[formato],
+        headers={'Content-Disposition': f'attachment; filename="{nome}"'},
+    )
+
+
+@app.cli.command('exportar')
+@click.option('--formato', type=click.Choice(list(EXPORT_FORMATOS)), default='csv')
+@click.option('--de', default=None, help='Data inicial da compra (YYYY-MM-DD).')
+@click.option('--ate', default=None, help='Data final da compra (YYYY-MM-DD).')
+@click.option('--parcelas', is_flag=True, help='Uma linha por parcela.')
+@click.option('--saida', '-o', type=click.File('w', encoding='utf-8', lazy=False), default='-',
+              help='Arquivo de destino (padrão: stdout).')
+def cli_exportar(formato, de, ate, parcelas, saida):
+    """Exporta os lançamentos em CSV ou NDJSON, em streaming."""
+    try:
+        de, ate = _data_exportacao(de), _data_exportacao(ate)
+    except ValueError:
+        raise click.BadParameter('de/ate devem ser datas YYYY-MM-DD')
+    for pedaco in exportar_lancamentos(formato, de, ate, parcelas):
+        saida.write(pedaco)
+
+
+# ================================================================
+# IMPORTAÇÃO DE EXTRATOS (OFX / CSV)
+# ================================================================
+# O arquivo é lido linha a linha (nunca inteiro na memória) e cada
+# movimento vira um lançamento avulso à vista no destino escolhido:
+#   cartão → saídas viram despesas do cartão; entradas (pagamento de
+#            fatura, estorno) são ignoradas;
+#   conta  → entradas viram receitas; saídas, despesas de débito no cartão
+#            de débito da conta.
+# Tudo entra numa única operação de escrita: executemany em lotes de
+# IMPORT_LOTE, linhas já importadas puladas pelo hash_importacao e um
+# UPDATE de saldo por conta.
+
+IMPORT_LOTE = 500
+IMPORT_MAX_ERROS = 50
+
+# Layouts CSV: nome da coluna (no cabeçalho) de data, descrição e valor,
+# formato da data, separador decimal e se saída vem negativa.
+LAYOUTS_CSV = {
+    'padrao': {'delimitador': ',', 'data': 'data', 'descricao': 'descricao', 'valor': 'valor',
+               'formato_data': '%Y-%m-%d', 'decimal': '.', 'saida_negativa': True},
+    'br':     {'delimitador': ';', 'data': 'data', 'descricao': 'descricao', 'valor': 'valor',
+               'formato_data': '%d/%m/%Y', 'decimal': ',', 'saida_negativa': True},
+    # Fatura do Nubank: compras positivas
+    'nubank': {'delimitador': ',', 'data': 'date', 'descricao': 'title', 'valor': 'amount',
+               'formato_data': '%Y-%m-%d', 'decimal': '.', 'saida_negativa': False},
+}
+
+SQL_LANCAMENTO_IMPORTADO = """
+    INSERT INTO transacoes (tipo, descricao, valor, categoria, id_cartao, id_conta,
+                            tipo_compra, pagamento, data_lancamento, hash_importacao)
+    VALUES (?,?,?,?,?,?,?,'avista',?,?)
+"""
+
+_RE_TAG_OFX = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<\r\n]*)')
+
+
+def _linhas_texto(binario):
+    """Linhas de um arquivo binário: UTF-8, ou cp1252 (comum em OFX de banco)."""
+    for i, bruto in enumerate(binario):
+        try:
+            linha = bruto.decode('utf-8')
+        except UnicodeDecodeError:
+            linha = bruto.decode('cp1252', 'replace')
+        yield linha.lstrip('\ufeff') if i == 0 else linha
+
+
+def _normalizar(texto: str) -> str:
+    sem_acento = unicodedata.normalize('NFKD', texto or '').encode('ascii', 'ignore').decode()
+    return ' '.join(sem_acento.lower().split())
+
+
+def _movimento_ofx(campos: dict) -> dict:
+    try:
+        data_mov = datetime.strptime(campos.get('DTPOSTED', '')[:8], '%Y%m%d').date()
+        valor = float(campos.get('TRNAMT', '').replace(',', '.'))
+    except ValueError:
+        return {'linha': campos['linha'], 'erro': 'DTPOSTED/TRNAMT inválidos'}
+    return {'linha': campos['linha'], 'data': data_mov, 'valor': valor,
+            'descricao': campos.get('MEMO') or campos.get('NAME') or '',
+            'fitid': campos.get('FITID') or None}
+
+
+def ler_ofx(linhas):
+    """Movimentos (<STMTTRN>) de um OFX, SGML (v1) ou XML (v2). Saída = valor negativo."""
+    atual = None
+    for n, linha in enumerate(linhas, 1):
+        for fecha, tag, valor in _RE_TAG_OFX.findall(linha):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if atual is not None:
+                    yield _movimento_ofx(atual)
+                atual = None if fecha else {'linha': n}
+            elif atual is not None and not fecha:
+                atual[tag] = valor.strip()
+    if atual is not None:
+        yield _movimento_ofx(atual)
+
+
+def ler_csv(linhas, layout: dict):
+    """Movimentos de um CSV no layout dado. Saída = valor negativo."""
+    leitor = csv.reader(linhas, delimiter=layout['delimitador'])
+    cabecalho = [col.strip().lower() for col in next(leitor, [])]
+    idx = {}
+    for campo in ('data', 'descricao', 'valor'):
+        nome = str(layout[campo]).lower()
+        if nome not in cabecalho:
+            raise ValueError(f"coluna '{layout[campo]}' não está no cabeçalho do CSV")
+        idx[campo] = cabecalho.index(nome)
+    for reg in leitor:
+        if not any(col.strip() for col in reg):
+            continue
+        try:
+            data_mov = datetime.strptime(reg[idx['data']].strip(), layout['formato_data']).date()
+            bruto = reg[idx['valor']].replace('R$', '').replace(' ', '').strip()
+            if layout['decimal'] == ',':
+                bruto = bruto.replace('.', '').replace(',', '.')
+            valor = float(bruto)
+        except (ValueError, IndexError):
+            yield {'linha': leitor.line_num, 'erro': 'data/valor inválidos'}
+            continue
+        yield {'linha': leitor.line_num, 'data': data_mov,
+               'valor': valor if layout['saida_negativa'] else -valor,
+               'descricao': reg[idx['descricao']].strip(), 'fitid': None}
+
+
+def resolver_layout(layout) -> dict:
+    """Nome de LAYOUTS_CSV, dict (sobre o 'padrao') ou JSON desse dict."""
+    if not layout:
+        return LAYOUTS_CSV['padrao']
+    if isinstance(layout, str):
+        if layout in LAYOUTS_CSV:
+            return LAYOUTS_CSV[layout]
+        try:
+            layout = json.loads(layout)
+        except ValueError:
+            raise ValueError(f"layout deve ser um de {', '.join(LAYOUTS_CSV)} ou um objeto JSON")
+    if not isinstance(layout, dict) or set(layout) - set(LAYOUTS_CSV['padrao']):
+        raise ValueError(f"layout aceita só as chaves {', '.join(LAYOUTS_CSV['padrao'])}")
+    return {**LAYOUTS_CSV['padrao'], **layout}
+
+
+def resolver_regras(regras) -> list:
+    """[{'contem': texto, 'categoria': nome}] (ou JSON disso) → [(texto normalizado, categoria)]."""
+    if isinstance(regras, str):
+        try:
+            regras = json.loads(regras) if regras.strip() else []
+        except ValueError:
+            raise ValueError('regras deve ser uma lista JSON')
+    try:
+        return [(_normalizar(r['contem']), r['categoria']) for r in regras or []]
+    except (TypeError, KeyError):
+        raise ValueError("cada regra precisa de 'contem' e 'categoria'")
+
+
+def importar_extrato(binario, formato: str, cartao: int = None, conta: int = None,
+                     layout=None, regras=None) -> dict:
+    """
+    Importa um extrato (iterável de linhas em bytes) para o cartão OU a
+    conta. Categoria = primeira regra cujo 'contem' aparece na descrição
+    (sem acento/caixa). Retorna contagens, saldos aplicados por conta e os
+    primeiros erros de leitura; ValueError para parâmetros inválidos.
+    """
+    if formato not in ('ofx', 'csv'):
+        raise ValueError('formato deve ser ofx ou csv')
+    if (cartao is None) == (conta is None):
+        raise ValueError('informe cartao ou conta (só um)')
+    regras = resolver_regras(regras)
+    linhas = _linhas_texto(binario)
+    movimentos = ler_ofx(linhas) if formato == 'ofx' else ler_csv(linhas, resolver_layout(layout))
+
+    c = get_db().cursor()
+    if cartao is not None:
+        c.execute("SELECT conta, tipo_pagamento FROM cartoes WHERE id=?", (cartao,))
+        row = c.fetchone()
+        if not row:
+            raise ValueError('Cartão não encontrado')
+        conta_cartao, tipo_pag = row
+        destino = f'cartao:{cartao}'
+        debito = (cartao, conta_cartao, 'debito' if tipo_pag == 'debito' else 'credito')
+    else:
+        c.execute("SELECT 1 FROM contas WHERE id=?", (conta,))
+        if not c.fetchone():
+            raise ValueError('Conta não encontrada')
+        destino = f'conta:{conta}'
+        # Saídas da conta entram como débito no cartão de débito dela
+        c.execute("""SELECT id FROM cartoes WHERE conta=? AND tipo_pagamento IN ('debito','multiplo')
+                     ORDER BY tipo_pagamento='multiplo', id LIMIT 1""", (conta,))
+        row = c.fetchone()
+        debito = (row[0], conta, 'debito') if row else None
+
+    registros, erros, ignoradas, lidas, vistos = [], [], 0, 0, {}
+    for m in movimentos:
+        lidas += 1
+        if 'erro' in m:
+            erros.append(m)
+            continue
+        valor = round(abs(m['valor']), 2)
+        if not valor:
+            ignoradas += 1
+            continue
+        descricao = m['descricao'] or '(sem descrição)'
+        norm = _normalizar(descricao)
+        categoria = next((cat for trecho, cat in regras if trecho in norm), None)
+
+        # Mesma linha repetida no arquivo (dois cafés iguais no dia) = n-ésima ocorrência
+        base = f"{destino}|{m['fitid']}" if m['fitid'] else \
+               f"{destino}|{m['data'].isoformat()}|{valor:.2f}|{m['valor'] < 0}|{norm}"
+        vistos[base] = vistos.get(base, 0) + 1
+        hash_ = hashlib.sha1(f'{base}|{vistos[base]}'.encode()).hexdigest()
+
+        if m['valor'] < 0:
+            if debito is None:
+                erros.append({'linha': m['linha'], 'erro': 'conta sem cartão de débito para lançar saídas'})
+                continue
+            id_cartao, conta_saldo, tipo_compra = debito
+            delta = -valor if tipo_compra == 'debito' else 0
+            registros.append((('despesa', descricao, valor, categoria, id_cartao, None, tipo_compra,
+                               m['data'].isoformat(), hash_), conta_saldo, delta))
+        elif cartao is not None:
+            ignoradas += 1      # pagamento de fatura / estorno
+        else:
+            registros.append((('receita', descricao, valor, categoria, None, conta, 'credito',
+                               m['data'].isoformat(), hash_), conta, valor))
+
+    def op(c):
+        importadas, saldos = 0, {}
+        for i in range(0, len(registros), IMPORT_LOTE):
+            lote = registros[i:i + IMPORT_LOTE]
+            c.execute(f"""SELECT hash_importacao FROM transacoes
+                          WHERE hash_importacao IN ({','.join('?' * len(lote))})""",
+                      [r[0][-1] for r in lote])
+            existentes = {row[0] for row in c.fetchall()}
+            novos = [r for r in lote if r[0][-1] not in existentes]
+            c.executemany(SQL_LANCAMENTO_IMPORTADO, [r[0] for r in novos])
+            importadas += len(novos)
+            for _, conta_saldo, delta in novos:
+                if delta:
+                    saldos[conta_saldo] = saldos.get(conta_saldo, 0) + delta
+        c.executemany("UPDATE contas SET saldo=saldo+? WHERE id=?",
+                      [(v, conta_saldo) for conta_saldo, v in saldos.items()])
+        return importadas, saldos
+
+    importadas, saldos = escrever(op, timeout=300) if registros else (0, {})
+    return {'lidas': lidas, 'importadas': importadas, 'duplicadas': len(registros) - importadas,
+            'ignoradas': ignoradas, 'total_erros': len(erros), 'erros': erros[:IMPORT_MAX_ERROS],
+            'saldos': {conta_saldo: round(v, 2) for conta_saldo, v in saldos.items()}}
+
+
+def _formato_por_nome(nome: str) -> str:
+    return 'ofx' if (nome or '').lower().endswith('.ofx') else 'csv'
+
+
+@app.route('/api/importar', methods=['POST'])
+def api_importar():
+    """
+    multipart: arquivo, cartao | conta, formato (ofx|csv; padrão pela
+    extensão), layout (nome ou JSON), regras (JSON).
+    """
+    arquivo = request.files.get('arquivo')
+    if not arquivo:
+        return jsonify({'success': False, 'error': 'Envie o extrato no campo arquivo'}), 400
+    try:
+        cartao = request.form.get('cartao', type=int)
+        conta  = request.form.get('conta',  type=int)
+        r = importar_extrato(arquivo.stream,
+                             request.form.get('formato') or _formato_por_nome(arquivo.filename),
+                             cartao, conta, request.form.get('layout'), request.form.get('regras'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, **r})
+
+
+@app.cli.command('importar')
+@click.argument('arquivo', type=click.File('rb'))
+@click.option('--cartao', type=int, default=None, help='Cartão de destino.')
+@click.option('--conta', type=int, default=None, help='Conta de destino.')
+@click.option('--formato', type=click.Choice(['ofx', 'csv']), default=None,
+              help='Padrão: pela extensão do arquivo.')
+@click.option('--layout', default=None, help=f"Layout CSV: {', '.join(LAYOUTS_CSV)} ou JSON.")
+@click.option('--regras', type=click.File('r', encoding='utf-8'), default=None,
+              help='JSON [{"contem": ..., "categoria": ...}].')
+def cli_importar(arquivo, cartao, conta, formato, layout, regras):
+    """Importa um extrato OFX/CSV para um cartão ou uma conta."""
+    try:
+        r = importar_extrato(arquivo, formato or _formato_por_nome(arquivo.name), cartao, conta,
+                             layout, regras.read() if regras else None)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    print(f"Lidas {r['lidas']}: {r['importadas']} importadas, {r['duplicadas']} já existentes, "
+          f"{r['ignoradas']} ignoradas, {r['total_erros']} com erro.")
+    for e in r['erros']:
+        print(f"  linha {e['linha']}: {e['erro']}")
+    for conta_saldo, delta in sorted(r['saldos'].items()):
+        print(f'  conta {conta_saldo}: {delta:+.2f}')
+
+
 # ================================================================
 # APIs — RECEITAS FIXAS
 # ================================================================
@@ -1144,13 +3592,14 @@ def api_adicionar_receita_fixa():
         return jsonify({'success': False, 'error': 'modo_dia inválido'})
     try: valor = float(valor_str)
     except: return jsonify({'success': False, 'error': 'Valor inválido'})
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO receitas_fixas (descricao,valor,categoria,id_conta,dia_mes,modo_dia) VALUES (?,?,?,?,?,?)",
-                  (descricao, valor, categoria, id_conta, dia_mes, modo_dia))
-        conn.commit()
+    def op(c):
+        c.execute("INSERT INTO receitas_fixas (descricao,valor,categoria,id_conta,dia_mes,modo_dia,gerar_desde) VALUES (?,?,?,?,?,?,?)",
+                  (descricao, valor, categoria, id_conta, dia_mes, modo_dia, date.today().strftime('%Y-%m')))
         novo_id = c.lastrowid
-    gerar_ocorrencias_receitas_fixas()
+        _gerar_receitas_fixas(c, date.today(), [novo_id])
+        return novo_id
+    novo_id = escrever(op)
+    agendador.recarregar()
     return jsonify({'success': True, 'id': novo_id})
 
 @app.route('/api/remover_receita_fixa', methods=['POST'])
@@ -1158,10 +3607,8 @@ def api_remover_receita_fixa():
     data = request.get_json()
     rf_id = data.get('id')
     if not rf_id: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM receitas_fixas WHERE id=?", (rf_id,))
-        conn.commit()
+    escrever(lambda c: c.execute("DELETE FROM receitas_fixas WHERE id=?", (rf_id,)))
+    agendador.recarregar()
     return jsonify({'success': True})
 
 @app.route('/api/pausar_receita_fixa', methods=['POST'])
@@ -1170,10 +3617,14 @@ def api_pausar_receita_fixa():
     rf_id = data.get('id')
     ativa = data.get('ativa', 1)
     if not rf_id: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
+    def op(c):
+        if ativa:
+            # Reativada: retoma no mês atual, sem gerar os meses em que ficou pausada
+            c.execute("UPDATE receitas_fixas SET gerar_desde=? WHERE id=? AND ativa=0",
+                      (date.today().strftime('%Y-%m'), rf_id))
         c.execute("UPDATE receitas_fixas SET ativa=? WHERE id=?", (ativa, rf_id))
-        conn.commit()
+    escrever(op)
+    agendador.recarregar()
     return jsonify({'success': True})
 
 
@@ -1219,13 +3670,14 @@ def api_adicionar_despesa_fixa():
         return jsonify({'success': False, 'error': 'modo_dia inválido'})
     try: valor = float(valor_str)
     except: return jsonify({'success': False, 'error': 'Valor inválido'})
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO despesas_fixas (descricao,valor,categoria,id_cartao,id_conta,dia_mes,modo_dia) VALUES (?,?,?,?,?,?,?)",
-                  (descricao, valor, categoria, id_cartao, id_conta, dia_mes, modo_dia))
-        conn.commit()
+    def op(c):
+        c.execute("INSERT INTO despesas_fixas (descricao,valor,categoria,id_cartao,id_conta,dia_mes,modo_dia,gerar_desde) VALUES (?,?,?,?,?,?,?,?)",
+                  (descricao, valor, categoria, id_cartao, id_conta, dia_mes, modo_dia, date.today().strftime('%Y-%m')))
         novo_id = c.lastrowid
-    gerar_ocorrencias_despesas_fixas()
+        _gerar_despesas_fixas(c, date.today(), [novo_id])
+        return novo_id
+    novo_id = escrever(op)
+    agendador.recarregar()
     return jsonify({'success': True, 'id': novo_id})
 
 @app.route('/api/remover_despesa_fixa', methods=['POST'])
@@ -1233,10 +3685,8 @@ def api_remover_despesa_fixa():
     data = request.get_json()
     df_id = data.get('id')
     if not df_id: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("DELETE FROM despesas_fixas WHERE id=?", (df_id,))
-        conn.commit()
+    escrever(lambda c: c.execute("DELETE FROM despesas_fixas WHERE id=?", (df_id,)))
+    agendador.recarregar()
     return jsonify({'success': True})
 
 @app.route('/api/pausar_despesa_fixa', methods=['POST'])
@@ -1245,13 +3695,27 @@ def api_pausar_despesa_fixa():
     df_id = data.get('id')
     ativa = data.get('ativa', 1)
     if not df_id: return jsonify({'success': False, 'error': 'ID não informado'})
-    with get_db() as conn:
-        c = conn.cursor()
+    def op(c):
+        if ativa:
+            # Reativada: retoma no mês atual, sem gerar os meses em que ficou pausada
+            c.execute("UPDATE despesas_fixas SET gerar_desde=? WHERE id=? AND ativa=0",
+                      (date.today().strftime('%Y-%m'), df_id))
         c.execute("UPDATE despesas_fixas SET ativa=? WHERE id=?", (ativa, df_id))
-        conn.commit()
+    escrever(op)
+    agendador.recarregar()
     return jsonify({'success': True})
 
 
+@app.route('/api/backfill', methods=['POST'])
+def api_backfill():
+    """Gera as ocorrências históricas das fixas ativas entre desde e ate (YYYY-MM)."""
+    data = request.get_json() or {}
+    desde, ate = data.get('desde'), data.get('ate')
+    erro = validar_faixa_backfill(desde, ate)
+    if erro: return jsonify({'success': False, 'error': erro}), 400
+    return jsonify({'success': True, **backfill(desde, ate)})
+
+
 # ================================================================
 # API — FATURA DETALHADA
 # ================================================================
@@ -1264,43 +3728,307 @@ def fatura_cartao(cartao_id):
         row = c.fetchone()
         if not row: return jsonify({'success': False, 'error': 'Cartão não encontrado'})
         inicio, fim, venc = periodo_fatura_atual(row[0], row[1])
-        c.execute("""
-            SELECT id, descricao, valor, data_lancamento, categoria, pagamento, parcelas
-            FROM transacoes
-            WHERE tipo='despesa' AND id_cartao=? AND data_lancamento BETWEEN ? AND ?
-            ORDER BY data_lancamento
-        """, (cartao_id, inicio.isoformat(), fim.isoformat()))
-        itens = []
-        total = 0.0
-        for r in c.fetchall():
-            tid, desc, vt, ds, cat, pag, parc = r
-            if pag == 'parcelado' and parc and parc >= 2:
-                try: dc = date.fromisoformat(str(ds)[:10])
-                except: dc = date.today()
-                v_item = valor_parcela_na_fatura(vt, parc, dc, inicio, fim)
-                label = f"{desc} ({parc}x)"
-            else:
-                v_item = vt
-                label  = desc
-            itens.append({'id': tid, 'descricao': label, 'valor': round(v_item, 2),
-                          'data': ds, 'categoria': cat})
-            total += v_item
+        fatura = calcular_faturas(c, [(cartao_id, inicio, fim)], com_itens=True)[0]
+    itens = [{'id': i['id_transacao'],
+              'descricao': f"{i['descricao']} ({i['parcela']}/{i['total_parcelas']})" if i['parcela']
+                           else i['descricao'],
+              'valor': i['valor'], 'data': i['data'], 'categoria': i['categoria']}
+             for i in fatura['itens']]
     return jsonify({
         'periodo_inicio': inicio.strftime('%d/%m/%Y'),
         'periodo_fim':    fim.strftime('%d/%m/%Y'),
         'vencimento':     venc.strftime('%d/%m/%Y'),
         'itens':          itens,
-        'total':          round(total, 2),
+        'total':          fatura['total'],
     })
 
 
+@app.route('/api/faturas/<int:cartao_id>')
+def api_faturas(cartao_id):
+    """
+    Histórico de faturas do cartão com vencimento entre ?de= e ?ate=
+    ('YYYY-MM', padrão: últimos 12 meses). Fechadas vêm dos snapshots; a
+    aberta e as fechadas ainda sem snapshot (agendador não passou, lançamento
+    retroativo) são calculadas na hora — GET não grava, quem grava é o
+    agendador/preparar().
+    """
+    hoje = date.today()
+    de  = request.args.get('de')  or (hoje - relativedelta(months=11)).strftime('%Y-%m')
+    ate = request.args.get('ate') or (hoje + relativedelta(months=1)).strftime('%Y-%m')
+    c = get_db().cursor()
+    c.execute("SELECT data_vencimento, dias_fechamento FROM cartoes WHERE id=?", (cartao_id,))
+    row = c.fetchone()
+    if not row: return jsonify({'success': False, 'error': 'Cartão não encontrado'}), 404
+    if row[0] is None or row[1] is None:
+        return jsonify({'success': True, 'faturas': [], 'aberta': None})
+
+    inicio, fim, venc = periodo_fatura_atual(row[0], row[1], hoje)
+
+    venc_ini, venc_fim = limites_mes(de)[0], limites_mes(ate)[1]
+    pendentes = [ciclo for ciclo in ciclos_sem_snapshot(c, cartao_id, row[0], row[1], hoje)
+                 if venc_ini <= ciclo[2].isoformat() < venc_fim]
+    c.execute("""SELECT id, inicio, fim, vencimento, total FROM faturas
+                 WHERE id_cartao=? AND vencimento >= ? AND vencimento < ?
+                 ORDER BY vencimento""", (cartao_id, venc_ini, venc_fim))
+    faturas = [{'id': r[0], 'inicio': r[1], 'fim': r[2], 'vencimento': r[3],
+                'total': r[4], 'itens': []} for r in c.fetchall()]
+    por_id = {f['id']: f for f in faturas}
+    if por_id:
+        c.execute(f"""SELECT id_fatura, id_transacao, descricao, data_lancamento, categoria,
+                             parcela, total_parcelas, valor
+                      FROM faturas_itens WHERE id_fatura IN ({','.join('?' * len(por_id))})
+                      ORDER BY id_fatura, data_lancamento, id_transacao""", list(por_id))
+        for r in c.fetchall():
+            por_id[r[0]]['itens'].append({'id_transacao': r[1], 'descricao': r[2], 'data': r[3],
+                                          'categoria': r[4], 'parcela': r[5],
+                                          'total_parcelas': r[6], 'valor': r[7]})
+    if pendentes:
+        calculadas = calcular_faturas(c, [(cartao_id, ini, f) for ini, f, _ in pendentes], com_itens=True)
+        faturas += [{'id': None, 'inicio': ini.isoformat(), 'fim': f.isoformat(),
+                     'vencimento': v.isoformat(), **fatura}
+                    for (ini, f, v), fatura in zip(pendentes, calculadas)]
+        faturas.sort(key=lambda f: f['vencimento'])
+
+    aberta = None
+    if venc_ini <= venc.isoformat() < venc_fim:
+        fatura = calcular_faturas(c, [(cartao_id, inicio, fim)], com_itens=True)[0]
+        aberta = {'inicio': inicio.isoformat(), 'fim': fim.isoformat(), 'vencimento': venc.isoformat(),
+                  **fatura}
+    return jsonify({'success': True, 'faturas': faturas, 'aberta': aberta})
+
+
+# ================================================================
+# VERIFICAÇÃO DE PLANOS DE CONSULTA
+# ================================================================
+
+# Rotas quentes exercitadas pela verificação; '{cartao}' vira cada cartão.
+ROTAS_QUENTES = [
+    '/', '/api/dashboard_data', '/api/dashboard_cartao/{cartao}', '/api/fatura/{cartao}',
+    '/api/faturas/{cartao}',
+    '/visaoGeral', '/projecoes', '/api/lancamentos', '/api/receitas', '/api/busca?q=me',
+]
+# Tabelas que crescem com o histórico: SCAN nelas reprova a verificação.
+TABELAS_GRANDES = ('transacoes', 'parcelas', 'rollup_cartao_mes', 'resumo_mensal')
+
+
+def verificar_planos() -> list:
+    """
+    Roda as ROTAS_QUENTES capturando o SQL executado (com os parâmetros já
+    expandidos) e passa cada SELECT por EXPLAIN QUERY PLAN.
+    Retorna [(sql, detalhe)] de cada SCAN completo em tabela grande — um
+    SCAN por índice com LIMIT (ex.: "últimos 10") não conta.
+    """
+    global _db_trace
+    capturadas = []
+    _db_trace = capturadas.append
+    try:
+        with get_db() as conn:
+            ids = [r[0] for r in conn.execute("SELECT id FROM cartoes")] or [0]
+        cliente = app.test_client()
+        for rota in ROTAS_QUENTES:
+            for cartao in (ids if '{cartao}' in rota else [None]):
+                cliente.get(rota.format(cartao=cartao))
+    finally:
+        _db_trace = None
+
+    problemas = []
+    vistas = set()
+    with get_db() as conn:
+        for sql in capturadas:
+            sql_norm = ' '.join(sql.split())
+            if not sql_norm.upper().startswith(('SELECT', 'WITH')) or sql_norm in vistas:
+                continue
+            vistas.add(sql_norm)
+            for linha in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+                detalhe = linha[3]
+                m = re.match(r'SCAN (\w+)', detalhe)
+                if not m:
+                    continue
+                tabela = m.group(1)
+                real = tabela if tabela in TABELAS_GRANDES else None
+                if real is None:
+                    # Alias (ex.: "FROM transacoes t" → SCAN t)
+                    m2 = re.search(rf'\b({"|".join(TABELAS_GRANDES)})\s+(?:AS\s+)?{tabela}\b', sql_norm)
+                    real = m2.group(1) if m2 else None
+                if real is None:
+                    continue
+                if 'USING' in detalhe and ' LIMIT ' in sql_norm.upper():
+                    continue
+                problemas.append((sql_norm, detalhe))
+    return problemas
+
+
+@app.cli.command('verificar-indices')
+def cli_verificar_indices():
+    """Falha (exit 1) se alguma consulta quente fizer SCAN em tabela grande."""
+    problemas = verificar_planos()
+    for sql, detalhe in problemas:
+        print(f'SCAN: {detalhe}\n      {sql[:300]}')
+    if problemas:
+        raise SystemExit(1)
+    print('OK: nenhuma consulta quente faz SCAN em tabela grande.')
+
+
+# ================================================================
+# SERVIDOR DE PRODUÇÃO (flask serve)
+# ================================================================
+
+# Páginas/APIs pedidas por cada worker antes de se declarar pronto: enchem
+# o cache por geração, as páginas prontas e os hashes dos estáticos.
+ROTAS_AQUECIMENTO = ['/api/dashboard_data', '/lancamentos', '/lancamentosReceita',
+                     '/lancamentosAssinaturas']
+_pronto = threading.Event()
+_lock_agendador = None      # arquivo aberto enquanto este processo for o dono da agenda
+
+
+def preparar():
+    """
+    Roda uma vez, no processo mestre, antes de criar os workers: migrações e
+    recuperação de fixas/faturas. Depois fecha tudo que não pode atravessar
+    um fork (thread de escrita e conexões SQLite).
+    """
+    aplicadas = init_db()
+    _, geradas = gerar_ocorrencias_fixas()
+    _, fechadas = fechar_faturas()
+    escritor.parar()
+    fechar_db_thread()
+    if has_app_context():
+        fechar_db(None)
+    app.logger.info('Preparação: %d migração(ões), %d ocorrência(s), %d fatura(s)',
+                    aplicadas, geradas, fechadas)
+
+
+def _assumir_agendador():
+    """
+    Lock de arquivo: o worker que o pegar roda o AgendadorFixas. Os demais
+    ficam numa thread bloqueados no flock — se o dono morrer (ou sair num
+    reload gradual), o lock cai junto e um deles assume.
+    """
+    if fcntl is None:
+        agendador.iniciar()
+        return
+    arquivo = open(DB + '.agendador.lock', 'a')
+
+    def esperar():
+        global _lock_agendador
+        fcntl.flock(arquivo, fcntl.LOCK_EX)
+        _lock_agendador = arquivo
+        agendador.iniciar()
+
+    threading.Thread(target=esperar, name='lock-agendador', daemon=True).start()
+
+
+def aquecer():
+    """Calendário, conexões e caches deste processo, pelo mesmo caminho das requisições."""
+    hoje = date.today()
+    for ano in (hoje.year, hoje.year + 1):
+        calendario_util(ano)
+    cliente = app.test_client()
+    for rota in ROTAS_AQUECIMENTO:
+        resp = cliente.get(rota)
+        if resp.status_code != 200:
+            app.logger.warning('Aquecimento: %s respondeu %d', rota, resp.status_code)
+    fechar_db_thread()
+
+
+def iniciar_worker():
+    """Em cada worker, logo após o fork: agenda (em um só) e aquecimento."""
+    _assumir_agendador()
+    aquecer()
+    _pronto.set()
+
+
+@app.route('/api/pronto')
+def api_pronto():
+    """Readiness: 200 só com o banco migrado e este worker aquecido; senão 503."""
+    versao = get_db().execute("PRAGMA user_version").fetchone()[0]
+    pronto = _pronto.is_set() and versao == len(MIGRACOES)
+    return jsonify({'pronto': pronto, 'pid': os.getpid(), 'migracao': versao,
+                    'migracoes': len(MIGRACOES),
+                    'agendador': agendador._pid == os.getpid()}), 200 if pronto else 503
+
+
+def servir(host: str, porta: int, workers: int, threads: int, streams: int, timeout_gracioso: int):
+    """
+    gunicorn (gthread, preload) quando instalado: mestre prepara, forka N
+    workers, SIGHUP recarrega com troca gradual dos workers e SIGTERM espera
+    as requisições em andamento. Sem gunicorn, waitress ou o servidor do
+    Werkzeug num processo só, com threads.
+    Cada worker tem threads + streams threads: os streams SSE, que ficam
+    abertos, nunca tomam as threads das requisições comuns.
+    """
+    preparar()
+    transmissor.max_inscritos = streams
+    try:
+        from gunicorn.app.base import BaseApplication      # opcional: pip install gunicorn
+    except ImportError:
+        BaseApplication = None
+
+    if BaseApplication is not None:
+        agendador.compartilhado = transmissor.compartilhado = workers > 1
+
+        class Servidor(BaseApplication):
+            def load_config(self):
+                config = {
+                    'bind': f'{host}:{porta}', 'workers': workers, 'threads': threads + streams,
+                    'worker_class': 'gthread', 'preload_app': True,
+                    'graceful_timeout': timeout_gracioso,
+                    'post_fork': lambda servidor, worker: iniciar_worker(),
+                    # SIGHUP: migrações novas rodam uma vez, no mestre, antes dos novos workers
+                    'on_reload': lambda servidor: preparar(),
+                }
+                for chave, valor in config.items():
+                    self.cfg.set(chave, valor)
+
+            def load(self):
+                return app
+
+        Servidor().run()
+        return
+
+    if workers > 1:
+        app.logger.warning('gunicorn não instalado: servindo em um processo só (%d threads)', threads)
+    iniciar_worker()
+    try:
+        from waitress import serve                          # opcional: pip install waitress
+    except ImportError:
+        from werkzeug.serving import run_simple
+        run_simple(host, porta, app, threaded=True)
+    else:
+        serve(app, host=host, port=porta, threads=threads + streams)
+
+
+@app.cli.command('serve')
+@click.option('--host', default='0.0.0.0', show_default=True)
+@click.option('--port', 'porta', type=int, default=lambda: int(os.environ.get('PORT', 5000)),
+              show_default='PORT ou 5000')
+@click.option('--workers', type=click.IntRange(min=1), default=lambda: os.cpu_count() or 1,
+              show_default='nº de CPUs', help='Processos (precisa de gunicorn).')
+@click.option('--threads', type=click.IntRange(min=1), default=4, show_default=True,
+              help='Threads por worker para requisições comuns.')
+@click.option('--streams', type=click.IntRange(min=0), default=8, show_default=True,
+              help='Streams SSE (/api/stream) abertos por worker, cada um com thread própria '
+                   'além das --threads. Acima disso o stream responde 503 e a página volta '
+                   'ao polling de 30 s.')
+@click.option('--graceful-timeout', 'timeout_gracioso', type=int, default=30, show_default=True,
+              help='Segundos para terminar requisições em andamento ao parar/recarregar.')
+def cli_serve(host, porta, workers, threads, streams, timeout_gracioso):
+    """Servidor de produção: migra uma vez e sobe N workers com T threads (+ streams SSE)."""
+    servir(host, porta, workers, threads, streams, timeout_gracioso)
+
+
 # ================================================================
 # INICIALIZAÇÃO
 # ================================================================
 
 if __name__ == '__main__':
-    init_db()
-    gerar_ocorrencias_receitas_fixas()
-    gerar_ocorrencias_despesas_fixas()
+    # Desenvolvimento (reloader, debug). Produção: flask --app app serve
+    # O reloader roda este módulo no processo vigia e de novo no filho que
+    # atende: migração e agendador só no filho, para não correrem em dobro.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_db()
+        # Geração das fixas fora do caminho crítico: o servidor já sobe atendendo
+        agendador.iniciar()
+        _pronto.set()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
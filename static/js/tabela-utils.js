@@ -12,14 +12,24 @@
  * toolbar: só o botão "Limpar filtros" + dica de edição
  * onEditar(meta, tr): callback opcional para clique-para-editar
  *
+ * Modo remoto (remoto: { url, linha, limite }):
+ *   filtros e ordenação viram parâmetros da URL e o servidor devolve janelas
+ *   { itens, proximo } paginadas por cursor. Só colunas com `param` ganham
+ *   filtro (data: param:['de','ate']) e só as com `ordem` ordenam.
+ *   linha(item) → <tr>; a próxima janela é buscada ao rolar perto do fim e
+ *   apenas as linhas visíveis ficam no DOM (rolagem virtual).
+ *   opcoes: [{ valor, rotulo }] fixa as opções do <select>.
+ *
  * API pública:
  *   tm.adicionar(tr, meta)
  *   tm.remover(tr)
  *   tm.atualizar(tr, novaMeta)
  *   tm.contar()
+ *   tm.recarregar()              (remoto: volta à primeira janela)
+ *   tm.definirOpcoes(chave, lista)
  */
 class TabelaManager {
-    constructor({ tbody, thead, toolbar, selLinhas, ulPag, infoSpan, colunas, onEditar }) {
+    constructor({ tbody, thead, toolbar, selLinhas, ulPag, infoSpan, colunas, onEditar, remoto }) {
         this.tbody     = tbody;
         this.thead     = thead;
         this.toolbar   = toolbar;
@@ -28,6 +38,7 @@ class TabelaManager {
         this.infoSpan  = infoSpan;
         this.colunas   = colunas;
         this.onEditar  = onEditar || null;
+        this.remoto    = remoto   || null;
 
         this.itens    = [];
         this.pag      = 1;
@@ -42,6 +53,11 @@ class TabelaManager {
         this._construirCabecalho();
 
         this.selLinhas?.addEventListener('change', () => { this.pag = 1; this._render(); });
+
+        if (this.remoto) {
+            this._iniciarRemoto();
+            this.recarregar();
+        }
     }
 
     // ════════════════════════════════════════════════════════
@@ -97,8 +113,17 @@ class TabelaManager {
             this._atualizarIconesSort();
         }
         this._atualizarBtnLimpar();
-        this.pag = 1;
-        this._render();
+        this._filtrosMudaram();
+    }
+
+    // Filtros/ordem mudaram: local → volta à página 1; remoto → nova busca.
+    // Digitação (atrasar) espera uma pausa antes de ir ao servidor.
+    _filtrosMudaram(atrasar) {
+        this._atualizarBtnLimpar();
+        if (!this.remoto) { this.pag = 1; this._render(); return; }
+        clearTimeout(this._timerBusca);
+        if (atrasar) this._timerBusca = setTimeout(() => this.recarregar(), 300);
+        else this.recarregar();
     }
 
     _atualizarBtnLimpar() {
@@ -133,6 +158,12 @@ class TabelaManager {
 
         ths.forEach((th, i) => {
             const col = this.colunas[i];
+            if (this.remoto) {
+                // Cabeçalho fixo dentro da área de rolagem
+                th.style.position = 'sticky';
+                th.style.top = '0';
+                th.style.zIndex = '1';
+            }
             if (!col || col.tipo === 'acoes') return;
 
             const labelOriginal = th.textContent.trim();
@@ -141,14 +172,19 @@ class TabelaManager {
             th.style.paddingBottom = '6px';
 
             // Label com ícone de sort
+            const ordenavel = !this.remoto || !!col.ordem;
             const sortWrap = document.createElement('div');
-            sortWrap.style.cssText = 'display:flex;align-items:center;gap:4px;cursor:pointer;user-select:none;white-space:nowrap;margin-bottom:5px;';
+            sortWrap.style.cssText = 'display:flex;align-items:center;gap:4px;user-select:none;white-space:nowrap;margin-bottom:5px;' +
+                (ordenavel ? 'cursor:pointer;' : '');
             sortWrap.innerHTML =
                 '<span style="font-size:11px;font-weight:600;">' + labelOriginal + '</span>' +
-                '<span class="tm-sort-ico" style="font-size:9px;opacity:.4;transition:opacity .15s;">⇅</span>';
-            sortWrap.addEventListener('click', () => this._toggleSort(col.chave));
+                '<span class="tm-sort-ico" style="font-size:9px;opacity:.4;transition:opacity .15s;">' + (ordenavel ? '⇅' : '') + '</span>';
+            if (ordenavel) sortWrap.addEventListener('click', () => this._toggleSort(col.chave));
             th.appendChild(sortWrap);
 
+            // Remoto: só filtra o que o servidor aceita
+            if (this.remoto && !col.param) return;
+
             // ── Filtro por tipo ──────────────────────────────
             const tipo   = col.tipo   || 'texto';
             const opcoes = col.opcoes || false;
@@ -172,9 +208,7 @@ class TabelaManager {
                     inp.addEventListener('input', () => {
                         this.filtros[col.chave].min = inputMin.value;
                         this.filtros[col.chave].max = inputMax.value;
-                        this.pag = 1;
-                        this._atualizarBtnLimpar();
-                        this._render();
+                        this._filtrosMudaram(true);
                     });
                 });
 
@@ -207,9 +241,7 @@ class TabelaManager {
                     inp.addEventListener('change', () => {
                         this.filtros[col.chave].min = inputMin.value;
                         this.filtros[col.chave].max = inputMax.value;
-                        this.pag = 1;
-                        this._atualizarBtnLimpar();
-                        this._render();
+                        this._filtrosMudaram();
                     });
                 });
 
@@ -226,11 +258,10 @@ class TabelaManager {
                 sel.innerHTML = '<option value="" style="color:#000;background:#fff;">Todos</option>';
                 sel.addEventListener('change', () => {
                     this.filtros[col.chave].val = sel.value;
-                    this.pag = 1;
-                    this._atualizarBtnLimpar();
-                    this._render();
+                    this._filtrosMudaram();
                 });
                 th.appendChild(sel);
+                if (Array.isArray(opcoes)) this.definirOpcoes(col.chave, opcoes);
 
             } else {
                 // Input texto livre (busca parcial)
@@ -241,9 +272,7 @@ class TabelaManager {
                 inp.style.cssText = this._estiloInput();
                 inp.addEventListener('input', () => {
                     this.filtros[col.chave].val = inp.value.toLowerCase().trim();
-                    this.pag = 1;
-                    this._atualizarBtnLimpar();
-                    this._render();
+                    this._filtrosMudaram(true);
                 });
                 th.appendChild(inp);
             }
@@ -263,16 +292,14 @@ class TabelaManager {
             this.sortDir = 'asc';
         }
         this._atualizarIconesSort();
-        this._atualizarBtnLimpar();
-        this.pag = 1;
-        this._render();
+        this._filtrosMudaram();
     }
 
     _atualizarIconesSort() {
         if (!this.thead) return;
         this.thead.querySelectorAll('.tm-sort-ico').forEach((ico, i) => {
             const col = this.colunas[i];
-            if (!col || col.tipo === 'acoes') return;
+            if (!col || col.tipo === 'acoes' || (this.remoto && !col.ordem)) return;
             if (col.chave === this.sortCol) {
                 ico.textContent = this.sortDir === 'asc' ? ' ↑' : ' ↓';
                 ico.style.opacity = '1';
@@ -288,7 +315,7 @@ class TabelaManager {
     // ════════════════════════════════════════════════════════
 
     _atualizarSelects(meta) {
-        if (!this.thead) return;
+        if (!this.thead || this.remoto) return;
         this.thead.querySelectorAll('select.tm-filter').forEach(sel => {
             const chave = sel.dataset.chave;
             const val   = String(meta[chave] ?? '').trim();
@@ -310,29 +337,46 @@ class TabelaManager {
         });
     }
 
+    // Opções fixas de um <select>: strings ou { valor, rotulo }
+    definirOpcoes(chave, lista) {
+        const sel = this.thead?.querySelector('select.tm-filter[data-chave="' + chave + '"]');
+        if (!sel) return;
+        const atual = sel.value;
+        sel.innerHTML = '<option value="" style="color:#000;background:#fff;">Todos</option>';
+        lista.forEach(op => {
+            const o = document.createElement('option');
+            o.value       = typeof op === 'object' ? op.valor  : op;
+            o.textContent = typeof op === 'object' ? op.rotulo : op;
+            o.style.cssText = 'color:#000;background:#fff;';
+            sel.appendChild(o);
+        });
+        sel.value = atual;
+    }
+
     // ════════════════════════════════════════════════════════
     // API pública
     // ════════════════════════════════════════════════════════
 
     adicionar(tr, meta) {
         this.itens.push({ tr, meta });
-        this.tbody.appendChild(tr);
+        if (!this.remoto) this.tbody.appendChild(tr);
         this._atualizarSelects(meta);
-
-        if (this.onEditar) {
-            tr.style.cursor = 'pointer';
-            tr.title = 'Clique para editar';
-            tr.addEventListener('mouseenter', () => { if (!tr._editando) tr.style.background = '#f0f7f0'; });
-            tr.addEventListener('mouseleave', () => { if (!tr._editando) tr.style.background = '';       });
-            tr.addEventListener('click', (e) => {
-                if (e.target.closest('button, a, select, input')) return;
-                this.onEditar(meta, tr);
-            });
-        }
-
+        this._ligarEdicao(tr, meta);
         this._render();
     }
 
+    _ligarEdicao(tr, meta) {
+        if (!this.onEditar) return;
+        tr.style.cursor = 'pointer';
+        tr.title = 'Clique para editar';
+        tr.addEventListener('mouseenter', () => { if (!tr._editando) tr.style.background = '#f0f7f0'; });
+        tr.addEventListener('mouseleave', () => { if (!tr._editando) tr.style.background = '';       });
+        tr.addEventListener('click', (e) => {
+            if (e.target.closest('button, a, select, input')) return;
+            this.onEditar(meta, tr);
+        });
+    }
+
     remover(tr) {
         this.itens = this.itens.filter(i => i.tr !== tr);
         tr.remove();
@@ -350,6 +394,140 @@ class TabelaManager {
 
     contar() { return this.itens.length; }
 
+    // ════════════════════════════════════════════════════════
+    // Modo remoto: janelas por cursor + rolagem virtual
+    // ════════════════════════════════════════════════════════
+
+    _iniciarRemoto() {
+        this._seq        = 0;      // descarta respostas de buscas antigas
+        this._proximo    = null;
+        this._carregando = false;
+        this._erro       = null;
+        this._alturaLinha = 41;    // estimativa; medida na primeira linha real
+        this._medida     = false;
+        this._folga      = 10;     // linhas extras acima/abaixo da área visível
+
+        this._area = this.tbody.closest('.table-wrapper') || this.tbody.parentElement.parentElement;
+        this._area.style.maxHeight = this.remoto.altura || '70vh';
+        this._area.style.overflowY = 'auto';
+
+        const nCols = this.colunas.length;
+        this._espacoTopo = document.createElement('tr');
+        this._espacoFim  = document.createElement('tr');
+        [this._espacoTopo, this._espacoFim].forEach(tr => {
+            tr.innerHTML = '<td colspan="' + nCols + '" style="padding:0;border:0;"></td>';
+        });
+
+        let agendado = false;
+        this._area.addEventListener('scroll', () => {
+            if (agendado) return;
+            agendado = true;
+            requestAnimationFrame(() => { agendado = false; this._render(); });
+        });
+    }
+
+    recarregar() {
+        if (!this.remoto) return;
+        this._seq++;
+        this.itens    = [];
+        this._proximo = null;
+        this._erro    = null;
+        this._area.scrollTop = 0;
+        this._buscarJanela();
+    }
+
+    _paramsRemotos() {
+        const p = new URLSearchParams();
+        this.colunas.forEach(col => {
+            const f = this.filtros[col.chave];
+            if (!f || !col.param) return;
+            if (Array.isArray(col.param)) {
+                if (f.min) p.set(col.param[0], f.min);
+                if (f.max) p.set(col.param[1], f.max);
+            } else if (f.val) {
+                p.set(col.param, f.val);
+            }
+        });
+        const colSort = this.colunas.find(c => c.chave === this.sortCol);
+        if (colSort?.ordem) { p.set('ordem', colSort.ordem); p.set('dir', this.sortDir); }
+        p.set('limite', this.remoto.limite || 100);
+        if (this._proximo) p.set('cursor', this._proximo);
+        return p;
+    }
+
+    _buscarJanela() {
+        const seq = this._seq;
+        this._carregando = true;
+        this._render();
+        fetch(this.remoto.url + '?' + this._paramsRemotos())
+            .then(r => r.json())
+            .then(d => {
+                if (seq !== this._seq) return;
+                this._carregando = false;
+                if (!d.success) { this._erro = d.error || 'desconhecido'; this._render(); return; }
+                d.itens.forEach(item => {
+                    const tr = this.remoto.linha(item);
+                    this._ligarEdicao(tr, item);
+                    this.itens.push({ tr, meta: item });
+                });
+                this._proximo = d.proximo;
+                this._render();
+            })
+            .catch(() => {
+                if (seq !== this._seq) return;
+                this._carregando = false;
+                this._erro = 'falha de conexão';
+                this._render();
+            });
+    }
+
+    _renderVirtual() {
+        const n = this.itens.length;
+        const h = this._alturaLinha;
+        const visiveis = Math.ceil((this._area.clientHeight || 420) / h);
+        const topo = Math.floor(this._area.scrollTop / h);
+        // Início sempre par: mantém a alternância do table-striped ao rolar
+        let ini = Math.max(0, topo - this._folga);
+        ini -= ini % 2;
+        const fim = Math.min(n, topo + visiveis + this._folga);
+
+        this._espacoTopo.style.height = (ini * h) + 'px';
+        this._espacoFim.style.height  = (Math.max(0, n - fim) * h) + 'px';
+        const frag = document.createDocumentFragment();
+        frag.appendChild(this._espacoTopo);
+        for (let i = ini; i < fim; i++) frag.appendChild(this.itens[i].tr);
+        frag.appendChild(this._espacoFim);
+        this.tbody.replaceChildren(frag);
+
+        if (!this._medida && fim > ini) {
+            const real = this.itens[ini].tr.offsetHeight;
+            if (real) {
+                this._medida = true;
+                if (real !== h) { this._alturaLinha = real; this._renderVirtual(); return; }
+            }
+        }
+
+        if (this.infoSpan) {
+            if (this._erro) {
+                this.infoSpan.textContent = 'Erro ao carregar: ' + this._erro;
+            } else if (n === 0) {
+                this.infoSpan.textContent = this._carregando ? 'Carregando…' : (
+                    Object.values(this.filtros).some(f => f.val || f.min || f.max)
+                        ? 'Nenhum resultado para os filtros aplicados'
+                        : 'Nenhum registro');
+            } else {
+                const de = Math.min(n, topo + 1), ate = Math.min(n, topo + visiveis);
+                this.infoSpan.textContent = 'Mostrando ' + de + '–' + ate + ' de ' + n +
+                    (this._proximo ? '+ (role para carregar mais)' : '');
+            }
+        }
+
+        // Perto do fim do que já veio: busca a próxima janela
+        if (this._proximo && !this._carregando && !this._erro && fim >= n - this._folga) {
+            this._buscarJanela();
+        }
+    }
+
     // ════════════════════════════════════════════════════════
     // Filtragem
     // ════════════════════════════════════════════════════════
@@ -419,6 +597,7 @@ class TabelaManager {
     _ipp() { return this.selLinhas ? parseInt(this.selLinhas.value) : 10; }
 
     _render() {
+        if (this.remoto) { this._renderVirtual(); return; }
         const filtrados = this._filtrados();
         const ordenados = this._ordenados(filtrados);
         const total = ordenados.length;
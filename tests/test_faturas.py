@@ -0,0 +1,77 @@
+import os
+import sys
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as financas  # noqa: E402
+
+# Cartão com vencimento dia 10 e fechamento 7 dias antes: em 17/10/2026 o
+# ciclo 03/09–02/10 (vence 10/10) está fechado e 03/10–02/11 está aberto.
+HOJE = date(2026, 10, 17)
+
+
+@pytest.fixture
+def cliente(tmp_path, monkeypatch):
+    monkeypatch.setattr(financas, 'DB', str(tmp_path / 'financas.db'))
+    financas.init_db()
+    yield financas.app.test_client()
+    financas.escritor.parar()
+    financas.fechar_db_thread()
+
+
+@pytest.fixture
+def cartao(cliente):
+    conta = cliente.post('/api/adicionar_conta', json={'nome': 'Corrente'}).get_json()['id']
+    return cliente.post('/api/adicionar_cartao', json={
+        'nome': 'Platinum', 'conta': conta, 'tipo_pagamento': 'credito',
+        'data_vencimento': 10, 'dias_fechamento': 7}).get_json()['id']
+
+
+def lancar(cliente, cartao, data, valor, parcelas=None, descricao='compra'):
+    corpo = {'tipo': 'despesa', 'descricao': descricao, 'valor': valor, 'id_cartao': cartao,
+             'tipo_compra': 'credito', 'data': data}
+    if parcelas:
+        corpo.update(pagamento='parcelado', parcelas=parcelas)
+    assert cliente.post('/api/adicionar_lancamento', json=corpo).get_json()['success']
+
+
+def fechada(cartao, vencimento):
+    return financas.get_db().execute(
+        "SELECT id, total FROM faturas WHERE id_cartao=? AND vencimento=?",
+        (cartao, vencimento)).fetchone()
+
+
+def aberta(cartao):
+    return financas.faturas_abertas(financas.get_db().cursor(), cartao, com_itens=True, hoje=HOJE)[cartao]
+
+
+def test_compra_depois_do_fechamento_nao_mexe_na_fatura_fechada(cliente, cartao):
+    lancar(cliente, cartao, '2026-09-20', 50)
+    financas.fechar_faturas(hoje=HOJE)
+    antes = fechada(cartao, '2026-10-10')
+    assert antes['total'] == 50
+
+    lancar(cliente, cartao, '2026-10-17', 300, parcelas=3, descricao='nova parcelada')
+    assert financas.fechar_faturas(hoje=HOJE)[1] == 0
+    depois = fechada(cartao, '2026-10-10')
+    assert (depois['id'], depois['total']) == (antes['id'], 50)
+
+    fatura = aberta(cartao)
+    assert fatura['total'] == 100
+    assert [(i['descricao'], i['parcela']) for i in fatura['itens']] == [('nova parcelada', 1)]
+
+
+def test_parcelada_retroativa_refaz_o_ciclo_da_compra(cliente, cartao):
+    lancar(cliente, cartao, '2026-09-20', 50)
+    financas.fechar_faturas(hoje=HOJE)
+
+    lancar(cliente, cartao, '2026-09-25', 200, parcelas=2, descricao='retroativa')
+    assert fechada(cartao, '2026-10-10') is None
+    assert financas.fechar_faturas(hoje=HOJE)[1] == 1
+    assert fechada(cartao, '2026-10-10')['total'] == 150
+
+    fatura = aberta(cartao)
+    assert [(i['descricao'], i['parcela']) for i in fatura['itens']] == [('retroativa', 2)]
+    assert fatura['total'] == 100